@@ -50,7 +50,13 @@ def login():
         password = form.password.data
         if is_valid:
             try:
-                result = DB.selectOne("SELECT id, email, username, password FROM IS601_Users where email= %(email)s or username=%(email)s", {"email":email})
+                # the roles are looked up by the same email/username so both reads go in one round trip
+                result, roles = DB.batch().selectOne(
+                    "SELECT id, email, username, password FROM IS601_Users where email= %(email)s or username=%(email)s", {"email":email}
+                ).selectAll("""
+                    SELECT name FROM IS601_Roles r JOIN IS601_UserRoles ur on r.id = ur.role_id JOIN IS601_Users u on u.id = ur.user_id
+                    WHERE (u.email = %(email)s or u.username = %(email)s) AND r.is_active = 1 AND ur.is_active = 1
+                    """, {"email":email}).run()
                 if result.status and result.row:
                     hash = result.row["password"]
                     if bcrypt.check_password_hash(hash, password):
@@ -58,12 +64,9 @@ def login():
                         del result.row["password"] # don't carry password/hash beyond here
                         user = User(**result.row)
                         # get roles
-                        result = DB.selectAll("""
-                        SELECT name FROM IS601_Roles r JOIN IS601_UserRoles ur on r.id = ur.role_id WHERE ur.user_id = %s AND r.is_active = 1 AND ur.is_active = 1
-                        """, user.id)
-                        if result.status and result.rows:
-                            print("role rows", result.rows)
-                            user.roles = [Role(**r) for r in result.rows]
+                        if roles.status and roles.rows:
+                            print("role rows", roles.rows)
+                            user.roles = [Role(**r) for r in roles.rows]
                         print(f"Roles: {user.roles}")
                         success = login_user(user) # login the user via flask_login
                         
@@ -1,15 +1,20 @@
 from flask import Blueprint, flash, render_template, request, redirect, url_for
-from sql.db import DB  # Import your DB class
+from sql.db import DB, DBTimeoutError  # Import your DB class
 from brokers.forms import BrokerForm  # Import your BrokerForm class
 from roles.permissions import admin_permission
-from brokerstock_utils.utils import manage_broker_stocks
+from brokerstock_utils.utils import fetch_stocks, manage_broker_stocks
 from utils.lazy import DictToObject
 from brokers.models import Broker
 from stocks.models import Stock
 brokers = Blueprint('brokers', __name__, url_prefix='/brokers', template_folder='templates')
 from faker import Faker
+import asyncio
 import random
 
+# rows are mapped straight from the cursor's tuples (row_format=Stock/Broker) instead of dict -> **kwargs
+DB.registerMapper(Stock)
+DB.registerMapper(Broker)
+
 def populate_form_with_broker(form, broker):
    # form.process(obj=broker)
     
@@ -33,69 +38,100 @@ def generate_random_broker():
     name = fake.name()
     rarity = random.choices(range(1, 11), weights=[10, 9, 8, 7, 6, 5, 4, 3, 2, 1], k=1)[0]
     broker = Broker(id=None, name=name, rarity=rarity, life=0, power=0, defense=0, stonks=0)
-    result = DB.selectAll("SELECT DISTINCT symbol FROM IS601_Stocks")
-    stocks = []
+    # the symbol universe rarely changes so it's served from the result cache
+    result = DB.selectAll("SELECT DISTINCT symbol FROM IS601_Stocks", cache=True, row_format="columns")
+    selected_symbols = []
     if result.status:
-        available_symbols = [row['symbol'] for row in result.rows]
+        available_symbols = result.rows["symbol"]
         selected_symbols = random.sample(available_symbols, min(len(available_symbols), rarity))
-        placeholders = ",".join(["%s" for x in selected_symbols])
+    if selected_symbols:
+        in_symbols, params = DB.inClause("symbol", selected_symbols)
         query = f"""
         SELECT *, 1 as shares FROM IS601_Stocks 
-        WHERE symbol in ({placeholders})
+        WHERE {in_symbols}
         AND IS601_Stocks.latest_trading_day = (
             SELECT MAX(latest_trading_day) FROM IS601_Stocks AS latest_stock
             WHERE latest_stock.symbol = IS601_Stocks.symbol
         )"""
-        result = DB.selectAll(query, *selected_symbols)
-        if result.status and result.rows:
-            print(f"rows: {result.rows}")
-            for row in result.rows:
-                broker.add_stock(Stock(**row))
+        try:
+            # the correlated MAX() subquery gets slow as IS601_Stocks grows, a broker without
+            # stocks is better than a hung page
+            result = DB.selectAll(query, *params, cache=True, row_format=Stock, timeout=2)
+        except DBTimeoutError as e:
+            print(f"Skipping stocks for the random broker: {e}")
+            result = None
+        if result and result.status and result.rows:
+            for stock in result.rows:
+                broker.add_stock(stock)
     
     broker.recalculate_stats()
     return broker
 def create_or_update_broker(form, broker_id=None):
-    if not broker_id:
-        query = "INSERT INTO IS601_Brokers (Name, Rarity, Life, Power, Defense, Stonks) VALUES (%s, %s, %s, %s, %s, %s)"
-        values = (form.name.data, form.rarity.data, form.life.data, form.power.data, form.defense.data, form.stonks.data)
-
-        result = DB.insertOne(query, *values)
-        broker_id = result.insert_id
-    
+    # quotes for new symbols come from the API first, so the transaction (and its connection)
+    # isn't held open during those calls
     stock_symbols = [{"symbol": entry.symbol.data, "shares": entry.shares.data} for entry in form.stocks]
-    manage_broker_stocks(broker_id, stock_symbols)
-    broker = fetch_broker_data(broker_id)
-    #populate_form_with_broker(form, broker)
-    if broker_id:
-        query = "UPDATE IS601_Brokers SET name = %s, rarity = %s, life = %s, power = %s, defense = %s, stonks = %s WHERE id = %s"
-        values = (broker.name, broker.rarity, broker.life, broker.power, broker.defense, broker.stonks, broker_id)
-        result = DB.update(query, *values)
+    stocks = fetch_stocks([s["symbol"] for s in stock_symbols])
+    found = {stock["symbol"] for stock in stocks}
+    missing = [s["symbol"] for s in stock_symbols if f"{s['symbol']}".upper().strip() not in found]
+    if missing:
+        # e.g., past the API's rate limit, saving the broker without them would drop them silently
+        raise Exception(f"Couldn't get quotes for {', '.join(missing)}, try again shortly")
+    # one transaction so a failure part way doesn't leave a half saved broker
+    # and all the statements share a single commit, on the broker's shard (a new one picks a shard)
+    with DB.shard(broker_id), DB.transaction():
+        if not broker_id:
+            query = "INSERT INTO IS601_Brokers (Name, Rarity, Life, Power, Defense, Stonks) VALUES (%s, %s, %s, %s, %s, %s)"
+            values = (form.name.data, form.rarity.data, form.life.data, form.power.data, form.defense.data, form.stonks.data)
+
+            result = DB.insertOne(query, *values)
+            broker_id = result.insert_id
+
+        manage_broker_stocks(broker_id, stock_symbols, stocks)
+        broker = fetch_broker_data(broker_id)
+        #populate_form_with_broker(form, broker)
+        if broker_id:
+            query = "UPDATE IS601_Brokers SET name = %s, rarity = %s, life = %s, power = %s, defense = %s, stonks = %s WHERE id = %s"
+            values = (broker.name, broker.rarity, broker.life, broker.power, broker.defense, broker.stonks, broker_id)
+            result = DB.update(query, *values)
 
         
     return result
-def fetch_broker_data(broker_id):
-    broker = Broker(**DB.selectOne("SELECT * FROM IS601_Brokers WHERE id = %s", broker_id).row)
-    stocks = get_stock_associations(broker.id)
-    for stock in stocks:
-        broker.add_stock(stock)
-    broker.recalculate_stats()
-    return broker
-
-def get_stock_associations(id):
-    stocks = []
-    stock_associations = DB.selectAll(
-        """SELECT IS601_Stocks.*, IS601_BrokerStocks.shares FROM IS601_Stocks 
+STOCK_ASSOCIATIONS_QUERY = """SELECT IS601_Stocks.*, IS601_BrokerStocks.shares FROM IS601_Stocks 
         JOIN IS601_BrokerStocks ON IS601_Stocks.symbol = IS601_BrokerStocks.symbol 
         WHERE IS601_BrokerStocks.broker_id = %s
         AND IS601_Stocks.latest_trading_day = (
             SELECT MAX(latest_trading_day) FROM IS601_Stocks AS latest_stock
             WHERE latest_stock.symbol = IS601_Stocks.symbol
         )
-        """, id
+        """
+
+def fetch_broker_data(broker_id):
+    with DB.shard(broker_id):
+        return DB.gather(afetch_broker_data(broker_id))[0]
+
+async def afetch_broker_data(broker_id):
+    # the broker row and its stocks don't depend on each other so they're loaded concurrently
+    result, stock_associations = await asyncio.gather(
+        DB.aselectOne("SELECT * FROM IS601_Brokers WHERE id = %s", broker_id, row_format=Broker),
+        DB.aselectAll(STOCK_ASSOCIATIONS_QUERY, broker_id, row_format=Stock)
     )
-        
+    if not result.status or not result.row:
+        return None
+    broker = result.row
+    for stock in stocks_from_result(stock_associations):
+        broker.add_stock(stock)
+    broker.recalculate_stats()
+    return broker
+
+def get_stock_associations(id):
+    with DB.shard(id):
+        return stocks_from_result(DB.selectAll(STOCK_ASSOCIATIONS_QUERY, id, row_format=Stock))
+
+def stocks_from_result(stock_associations):
+    # expects a select run with row_format=Stock
+    stocks = []
     if stock_associations.status:
-        stocks = [Stock(**stock) for stock in stock_associations.rows]
+        stocks = stock_associations.rows
     return stocks
 
 @brokers.route("/random", methods=["GET", "POST"])
@@ -104,10 +140,13 @@ def random_broker():
     form = BrokerForm()
 
     if form.validate_on_submit():
-        result = create_or_update_broker(form)
-        if result.status:
-            flash(f"Created broker record for {form.name.data}", "success")
-            #return redirect(url_for('brokers.list'))
+        try:
+            result = create_or_update_broker(form)
+            if result.status:
+                flash(f"Created broker record for {form.name.data}", "success")
+                #return redirect(url_for('brokers.list'))
+        except Exception as e:
+            flash(f"Error creating broker record: {e}", "danger")
     else:
         print("Form Errors:", form.errors)
     broker = generate_random_broker()
@@ -122,11 +161,14 @@ def add():
     form = BrokerForm()
     
     if form.validate_on_submit():
-        result = create_or_update_broker(form)
-        if result.status:
-            flash(f"Created broker record for {form.name.data}", "success")
-        else:
-            flash(f"Error creating broker record: {result.error}", "danger")
+        try:
+            result = create_or_update_broker(form)
+            if result.status:
+                flash(f"Created broker record for {form.name.data}", "success")
+            else:
+                flash(f"Error creating broker record: {result.error}", "danger")
+        except Exception as e:
+            flash(f"Error creating broker record: {e}", "danger")
     else:
         print("Form Errors:", form.errors)
     return render_template("broker_form.html", form=form, type="Create")
@@ -140,11 +182,14 @@ def edit():
         flash("Missing ID", "danger")
         return redirect(url_for("brokers.list"))
     if form.validate_on_submit():
-        result = create_or_update_broker(form, broker_id=id)
-        if result.status:
-            flash(f"Updated broker record for {form.name.data}", "success")
-        else:
-            flash(f"Error updating broker record: {result.error}", "danger")
+        try:
+            result = create_or_update_broker(form, broker_id=id)
+            if result.status:
+                flash(f"Updated broker record for {form.name.data}", "success")
+            else:
+                flash(f"Error updating broker record: {result.error}", "danger")
+        except Exception as e:
+            flash(f"Error updating broker record: {e}", "danger")
     else:
         print("Form Errors:", form.errors)
     broker = fetch_broker_data(id)
@@ -156,7 +201,9 @@ def edit():
 def list():
     brokers = []
     try:
-        result = DB.selectAll("SELECT id, Name, Rarity, Life, Power, Defense, Stonks FROM IS601_Brokers")
+        # brokers can be spread over several shards, each one's are merged back in id order
+        result = DB.selectAllShards("SELECT id, Name, Rarity, Life, Power, Defense, Stonks FROM IS601_Brokers",
+                                    key=lambda row: row["id"])
         if result.status:
             brokers = result.rows
     except Exception as e:
@@ -171,8 +218,9 @@ def delete():
         flash("Missing ID", "danger")
         return redirect(url_for("brokers.list"))
     try:
-        result = DB.delete("DELETE FROM IS601_BrokerStocks WHERE broker_id = %s", id)
-        result = DB.delete("DELETE FROM IS601_Brokers WHERE id = %s", id)
+        with DB.shard(id):
+            result = DB.delete("DELETE FROM IS601_BrokerStocks WHERE broker_id = %s", id)
+            result = DB.delete("DELETE FROM IS601_Brokers WHERE id = %s", id)
         if result.status:
             flash("Deleted broker record", "success")
     except Exception as e:
@@ -187,12 +235,14 @@ def view():
         return redirect(url_for("brokers.list"))
     broker = None
     try:
-        result = DB.selectOne(
-            "SELECT id, name, rarity, life, power, defense, stonks FROM IS601_Brokers WHERE id = %s", id
-        )
-        if result.status:
-            broker = fetch_broker_data(id)
-        else:
+        with DB.shard(id):
+            result, broker = DB.gather(
+                DB.aselectOne(
+                    "SELECT id, name, rarity, life, power, defense, stonks FROM IS601_Brokers WHERE id = %s", id
+                ),
+                afetch_broker_data(id)
+            )
+        if not result.status or broker is None:
             flash("Broker record not found", "danger")
             return redirect(url_for('brokers.list'))
     except Exception as e:
@@ -1,35 +1,44 @@
 from sql.db import DB
 from utils.AlphaVantage import AlphaVantage
+
+# the fields of AlphaVantage.quote()
+STOCK_COLUMNS = ["symbol", "open", "high", "low", "price", "volume", "latest_trading_day", "previous_close",
+                 "change", "change_percent"]
+
 def fetch_stocks(symbols):
     symbols = [s.upper().strip() for s in symbols]
-    placeholders = ','.join(['%s'] * len(symbols))
     print(f"Symbols: {symbols}")
-    print(f"Placeholders: {placeholders}")
-    result = DB.selectAll(f"SELECT id, symbol FROM IS601_Stocks WHERE symbol IN ({placeholders})", *tuple(symbols))
+    in_symbols, params = DB.inClause("symbol", symbols)
+    result = DB.selectAll(f"SELECT id, symbol FROM IS601_Stocks WHERE {in_symbols}", *params)
     
     stocks = {row['symbol']: row['id'] for row in result.rows} if result.status and result.rows else {}
     print(stocks)
-    for symbol in symbols:
-        if symbol not in stocks.keys():
-            stock_data = AlphaVantage.quote(symbol)
-            if stock_data:
-                # Assuming stock_data is a dict with correct keys and values
-                cols = ', '.join([f"`{k}`" for k in stock_data.keys()])
-                placeholders = ', '.join(['%s'] * len(stock_data))
-                values = tuple(stock_data.values())
-                query = f"INSERT INTO IS601_Stocks ({cols}) VALUES ({placeholders})"
-                result = DB.insertOne(query, *values)
-                if result.status and result.insert_id:
-                    print(f"Successfully inserted stock {symbol}: {stock_data}")
-                    stocks[symbol] = result.insert_id
+    missing = [symbol for symbol in symbols if symbol not in stocks]
+    if missing:
+        # every missing quote at once (bulk call or in parallel) and a single insert for them
+        rows = []
+        for symbol, stock_data in AlphaVantage.quotes(missing).items():
+            if isinstance(stock_data, Exception):
+                print(f"Unable to fetch stock {symbol}: {stock_data}")
+            elif stock_data:
+                rows.append(stock_data)
+        if rows:
+            result = DB.bulkUpsert("IS601_Stocks", STOCK_COLUMNS, rows)
+            if result.status:
+                print(f"Successfully inserted stocks {[row['symbol'] for row in rows]}")
+                in_symbols, params = DB.inClause("symbol", [row["symbol"] for row in rows])
+                result = DB.selectAll(f"SELECT id, symbol FROM IS601_Stocks WHERE {in_symbols}", *params)
+                stocks.update({row['symbol']: row['id'] for row in result.rows or []})
 
     return [{"id": stock_id, "symbol": symbol} for symbol, stock_id in stocks.items()]
 
 
 
-def manage_broker_stocks(broker_id, symbol_data):
-    symbols = [s["symbol"] for s in symbol_data]
-    stocks = fetch_stocks(symbols)
+def manage_broker_stocks(broker_id, symbol_data, stocks=None):
+    # stocks: fetch_stocks() of the symbols when the caller already has them (it calls the API for missing
+    # quotes, better done before opening a transaction)
+    if stocks is None:
+        stocks = fetch_stocks([s["symbol"] for s in symbol_data])
 
     # Merge stocks with symbol_data
     merged_stocks = []
@@ -40,20 +49,14 @@ def manage_broker_stocks(broker_id, symbol_data):
 
     # Delete existing associations not in the new list
     stock_symbols = [s['symbol'] for s in merged_stocks]
-    delete_placeholders = ','.join(['%s'] * len(stock_symbols))
-    DB.delete(f"DELETE FROM IS601_BrokerStocks WHERE broker_id = %s and symbol NOT IN ({delete_placeholders})", *([broker_id] + stock_symbols))
-
-    # Prepare data for bulk insert
-    insert_values = {}
-    placeholders = []
-    for i, stock in enumerate(merged_stocks):
-        placeholders.append(f"(%(b{i})s, %(s{i})s, %(sh{i})s)")
-        insert_values.update({f"b{i}": broker_id, f"s{i}": stock['symbol'], f"sh{i}": stock['shares']})
+    not_in_symbols, params = DB.inClause("symbol", stock_symbols, negate=True)
+    DB.delete(f"DELETE FROM IS601_BrokerStocks WHERE broker_id = %s and {not_in_symbols}", broker_id, *params)
 
     # Bulk insert new associations
     if merged_stocks:
-        query = f"INSERT INTO IS601_BrokerStocks (broker_id, symbol, shares) VALUES {','.join(placeholders)} ON DUPLICATE KEY UPDATE shares = VALUES(shares)"
-        result = DB.insertOne(query, insert_values)
+        result = DB.bulkUpsert("IS601_BrokerStocks", ["broker_id", "symbol", "shares"],
+                               [(broker_id, stock['symbol'], stock['shares']) for stock in merged_stocks],
+                               ["shares"])
         if result.status:
             print("Successful mapping of broker to stocks")
         else:
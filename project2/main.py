@@ -43,8 +43,23 @@ def create_app(config_filename=''):
         app.register_blueprint(stocks)
         from brokers.brokers import brokers
         app.register_blueprint(brokers)
+        from views.metrics import metrics
+        app.register_blueprint(metrics)
         # load the extension
         principals = Principal(app) # must be defined/initialized for identity to work (flask_principal)
+        # open DB connections up front so the worker's first requests don't pay for connecting
+        try:
+            from sql.db import DB
+            DB.warmPool(int(os.environ.get("DB_POOL_PREWARM", 2)))
+        except Exception as e:
+            print("Unable to pre-warm the DB pool", e)
+        # optional time budget (seconds) for all of a request's selects, see DB.requestDeadline()
+        request_deadline = float(os.environ.get("DB_REQUEST_DEADLINE", 0))
+        if request_deadline > 0:
+            @app.before_request
+            def start_db_deadline():
+                from sql.db import DB
+                DB.requestDeadline(request_deadline)
         @login_manager.user_loader
         def load_user(user_id):
             if user_id is None:
@@ -61,7 +76,9 @@ def create_app(config_filename=''):
             from sql.db import DB
             print("loading user from DB") # note: we'd lose roles here since it makes a new user object without a roles query
             try:
-                result = DB.selectOne("SELECT id, email FROM IS601_Users WHERE id = %s", user_id)
+                # runs for whichever page is loading, reported on its own in the query budget
+                with DB.budgetLabel("load_user"):
+                    result = DB.selectOne("SELECT id, email FROM IS601_Users WHERE id = %s", user_id)
                 if result.status:
                     return User(**result.row)
             except Exception as e:
@@ -1,5 +1,5 @@
 from flask import Blueprint, flash, render_template, request, redirect, url_for
-from sql.db import DB
+from sql.db import DB, DBTimeoutError
 from roles.forms import RoleForm
 from werkzeug.datastructures import MultiDict
 from roles.permissions import admin_permission
@@ -54,7 +54,7 @@ def edit():
 def list():
     rows = [] 
     try:
-        result = DB.selectAll("SELECT id,name, description, is_active FROM IS601_Roles LIMIT 100",)
+        result = DB.selectAll("SELECT id,name, description, is_active FROM IS601_Roles LIMIT 100", cache=True)
         if result.status and result.rows:
             rows = result.rows
     except Exception as e:
@@ -93,20 +93,29 @@ def assign():
     roles = []
 
     email = request.args.get("email")
+    # the user search and the active roles go in one round trip (roles usually come from the result cache)
+    batch = DB.batch()
     if email:
-        try:
-            result = DB.selectAll("""
+        batch.selectAll("""
             SELECT id, email, 
                 (SELECT GROUP_CONCAT(name, ' (' , IF(ur.is_active = 1,'active','inactive') , ')') from 
                 IS601_UserRoles ur JOIN IS601_Roles on ur.role_id = IS601_Roles.id WHERE ur.user_id = IS601_Users.id) as roles
             FROM IS601_Users where email like %s limit 10
             
             """, f"%{email}%")
-            if result.status and result.rows:
-                users = result.rows
-        except Exception as e:
-            flash(str(e), "danger")
-    result = DB.selectAll("SELECT id, name FROM IS601_Roles WHERE is_active = 1",)
+    batch.selectAll("SELECT id, name FROM IS601_Roles WHERE is_active = 1", cache=True)
+    try:
+        # a leading % wildcard can't use an index, don't let a slow search hold the worker
+        *found, result = batch.run(timeout=3)
+        if found and found[0].status and found[0].rows:
+            users = found[0].rows
+    except DBTimeoutError:
+        flash("The search took too long, try a more specific email", "warning")
+        result = DB.selectAll("SELECT id, name FROM IS601_Roles WHERE is_active = 1", cache=True)
+    except Exception as e:
+        flash(str(e), "danger")
+        # the roles are still needed for the page
+        result = DB.selectAll("SELECT id, name FROM IS601_Roles WHERE is_active = 1", cache=True)
     if result.status and result.rows:
         roles = result.rows
     return render_template("assign.html", users=users, roles=roles)
@@ -124,10 +133,12 @@ def apply():
         for user in users:
             for role in roles:
                 print(user, role)
-                mappings.append((int(user), int(role)))
+                mappings.append((int(user), int(role), 1))
         if len(mappings) > 0:
             try:
-                result = DB.insertMany("INSERT INTO IS601_UserRoles (user_id, role_id, is_active) VALUES(%s, %s, 1) ON DUPLICATE KEY UPDATE is_active = !is_active", mappings)
+                # toggles existing mappings, one statement per chunk instead of one per mapping
+                result = DB.bulkUpsert("IS601_UserRoles", ["user_id", "role_id", "is_active"], mappings,
+                                       {"is_active": "!is_active"})
                 if result.status:
                     flash(f"Successfully enabled/disabled roles for the user/role {len(mappings)} mappings", "success")
             except Exception as e:
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+
+from sql.db import DB, DBConfig
+
+# usage (from project2, so the app's modules import the same way they do in the app):
+#   python -m sql.bench [queries]
+#   per-query overhead of a pooled query (DB.connection())
+#   uses DB_URL from the environment/.env (sqlite:// when unset so it runs without a server),
+#   against MySQL the liveness check is a full round trip so the difference is much larger
+#   python -m sql.bench drivers [iterations]
+#   the app's stocks list and broker loading on each MySQL driver/option (needs a mysql:// DB_URL
+#   with some data, drivers that aren't installed are skipped)
+
+QUERY = "SELECT 1"
+
+
+def run(queries, ping_interval):
+    os.environ["DB_PING_INTERVAL"] = str(ping_interval)
+    DB.reset()
+    DB.selectOne(QUERY)  # connect outside of the timing
+    start = time.perf_counter()
+    for _ in range(queries):
+        DB.selectOne(QUERY)
+    elapsed = time.perf_counter() - start
+    pings = DB.poolStats()["pings"]
+    DB.reset()
+    return elapsed / queries * 1e6, pings
+
+
+def config_cost(iterations=1000):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        DBConfig.fromEnv()
+    parsed = (time.perf_counter() - start) / iterations * 1e6
+    DB.getConfig()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        DB.getConfig()
+    cached = (time.perf_counter() - start) / iterations * 1e6
+    return parsed, cached
+
+
+# label -> DB_DRIVER/DB_COMPRESS/DB_BUFFERED
+DRIVER_OPTIONS = [
+    ("connector (C extension)", {"DB_DRIVER": "connector"}),
+    ("connector (C extension) compressed", {"DB_DRIVER": "connector", "DB_COMPRESS": "1"}),
+    ("connector pure python", {"DB_DRIVER": "connector-pure"}),
+    ("connector pure python buffered", {"DB_DRIVER": "connector-pure", "DB_BUFFERED": "1"}),
+    ("connector pure python compressed", {"DB_DRIVER": "connector-pure", "DB_COMPRESS": "1"}),
+    ("pymysql", {"DB_DRIVER": "pymysql"}),
+    ("mysqlclient", {"DB_DRIVER": "mysqlclient"}),
+    ("mysqlclient compressed", {"DB_DRIVER": "mysqlclient", "DB_COMPRESS": "1"}),
+]
+STOCKS_LIST = ("SELECT id, symbol, open, high, low, price, volume, latest_trading_day, previous_close, "
+               "`change`, change_percent FROM IS601_Stocks LIMIT 100")
+
+
+def workload(iterations):
+    # the stocks list page and loading every broker (row + stock associations), ms per iteration
+    from brokers.brokers import STOCK_ASSOCIATIONS_QUERY
+    broker_ids = [row["id"] for row in DB.selectAllShards("SELECT id FROM IS601_Brokers LIMIT 20", limit=20).rows]
+    timings = {"stocks list": 0.0, "broker load": 0.0}
+    for _ in range(iterations):
+        start = time.perf_counter()
+        DB.selectAll(STOCKS_LIST)
+        timings["stocks list"] += time.perf_counter() - start
+        start = time.perf_counter()
+        for broker_id in broker_ids:
+            with DB.shard(broker_id):
+                DB.selectOne("SELECT * FROM IS601_Brokers WHERE id = %s", broker_id)
+                DB.selectAll(STOCK_ASSOCIATIONS_QUERY, broker_id)
+        timings["broker load"] += time.perf_counter() - start
+    return {k: v / iterations * 1000 for k, v in timings.items()}
+
+
+def compare_drivers(iterations):
+    if os.environ["DB_URL"].startswith("sqlite:"):
+        print("the driver comparison needs a mysql:// DB_URL")
+        return
+    names = ["DB_DRIVER", "DB_COMPRESS", "DB_BUFFERED"]
+    saved = {name: os.environ.get(name) for name in names}
+    print(f"{'options':36} {'stocks list':>12} {'broker load':>12}  (ms per iteration, {iterations} iterations)")
+    try:
+        for label, options in DRIVER_OPTIONS:
+            for name in names:
+                os.environ.pop(name, None)
+            os.environ.update(options)
+            DB.reset()
+            try:
+                workload(1)  # connect and prepare outside of the timing
+            except Exception as e:
+                print(f"{label:36} skipped: {e}")
+                continue
+            timings = workload(iterations)
+            print(f"{label:36} {timings['stocks list']:12.2f} {timings['broker load']:12.2f}")
+    finally:
+        DB.reset()
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    if len(sys.argv) > 1 and sys.argv[1] == "drivers":
+        os.environ.setdefault("DB_URL", "sqlite://")
+        compare_drivers(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+        sys.exit(0)
+    os.environ.setdefault("DB_URL", "sqlite://")
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f"{queries} x {QUERY} on {os.environ['DB_URL'].split('@')[-1]}")
+    always, always_pings = run(queries, 0)
+    idle, idle_pings = run(queries, 30)
+    print(f"ping on every checkout: {always:8.1f} us/query ({always_pings} pings)")
+    print(f"ping after 30s idle:    {idle:8.1f} us/query ({idle_pings} pings)")
+    print(f"saved:                  {always - idle:8.1f} us/query")
+    parsed, cached = config_cost()
+    print(f"config from env: {parsed:8.1f} us, cached: {cached:8.3f} us")
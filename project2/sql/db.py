@@ -1,7 +1,34 @@
 from enum import Enum
-import mysql.connector
-from mysql.connector import Error
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
+try:
+    from sql.sqlite_db import SQLiteConnection, SQLiteError
+    from sql import drivers
+except ImportError:  # scripts run from inside sql/ (e.g., init_db.py)
+    from sqlite_db import SQLiteConnection, SQLiteError
+    import drivers
+try:
+    import mysql.connector
+    from mysql.connector import Error
+except ImportError:  # the driver is only needed for mysql:// urls
+    mysql = None
+    Error = SQLiteError
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import itertools
 import json
+import os
+import random
+import re
+import threading
+import time
+import traceback
+import weakref
 
 class CRUD(Enum):
     CREATE = 1,
@@ -12,7 +39,7 @@ class CRUD(Enum):
 
 
 class DBResponse:
-    def __init__(self, status, row=None, rows=None, insert_id=None):
+    def __init__(self, status, row=None, rows=None, insert_id=None, rows_affected=None, columns=None):
         self.status = status
         if row is not None:
             self.row = row
@@ -23,80 +50,1376 @@ class DBResponse:
         else:
             self.rows = []
         self.insert_id = insert_id
+        self.rows_affected = rows_affected
+        # column names of a select, in the order of the values in tuple rows
+        self.columns = columns
 
     def __str__(self):
         return json.dumps(self.__dict__)
 
 
+class RowFormat:
+    """Shapes for select results, reads fetch plain tuples and convert them once per response
+
+    dict (default) - one dict per row, what every caller used to get
+    tuple - the cursor's tuples as is, the cheapest
+    namedtuple - tuples with attribute access by column name
+    columns - a single dict of column -> list of values (selectOne gets column -> value)
+    a class registered with DB.registerMapper - one instance per row built straight from the tuple
+    """
+    DICT = "dict"
+    TUPLE = "tuple"
+    NAMEDTUPLE = "namedtuple"
+    COLUMNS = "columns"
+    # class -> factory(columns) returning a row -> object function
+    _mappers = {}
+
+    @staticmethod
+    def register(cls, factory=None):
+        RowFormat._mappers[cls] = factory or functools.partial(RowFormat.constructorMapper, cls)
+        RowFormat.converter.cache_clear()
+
+    @staticmethod
+    def constructorMapper(cls, columns):
+        # positional call of cls(...) with each parameter taken from the column of the same name,
+        # parameters without a column get their default, columns without a parameter are ignored
+        index = {c: i for i, c in enumerate(columns)}
+        picks = []
+        defaults = []
+        for p in inspect.signature(cls).parameters.values():
+            if p.kind not in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD):
+                continue
+            if p.name in index:
+                picks.append(index[p.name])
+            elif p.default is not p.empty:
+                picks.append(len(columns) + len(defaults))
+                defaults.append(p.default)
+            else:
+                raise Exception(f"{cls.__name__} needs a {p.name} column, got {columns}")
+        if not picks:
+            return lambda row: cls()
+        get = itemgetter(*picks)
+        tail = tuple(defaults)
+        if len(picks) == 1:
+            return (lambda row: cls(get(row + tail))) if tail else (lambda row: cls(get(row)))
+        return (lambda row: cls(*get(row + tail))) if tail else (lambda row: cls(*get(row)))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def converter(row_format, columns):
+        # row -> formatted row, built once per (format, columns) instead of per row
+        if row_format == RowFormat.DICT or row_format == RowFormat.COLUMNS:
+            return lambda row: dict(zip(columns, row))
+        if row_format == RowFormat.TUPLE:
+            return None
+        if row_format == RowFormat.NAMEDTUPLE:
+            return namedtuple("Row", columns, rename=True)._make
+        factory = RowFormat._mappers.get(row_format)
+        if factory is None:
+            raise Exception(f"Unknown row format {row_format}, use DB.registerMapper() for classes")
+        return factory(columns)
+
+    @staticmethod
+    def rows(rows, columns, row_format):
+        if row_format == RowFormat.COLUMNS:
+            if not rows:
+                return {c: [] for c in columns}
+            return {c: list(values) for c, values in zip(columns, zip(*rows))}
+        convert = RowFormat.converter(row_format, tuple(columns))
+        if convert is None:
+            return rows if type(rows) is list else list(rows)
+        return [convert(r) for r in rows]
+
+    @staticmethod
+    def row(row, columns, row_format):
+        if row is None:
+            return None
+        convert = RowFormat.converter(row_format, tuple(columns))
+        return row if convert is None else convert(row)
+
+    @staticmethod
+    def apply(response, isMany, row_format):
+        # formats a response holding the cursor's tuples, in place
+        columns = response.columns or ()
+        if isMany:
+            response.rows = RowFormat.rows(response.rows, columns, row_format)
+        else:
+            response.row = RowFormat.row(response.row, columns, row_format)
+        return response
+
+
+class DBUnavailableError(Exception):
+    """Raised without touching the network while the circuit breaker considers the database down"""
+
+
+class DBTimeoutError(Exception):
+    """A select ran past its timeout or deadline, callers can catch this to degrade the page"""
+
+
+class DBBudgetExceededError(DBUnavailableError):
+    """The query quota (DB_QUERY_QUOTA) is used up and DB_QUERY_QUOTA_MODE=shed"""
+
+
+class CircuitBreaker:
+    """Fails fast while the database can't be reached instead of every request waiting on a connect timeout
+
+    closed - normal, threshold connection failures in a row open it
+    open - DBUnavailableError right away until reset_timeout seconds have passed
+    half_open - one caller probes the database, success closes the breaker and failure opens it again
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=5, reset_timeout=10):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = 0
+        self._probe_at = None
+        self._lock = threading.Lock()
+
+    def before(self):
+        # called before checking out a connection
+        if self.state == CircuitBreaker.CLOSED:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CircuitBreaker.OPEN:
+                remaining = self.reset_timeout - (now - self._opened_at)
+                if remaining > 0:
+                    raise DBUnavailableError(f"Database unavailable, next attempt in {remaining:.1f}s")
+                self.state = CircuitBreaker.HALF_OPEN
+            elif self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+                # someone else is probing (a probe that never reported back is replaced after reset_timeout)
+                raise DBUnavailableError("Database unavailable, waiting on a reconnect attempt")
+            self._probe_at = now
+
+    def success(self):
+        if self.state == CircuitBreaker.CLOSED and self.failures == 0:
+            return
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                print("db.py circuit breaker closed, database is reachable again")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self._probe_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    self.trips += 1
+                    print(f"db.py circuit breaker open for {self.reset_timeout}s after {self.failures} failures")
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_at = None
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+class ConnectionPool:
+    """Thread-safe pool of connections handed out by DB.connection()"""
+
+    def __init__(self, connect, size=5, timeout=10, idle_timeout=300, ping_interval=30, breaker=None):
+        self._connect = connect  # factory that opens a new connection
+        self.breaker = breaker  # optional CircuitBreaker, see ok()/failed()
+        self.size = size
+        self.timeout = timeout  # seconds to wait for a free connection
+        self.idle_timeout = idle_timeout  # seconds before an unused connection is closed
+        # connections idle for less than this are handed out without a liveness check (a round trip
+        # on MySQL), a dead one still fails its statement and is discarded by DB.connection()
+        self.ping_interval = ping_interval
+        self._idle = []  # (connection, last_used, suspect) most recently used last
+        self._in_use = 0
+        self._waiting = 0
+        self._total_connects = 0
+        self._pings = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        if self.breaker is not None:
+            self.breaker.before()
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._check_fork()
+            stale = self._evict_idle()
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(f"Timed out waiting for a DB connection (pool size {self.size})")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            # reserve the slot before doing any network work outside the lock
+            self._in_use += 1
+            conn, last_used, suspect = self._idle.pop() if self._idle else (None, None, False)
+        ConnectionPool._close_all(stale)
+        try:
+            if conn is not None and (suspect or time.monotonic() - last_used >= self.ping_interval):
+                with self._cond:
+                    self._pings += 1
+                if not conn.is_connected():
+                    ConnectionPool._close_all([conn])
+                    conn = None
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self.failed()
+                    raise
+                with self._cond:
+                    self._total_connects += 1
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False, suspect=False):
+        # suspect: the last statement failed, the connection is checked before it's handed out again
+        with self._cond:
+            self._in_use = max(0, self._in_use - 1)
+            if not discard and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic(), suspect))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            ConnectionPool._close_all([conn])
+
+    def warm(self, count=None):
+        # opens connections up front so the first requests of a worker don't pay for the connect
+        count = self.size if count is None else min(count, self.size)
+        opened = []
+        with self._cond:
+            self._check_fork()
+            needed = count - len(self._idle) - self._in_use
+            needed = max(0, min(needed, self.size - len(self._idle) - self._in_use))
+            self._in_use += needed
+        try:
+            for _ in range(needed):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self._in_use -= needed
+                self._total_connects += len(opened)
+                now = time.monotonic()
+                self._idle.extend((conn, now, False) for conn in opened)
+                self._cond.notify_all()
+        return len(opened)
+
+    def close(self):
+        # closes idle connections; checked out ones are closed when they come back if over size
+        with self._cond:
+            idle = [conn for conn, _, _ in self._idle]
+            self._idle = []
+        ConnectionPool._close_all(idle)
+
+    def ok(self):
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def failed(self):
+        # the database couldn't be reached (connect error or lost connection)
+        if self.breaker is not None:
+            self.breaker.failure()
+
+    def load(self):
+        # checked out connections plus callers waiting for one
+        return self._in_use + self._waiting
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "total_connects": self._total_connects,
+                "pings": self._pings,
+                "breaker": self.breaker.stats() if self.breaker is not None else None,
+            }
+
+    def _evict_idle(self):
+        # called with the lock held, returns the connections to close outside of it
+        if not self.idle_timeout:
+            return []
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = [entry[0] for entry in self._idle if entry[1] < cutoff]
+        if stale:
+            self._idle = [entry for entry in self._idle if entry[1] >= cutoff]
+        return stale
+
+    def _check_fork(self):
+        # connections opened before a fork (e.g., gunicorn --preload) share the parent's socket
+        # so the child drops them without closing (closing would end the parent's session)
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._in_use = 0
+            self._waiting = 0
+
+    @staticmethod
+    def _close_all(conns):
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class StatementCache:
+    """Per-connection LRU of prepared cursors keyed by SQL text
+
+    mysql.connector only skips the prepare round-trip when a prepared cursor is executed
+    again with the very same statement, so each cached cursor keeps its statement object.
+    """
+    NAMED_PARAM = re.compile(r"%\((\w+)\)s")
+    # hit/miss counters are shared by every connection's cache
+    _lock = threading.Lock()
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, db, size=32):
+        # weak so DB._statements (keyed weakly by connection) can let go of closed connections
+        self._db = weakref.proxy(db)
+        self.size = size
+        self._entries = OrderedDict()  # sql text -> (cursor, positional sql, named param keys)
+
+    def get(self, queryString):
+        entry = self._entries.get(queryString)
+        if entry is not None:
+            self._entries.move_to_end(queryString)
+            StatementCache._count(hits=1)
+            return entry
+        StatementCache._count(misses=1)
+        # named params are converted here once instead of by the driver on every call
+        # (the driver's conversion builds a new string which forces a re-prepare)
+        keys = StatementCache.NAMED_PARAM.findall(queryString)
+        sql = StatementCache.NAMED_PARAM.sub("%s", queryString) if keys else queryString
+        entry = (self._db.cursor(prepared=True), sql, keys)
+        if self.size > 0:
+            self._entries[queryString] = entry
+            while len(self._entries) > self.size:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                StatementCache._count(evictions=1)
+                StatementCache._close(evicted)
+        return entry
+
+    def owns(self, cursor):
+        return any(cursor is entry[0] for entry in self._entries.values())
+
+    def clear(self):
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for cursor, _, _ in entries:
+            StatementCache._close(cursor)
+
+    @staticmethod
+    def positional(args, keys):
+        # maps a dict of named params onto the order of the %(name)s placeholders
+        if keys and isinstance(args, dict):
+            return tuple(args[k] for k in keys)
+        return args
+
+    @staticmethod
+    def stats():
+        with StatementCache._lock:
+            lookups = StatementCache.hits + StatementCache.misses
+            return {
+                "hits": StatementCache.hits,
+                "misses": StatementCache.misses,
+                "evictions": StatementCache.evictions,
+                "hit_rate": round(StatementCache.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    @staticmethod
+    def _count(hits=0, misses=0, evictions=0):
+        with StatementCache._lock:
+            StatementCache.hits += hits
+            StatementCache.misses += misses
+            StatementCache.evictions += evictions
+
+    @staticmethod
+    def _close(cursor):
+        try:
+            cursor.close()  # deallocates the statement on the server
+        except Exception:
+            pass
+
+
+class QueryStats:
+    """Latency/row aggregates per statement fingerprint plus the slow-query log"""
+    STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+    NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+    PARAM = re.compile(r"%\(\w+\)s|%s")
+    LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+    VALUES = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+")
+    COMMENT = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+    SPACE = re.compile(r"\s+")
+
+    def __init__(self, slow_ms=500, slow_log=None, samples=1024):
+        self.slow_ms = slow_ms  # statements slower than this go to the slow-query log
+        self.slow_log = slow_log  # file to append slow queries to, printed when not set
+        self.samples = samples  # latest latencies kept per fingerprint for the percentiles
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._fingerprints = {}  # sql text -> fingerprint so the regexes run once per statement
+
+    @staticmethod
+    def fingerprint(queryString):
+        # normalizes literals/placeholders so "IN (%s,%s)" and "IN (%s)" count as the same statement
+        fp = QueryStats.STRING.sub("?", queryString)
+        fp = QueryStats.COMMENT.sub(" ", fp)
+        fp = QueryStats.PARAM.sub("?", fp)
+        fp = QueryStats.NUMBER.sub("?", fp)
+        fp = QueryStats.LIST.sub("(...)", fp)
+        fp = QueryStats.VALUES.sub(r"\1", fp)
+        return QueryStats.SPACE.sub(" ", fp).strip()
+
+    def record(self, queryString, seconds, rows_returned=0, rows_affected=0, error=False, args=None):
+        fp = self._fingerprints.get(queryString)
+        if fp is None:
+            fp = QueryStats.fingerprint(queryString)
+            if len(self._fingerprints) < 10000:  # dynamic sql shouldn't grow this forever
+                self._fingerprints[queryString] = fp
+        with self._lock:
+            stat = self._stats.get(fp)
+            if stat is None:
+                stat = self._stats[fp] = {
+                    "count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                    "rows_returned": 0, "rows_affected": 0,
+                    "latencies": deque(maxlen=self.samples),
+                }
+            stat["count"] += 1
+            stat["errors"] += 1 if error else 0
+            stat["total"] += seconds
+            stat["max"] = max(stat["max"], seconds)
+            stat["rows_returned"] += rows_returned or 0
+            stat["rows_affected"] += max(rows_affected or 0, 0)
+            stat["latencies"].append(seconds)
+        ms = seconds * 1000
+        if self.slow_ms is not None and ms >= self.slow_ms:
+            self._log_slow(fp, queryString, ms, args)
+        return fp
+
+    def snapshot(self, limit=None):
+        # hottest statements (by total time) first, times in ms
+        with self._lock:
+            items = [(fp, dict(stat, latencies=sorted(stat["latencies"]))) for fp, stat in self._stats.items()]
+        report = []
+        for fp, stat in items:
+            latencies = stat.pop("latencies")
+            report.append({
+                "statement": fp,
+                **stat,
+                "total": round(stat["total"] * 1000, 3),
+                "max": round(stat["max"] * 1000, 3),
+                "avg": round(stat["total"] * 1000 / stat["count"], 3),
+                "p50": QueryStats._percentile(latencies, 50),
+                "p95": QueryStats._percentile(latencies, 95),
+                "p99": QueryStats._percentile(latencies, 99),
+            })
+        report.sort(key=lambda r: r["total"], reverse=True)
+        return report[:limit] if limit else report
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    @staticmethod
+    def _percentile(latencies, pct):
+        if not latencies:
+            return 0.0
+        # nearest-rank percentile
+        index = max(0, -(-len(latencies) * pct // 100) - 1)
+        return round(latencies[int(index)] * 1000, 3)
+
+    def _log_slow(self, fp, queryString, ms, args):
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S')} {ms:.1f}ms {fp}"
+        if DB.debug:
+            line += f" args={args}"
+        if self.slow_log:
+            try:
+                with open(self.slow_log, "a") as f:
+                    f.write(line + "\n")
+                return
+            except Exception as e:
+                print("Unable to write slow query log", e)
+        print(f"db.py slow query {line}")
+
+
+class ResultCache:
+    """Opt-in read-through cache for select results with TTL, LRU eviction and table-based invalidation
+
+    Writes invalidate every cached result that reads from a table they touch. This only covers
+    writes made by this process (other workers rely on the TTL) so keep it for rarely changing data.
+    """
+    TABLE = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+`?(\w+)`?", re.I)
+
+    def __init__(self, size=256, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, tables, row, rows, columns)
+        self._generations = {}  # table -> write counter, guards against caching results older than a write
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def tables(queryString):
+        return frozenset(t.lower() for t in ResultCache.TABLE.findall(queryString))
+
+    @staticmethod
+    def key(isMany, queryString, args):
+        # the same select returns different rows on each shard
+        return (isMany, queryString, repr(args), DB._shard.get())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        _, _, row, rows, columns = entry
+        # callers mutate rows (e.g., del row["password"]) so each hit gets its own copies
+        return DBResponse(status=True, row=ResultCache._copy(row),
+                          rows=[ResultCache._copy(r) for r in rows], columns=columns)
+
+    @staticmethod
+    def _copy(row):
+        # selects cache the cursor's tuples, those can be shared as is
+        return dict(row) if isinstance(row, dict) else row
+
+    def generation(self, tables):
+        with self._lock:
+            return tuple(self._generations.get(t, 0) for t in sorted(tables))
+
+    def put(self, key, tables, generation, response, ttl=None):
+        if self.size <= 0 or not response.status:
+            return
+        row = ResultCache._copy(response.row)
+        rows = [ResultCache._copy(r) for r in response.rows]
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            # a write to one of the tables landed while this was reading, the result may be stale
+            if generation != tuple(self._generations.get(t, 0) for t in sorted(tables)):
+                return
+            self._entries[key] = (expires, tables, row, rows, response.columns)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        with self._lock:
+            for t in tables:
+                self._generations[t] = self._generations.get(t, 0) + 1
+            stale = [k for k, entry in self._entries.items() if entry[1] & tables]
+            for k in stale:
+                del self._entries[k]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class QueryBudget:
+    """Counts queries sent to the database per endpoint over a rolling window against a quota
+
+    Queries are labeled with the flask endpoint (e.g., brokers.view) or a DB.budgetLabel() block,
+    counted in one-minute buckets so the window slides, and per request (how many a page needs).
+    mode "warn" prints when usage passes warn_at of the quota, "shed" also refuses queries with
+    DBBudgetExceededError once the quota is used up until old buckets age out of the window.
+    """
+    BUCKET = 60  # seconds
+
+    def __init__(self, quota=10000, window=3600, warn_at=0.8, mode="warn"):
+        self.quota = quota
+        self.window = window
+        self.warn_at = warn_at
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._buckets = deque()  # [bucket start, label -> queries, label -> requests, label -> max per request]
+        self._used = 0
+        self._queries = {}  # label -> queries in the window
+        self._requests = {}  # label -> requests in the window
+        self._warned = False
+        self.shed = 0
+
+    def charge(self, label, request_count=None):
+        # request_count: this request's queries so far including this one (None outside of a request)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if self.quota and self.mode == "shed" and self._used >= self.quota:
+                self.shed += 1
+                raise DBBudgetExceededError(f"Query quota of {self.quota} per {self.window}s used up")
+            start = now - now % QueryBudget.BUCKET
+            if not self._buckets or self._buckets[-1][0] != start:
+                self._buckets.append([start, {}, {}, {}])
+            _, queries, requests, maxes = self._buckets[-1]
+            queries[label] = queries.get(label, 0) + 1
+            self._queries[label] = self._queries.get(label, 0) + 1
+            self._used += 1
+            if request_count == 1:
+                requests[label] = requests.get(label, 0) + 1
+                self._requests[label] = self._requests.get(label, 0) + 1
+            if request_count is not None and request_count > maxes.get(label, 0):
+                maxes[label] = request_count
+            warn = self.quota and not self._warned and self._used >= self.quota * self.warn_at
+            if warn:
+                self._warned = True
+            used = self._used
+        if warn:
+            print(f"db.py query budget: {used} of {self.quota} queries used in the last {self.window}s")
+
+    def _expire(self, now):
+        # called with the lock held
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            _, queries, requests, _ = self._buckets.popleft()
+            for label, count in queries.items():
+                self._queries[label] -= count
+                self._used -= count
+            for label, count in requests.items():
+                self._requests[label] -= count
+        if self._warned and self._used < self.quota * self.warn_at:
+            self._warned = False
+
+    def report(self, limit=None):
+        # endpoints using the most quota first
+        with self._lock:
+            self._expire(time.time())
+            maxes = {}
+            for _, _, _, bucket_maxes in self._buckets:
+                for label, count in bucket_maxes.items():
+                    maxes[label] = max(maxes.get(label, 0), count)
+            endpoints = [{
+                "endpoint": label,
+                "queries": count,
+                "share": round(count / self._used, 4) if self._used else 0.0,
+                "requests": self._requests.get(label, 0),
+                "per_request_avg": round(count / self._requests[label], 2) if self._requests.get(label) else None,
+                "per_request_max": maxes.get(label),
+            } for label, count in self._queries.items() if count > 0]
+            used = self._used
+        endpoints.sort(key=lambda e: e["queries"], reverse=True)
+        return {
+            "quota": self.quota,
+            "window": self.window,
+            "mode": self.mode,
+            "used": used,
+            "remaining": max(self.quota - used, 0) if self.quota else None,
+            "shed": self.shed,
+            "endpoints": endpoints[:limit] if limit else endpoints,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+            self._used = 0
+            self._queries = {}
+            self._requests = {}
+            self._warned = False
+            self.shed = 0
+
+
+class IdentityMap:
+    """Rows loaded by primary key during the current flask request, kept in flask.g
+
+    selectOne("SELECT <columns or *> FROM <table> WHERE id = %s", id) keeps the columns it read and
+    later reads of the same row asking for some of those are projected from them, other columns are
+    read (and added) as asked for. Tables with columns that shouldn't sit in flask.g for the request
+    (DB_IDENTITY_MAP_EXCLUDE, IS601_Users and its password hash by default) aren't kept.
+    Writes drop the rows of the tables they touch, a rolled back transaction drops everything.
+    """
+    PK_READ = re.compile(r"^\s*SELECT\s+(\*|`?\w+`?(?:\s*,\s*`?\w+`?)*)\s+FROM\s+`?(\w+)`?"
+                         r"\s+WHERE\s+`?id`?\s*=\s*%s\s*;?\s*$", re.I)
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse(queryString):
+        # (table, columns) for a primary key read (columns is None for *), otherwise None
+        match = IdentityMap.PK_READ.match(queryString)
+        if match is None:
+            return None
+        columns, table = match.groups()
+        if columns.strip() == "*":
+            return table, None
+        return table, tuple(c.strip().strip("`") for c in columns.split(","))
+
+    @staticmethod
+    def current():
+        request_g = DB._requestG()
+        return request_g.setdefault("_db_identity", {}) if request_g is not None else None
+
+    @staticmethod
+    def load(identity, parsed, pk, fetch):
+        # fetch(sql) runs a select for the pk with tuple rows, returns a DBResponse with tuple rows
+        # None when the table isn't kept, the caller runs its query as is
+        table, columns = parsed
+        if table.lower() in DB.getConfig().identity_exclude:
+            return None
+        key = (table.lower(), str(pk))
+        entry = identity.get(key)
+        loaded = None
+        if entry is not None:
+            # loaded earlier in the request, or being loaded right now by a concurrent aselectOne
+            try:
+                loaded = entry.result()
+            except BaseException:
+                loaded = None
+            response = IdentityMap._project(loaded, columns) if loaded is not None else None
+            if response is not None:
+                IdentityMap._count(hits=1)
+                return response
+        future = Future()
+        identity[key] = future
+        try:
+            select = "*" if columns is None else ", ".join(f"`{c}`" for c in columns)
+            response = fetch(f"SELECT {select} FROM {table} WHERE id = %s")
+        except BaseException as e:
+            if identity.get(key) is future:
+                del identity[key]
+            future.set_exception(e)
+            raise
+        read_columns, row = tuple(response.columns), response.row
+        if loaded is not None and loaded[1] is not None and row is not None:
+            # keep what was read before too
+            have = {c.lower() for c in read_columns}
+            extra = [i for i, c in enumerate(loaded[0]) if c.lower() not in have]
+            read_columns += tuple(loaded[0][i] for i in extra)
+            row = tuple(row) + tuple(loaded[1][i] for i in extra)
+        future.set_result((read_columns, row, columns is None or (loaded is not None and loaded[2])))
+        IdentityMap._count(misses=1)
+        return DBResponse(status=True, row=response.row, columns=response.columns)
+
+    @staticmethod
+    def _project(loaded, columns):
+        # the columns asked for (None for all) out of a loaded (columns, row, all columns) entry,
+        # None when it doesn't have them
+        all_columns, row, complete = loaded
+        if columns is None:
+            return DBResponse(status=True, row=row, columns=all_columns) if complete else None
+        index = {c.lower(): i for i, c in enumerate(all_columns)}
+        if any(c.lower() not in index for c in columns):
+            return None
+        projected = tuple(row[index[c.lower()]] for c in columns) if row is not None else None
+        return DBResponse(status=True, row=projected, columns=columns)
+
+    @staticmethod
+    def invalidate(tables):
+        identity = IdentityMap.current()
+        if identity:
+            for key in [k for k in identity if k[0] in tables]:
+                identity.pop(key, None)
+
+    @staticmethod
+    def clear():
+        identity = IdentityMap.current()
+        if identity:
+            identity.clear()
+
+    @staticmethod
+    def _count(hits=0, misses=0):
+        with IdentityMap._lock:
+            IdentityMap.hits += hits
+            IdentityMap.misses += misses
+
+    @staticmethod
+    def stats():
+        with IdentityMap._lock:
+            lookups = IdentityMap.hits + IdentityMap.misses
+            return {
+                "hits": IdentityMap.hits,
+                "misses": IdentityMap.misses,
+                "hit_rate": round(IdentityMap.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class NPlusOneError(Exception):
+    """The same statement shape ran more than DB_NPLUSONE_THRESHOLD times in one request (strict mode)"""
+
+
+class NPlusOneDetector:
+    """Flags statements run over and over within one request, the usual sign of a query in a loop
+
+    Statements are counted per request (or DB.nPlusOneScope() block) by QueryStats fingerprint,
+    so "WHERE id = 1" and "WHERE id = 2" are the same shape. The first time a shape goes over
+    threshold the request path and the stack that issued it are printed and kept for the report.
+    strict raises NPlusOneError instead so a test fails, shapes in allow are only reported.
+    """
+    # frames from these files are the plumbing, not where the loop is
+    SKIP = (os.sep + "sql" + os.sep + "db.py", os.sep + "sqlite_db.py", os.sep + "drivers.py",
+            "site-packages", os.sep + "threading.py", os.sep + "concurrent" + os.sep,
+            os.sep + "asyncio" + os.sep, os.sep + "contextlib.py")
+
+    def __init__(self, threshold=0, strict=False, allow=None, size=100, stack_depth=8):
+        self.threshold = threshold  # 0 turns detection off
+        self.strict = strict
+        self.allow = set(allow or ())  # known fingerprints, reported but never raised
+        self.size = size  # incidents kept for the report
+        self.stack_depth = stack_depth
+        self._lock = threading.Lock()
+        self._incidents = OrderedDict()  # (fingerprint, endpoint) -> incident
+
+    def check(self, fp, counts, threshold, strict, path=None, endpoint=None):
+        # counts: fingerprint -> statements so far in this request/scope
+        count = counts[fp] = counts.get(fp, 0) + 1
+        if count <= threshold:
+            return
+        key = (fp, endpoint)
+        with self._lock:
+            incident = self._incidents.get(key)
+            if incident is None:
+                incident = self._incidents[key] = {
+                    "statement": fp, "endpoint": endpoint, "path": path,
+                    "threshold": threshold, "requests": 0, "max_count": 0,
+                    "stack": self.stack(),
+                }
+                if len(self._incidents) > self.size:
+                    self._incidents.popitem(last=False)
+            else:
+                self._incidents.move_to_end(key)
+            if count == threshold + 1:
+                incident["requests"] += 1
+                incident["path"] = path
+            incident["max_count"] = max(incident["max_count"], count)
+        if count == threshold + 1:
+            where = path or "outside of a request"
+            print(f"db.py N+1: {fp} ran more than {threshold} times in {where}\n{incident['stack']}")
+            if strict and fp not in self.allow:
+                raise NPlusOneError(f"{fp} ran more than {threshold} times in {where}\n{incident['stack']}")
+
+    def stack(self):
+        frames = [f for f in traceback.extract_stack()[:-1]
+                  if not any(part in f.filename for part in NPlusOneDetector.SKIP)]
+        return "".join(traceback.format_list(frames[-self.stack_depth:]))
+
+    def report(self):
+        # most recently seen first
+        with self._lock:
+            incidents = [dict(incident) for incident in reversed(self._incidents.values())]
+        return {"threshold": self.threshold, "strict": self.strict, "incidents": incidents}
+
+    def reset(self):
+        with self._lock:
+            self._incidents.clear()
+
+
+class Transaction:
+    """State of an open DB.transaction(): the pinned connection and the tables it wrote to"""
+
+    def __init__(self, db):
+        self.db = db
+        self.tables = set()
+        self.replicate = []  # writes to copy to the other shards once committed, see DB._replicate()
+
+
+class Batch:
+    """Selects queued with selectOne()/selectAll() and sent in one round trip by run(), see DB.batch()"""
+
+    def __init__(self):
+        self.statements = []  # (isMany, queryString, args, cache, row_format)
+
+    def selectAll(self, queryString, *args, cache=False, row_format=RowFormat.DICT):
+        self.statements.append((True, queryString, args, cache, row_format))
+        return self
+
+    def selectOne(self, queryString, *args, cache=False, row_format=RowFormat.DICT):
+        self.statements.append((False, queryString, args, cache, row_format))
+        return self
+
+    def run(self, timeout=None):
+        # one DBResponse per queued statement, in the order they were added
+        # timeout (seconds) applies to the batch as a whole, see DB.selectAll()
+        return DB._runBatch(self.statements, timeout)
+
+
+class DBConfig:
+    """Connection settings read from the environment once instead of on every connect"""
+
+    def __init__(self, url, connect_args=None, pool_size=5, pool_timeout=10, idle_timeout=300,
+                 ping_interval=30, replica_urls=None, replica_strategy="round_robin", read_retries=2,
+                 retry_backoff=0.05, retry_backoff_max=1.0, breaker_threshold=5, breaker_reset=10,
+                 connect_timeout=5, driver="connector", compress=False, buffered=False, collation="utf8mb4_0900_ai_ci",
+                 statement_cache_size=32, identity_exclude=("IS601_Users",), shard_urls=None,
+                 shard_tables=("IS601_Brokers", "IS601_BrokerStocks"),
+                 shard_replicated=("IS601_Stocks(symbol,latest_trading_day)",)):
+        self.url = url
+        self.sqlite = bool(url) and url.startswith("sqlite:")
+        # keyword arguments for mysql.connector.connect()
+        self.connect_args = connect_args
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        # selects go to these (when set) unless the request already wrote, see DB.readPool()
+        self.replica_urls = replica_urls or []
+        self.replica_strategy = replica_strategy  # round_robin or least_loaded
+        # reads (outside transactions) that hit a connection failure are retried after a jittered backoff
+        self.read_retries = read_retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        # connection failures in a row before DB calls fail fast with DBUnavailableError, and for how long
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.connect_timeout = connect_timeout
+        # MySQL driver and its options, see sql/drivers.py
+        self.driver = driver
+        self.compress = compress
+        self.buffered = buffered
+        # the tables' collation (the database default), for strings compared with columns, see DB.inClause()
+        if not re.match(r"^\w+$", collation):
+            raise Exception(f"Invalid collation {collation}")
+        self.collation = collation
+        # prepared statements kept open per connection, 0 closes each after use (see StatementCache)
+        self.statement_cache_size = statement_cache_size
+        # tables the request's identity map doesn't keep rows of (sensitive columns), see IdentityMap
+        self.identity_exclude = frozenset(t.lower() for t in identity_exclude)
+        # broker data spread over these by broker id (see DB.shard()), other tables stay on url
+        self.shard_urls = shard_urls or []
+        self.shard_tables = frozenset(t.lower() for t in shard_tables)
+        # reference data written to url and every shard so the shards can join against it, as
+        # "Table(column,...)" with the table's natural key, each database numbers the rows on its own
+        # so updates/deletes are repeated on the other databases by that key (see DB._replicatedWrites())
+        self.replicated_keys = {}
+        for entry in shard_replicated:
+            table, _, keys = entry.partition("(")
+            self.replicated_keys[table.strip().lower()] = tuple(k.strip() for k in keys.rstrip(")").split(",")
+                                                                 if k.strip())
+        self.shard_replicated = frozenset(self.replicated_keys)
+
+    def connectArgs(self, url):
+        if url.startswith("sqlite:"):
+            return None
+        return dict(DBConfig.parseUrl(url), connection_timeout=int(self.connect_timeout))
+
+    def breaker(self):
+        return CircuitBreaker(self.breaker_threshold, self.breaker_reset) if self.breaker_threshold > 0 else None
+
+    def backoff(self, attempt):
+        # "full jitter" so requests that failed together don't all retry at the same moment
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+
+    @staticmethod
+    def fromEnv():
+        from dotenv import load_dotenv
+        load_dotenv()
+        db_url = os.environ.get("DB_URL")
+        connect_timeout = float(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+        return DBConfig(
+            db_url,
+            connect_args=dict(DBConfig.parseUrl(db_url), connection_timeout=int(connect_timeout))
+            if db_url and not db_url.startswith("sqlite:") else None,
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+            pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+            idle_timeout=float(os.environ.get("DB_POOL_IDLE_TIMEOUT", 300)),
+            ping_interval=float(os.environ.get("DB_PING_INTERVAL", 30)),
+            replica_urls=[u.strip() for u in os.environ.get("DB_REPLICA_URLS", "").split(",") if u.strip()],
+            replica_strategy=os.environ.get("DB_REPLICA_STRATEGY", "round_robin"),
+            read_retries=int(os.environ.get("DB_READ_RETRIES", 2)),
+            retry_backoff=float(os.environ.get("DB_RETRY_BACKOFF", 0.05)),
+            retry_backoff_max=float(os.environ.get("DB_RETRY_BACKOFF_MAX", 1.0)),
+            breaker_threshold=int(os.environ.get("DB_BREAKER_THRESHOLD", 5)),
+            breaker_reset=float(os.environ.get("DB_BREAKER_RESET", 10)),
+            connect_timeout=connect_timeout,
+            driver=os.environ.get("DB_DRIVER", "connector"),
+            compress=os.environ.get("DB_COMPRESS", "0").lower() in ("1", "true", "yes"),
+            buffered=os.environ.get("DB_BUFFERED", "0").lower() in ("1", "true", "yes"),
+            collation=os.environ.get("DB_COLLATION", "utf8mb4_0900_ai_ci"),
+            statement_cache_size=int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 32)),
+            identity_exclude=[t.strip() for t in os.environ.get(
+                "DB_IDENTITY_MAP_EXCLUDE", "IS601_Users").split(",") if t.strip()],
+            shard_urls=[u.strip() for u in os.environ.get("DB_SHARD_URLS", "").split(",") if u.strip()],
+            shard_tables=[t.strip() for t in os.environ.get(
+                "DB_SHARD_TABLES", "IS601_Brokers,IS601_BrokerStocks").split(",") if t.strip()],
+            # commas separate both tables and key columns: IS601_Stocks(symbol,latest_trading_day),Other(code)
+            shard_replicated=re.findall(r"\w+(?:\([^)]*\))?", os.environ.get(
+                "DB_SHARD_REPLICATED", "IS601_Stocks(symbol,latest_trading_day)")))
+
+    @staticmethod
+    def parseUrl(db_url):
+        from urllib.parse import urlparse
+        url = urlparse(db_url)
+        if url:
+            # enable autocommit (quick fix for common issues)
+            return {"host": url.hostname, "user": url.username, "password": url.password,
+                    "database": url.path.strip("/"), "port": int(url.port), "autocommit": True}
+        else:  # old logic as fallback
+            data = re.findall(
+                r"mysql://(\w+):(\w+)@([\w\.]+):([\d]+)/([\w]+)", db_url)
+            if len(data) > 0:
+                data = data[0]
+                if len(data) >= 5:
+                    user, password, host, port, database = data
+                    return {"host": host, "user": user, "password": password, "database": database,
+                            "port": int(port), "autocommit": True}
+                else:
+                    raise Exception("Missing connection details")
+            else:
+                raise Exception("Invalid connection string")
+
+
 class DB:
-    db = None
+    config = None
+    db = None  # DB.getDB()'s shared connection
+    pool = None
+    replicas = None
+    shards = None
+    budget = None
+    nplusone = None
+    stats = None
+    results = None
+    executor = None
+    max_packet = None
     debug = False
+    _pool_lock = threading.Lock()
+    # connection -> StatementCache, entries go away with their connection
+    _statements = weakref.WeakKeyDictionary()
+    _statements_lock = threading.Lock()
+    # open DB.transaction() for the current thread/task
+    _transaction = contextvars.ContextVar("db_transaction", default=None)
+    # read-your-writes outside of a flask request (scripts, tests), requests use flask.g
+    _wrote = contextvars.ContextVar("db_wrote", default=False)
+    _replica_turn = itertools.count()
+    # index into DB.shards of the current DB.shard() block, where new brokers go next
+    _shard = contextvars.ContextVar("db_shard", default=None)
+    _shard_turn = itertools.count()
+    # DB.budgetLabel() for queries that aren't naturally tied to one endpoint (e.g., load_user)
+    _budget_label = contextvars.ContextVar("db_budget_label", default=None)
+    # absolute time.monotonic() deadline of the innermost DB.deadline() block
+    _deadline = contextvars.ContextVar("db_deadline", default=None)
+    # (counts, threshold, strict) of the innermost DB.nPlusOneScope()
+    _nplusone_scope = contextvars.ContextVar("db_nplusone_scope", default=None)
+    # ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED, MariaDB's ER_STATEMENT_TIMEOUT
+    TIMEOUT_ERRNOS = (3024, 1317, 1969)
+    # extra time the socket read timeout allows on top of MAX_EXECUTION_TIME
+    TIMEOUT_GRACE = 1.0
+    # MAX_EXECUTION_TIME values (ms) a select's remaining time is rounded down to, 25% apart from
+    # 100ms to an hour, so the hint adds a few dozen statement texts (prepared statements) at most
+    TIMEOUT_BUCKETS = [round(100 * 1.25 ** i) for i in range(48)]
+    SELECT = re.compile(r"^\s*SELECT\b", re.I)
+    # statements routed by DB.shard() and replicated by DB._replicate(), DDL (migrations) runs where it's sent
+    DML = re.compile(r"^\s*(?:SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b", re.I)
+    # an UPDATE/DELETE on a replicated table: the statement up to WHERE, the table and the condition
+    REPLICATED_WRITE = re.compile(r"^\s*(UPDATE\s+`?(\w+)`?\s+SET\s+.*?|DELETE\s+FROM\s+`?(\w+)`?)"
+                                  r"\s+WHERE\s+(.*?)\s*;?\s*$", re.I | re.S)
 
-    def __runQuery(op, isMany, queryString, args=None):
+    def __runQuery(op, isMany, queryString, args=None, cache=False, row_format=RowFormat.DICT, timeout=None):
         response = None
-        try:
-            db = DB.getDB()
-            # cursor = db.cursor(dictionary=True)
-            cursor = db.cursor(prepared=True, dictionary=True)
-            status = False
-            if DB.debug:
-                print(f"db.py query {queryString}")
-                print(f"db.py args {args}")
-            if not isMany or op == CRUD.READ:
-                if args is not None and len(args) > 0:
-                    if type(args[0]) is dict:
-                        args = {k: v for d in args for k, v in d.items()}
-                    status = cursor.execute(queryString, args)
-                    if status is None:
-                        status = True
-                else:
-                    status = cursor.execute(queryString)
-                    #print(f"status is {status}")
+        stats = DB.getStats()
+        results = DB.getResultCache()
+        transaction = DB._transaction.get()
+        if transaction is not None:
+            # uncommitted data mustn't be cached (or served from the cache)
+            cache = False
+        if op == CRUD.READ and cache:
+            key = ResultCache.key(isMany, queryString, args)
+            cached = results.get(key)
+            if cached is not None:
+                return RowFormat.apply(cached, isMany, row_format)
+            tables = ResultCache.tables(queryString)
+            generation = results.generation(tables)
+        DB._checkShard(queryString)
+        DB.chargeBudget()
+        config = DB.getConfig()
+        replicated = op != CRUD.READ and config.shard_urls and DB.DML.match(queryString) \
+            and ResultCache.tables(queryString) & config.shard_replicated
+        attempt = 0
+        while True:
+            start = None
+            # writes aren't cut short, a deadline only bounds reads
+            remaining = DB._timeout(timeout) if op == CRUD.READ else None
+            try:
+                with DB.connection(read=op == CRUD.READ) as db:
+                    if replicated:
+                        writes = DB._replicatedWrites(db, isMany, queryString, args)
+                    start = time.perf_counter()
+                    with DB._statementTimeout(db, remaining):
+                        response = DB.__execute(db, op, isMany, DB._timeoutHint(db, queryString, remaining), args)
+                    elapsed = time.perf_counter() - start
+                break
+            except Error as e:
+                # connect errors are counted too, they're still time the page spent on this statement
+                stats.record(queryString, time.perf_counter() - start if start is not None else 0.0,
+                             error=True, args=args)
+                if DB._timedOut(e, start, remaining):
+                    print(f"Query timed out after {remaining:.2f}s: {e}")
+                    raise DBTimeoutError(f"Query timed out after {remaining:.2f}s") from e
+                # only reads are retried, a write may have been applied before the connection dropped
+                if op == CRUD.READ and transaction is None and DB._retryRead(e, attempt):
+                    attempt += 1
+                    continue
+                print(f"Error {e}")
+                raise Exception(e)
+        rows_returned = len(response.rows) if response.rows else (1 if response.row else 0)
+        fp = stats.record(queryString, elapsed, rows_returned=rows_returned,
+                          rows_affected=response.rows_affected, args=args)
+        DB.checkNPlusOne(fp)
+        if op == CRUD.READ:
+            if cache:
+                results.put(key, tables, generation, response, ttl=None if cache is True else cache)
+            RowFormat.apply(response, isMany, row_format)
+        else:
+            DB.stickToPrimary()
+            tables = ResultCache.tables(queryString)
+            results.invalidate(tables)
+            IdentityMap.invalidate(tables)
+            if transaction is not None:
+                # invalidated again on commit in case another thread cached the pre-commit rows
+                transaction.tables.update(tables)
+            if replicated:
+                for write in writes:
+                    if transaction is not None:
+                        transaction.replicate.append((op, *write))
+                    else:
+                        DB._replicate(op, *write)
+        return response
+
+    def __execute(db, op, isMany, queryString, args):
+        response = None
+        statements = DB.statementCache(db)
+        cursor, queryString, keys = statements.get(queryString)
+        status = False
+        if DB.debug:
+            print(f"db.py query {queryString}")
+            print(f"db.py args {args}")
+        if not isMany or op == CRUD.READ:
+            if args is not None and len(args) > 0:
+                if type(args[0]) is dict:
+                    args = {k: v for d in args for k, v in d.items()}
+                status = cursor.execute(queryString, StatementCache.positional(args, keys))
+                if status is None:
                     status = True
             else:
-                if args is not None and len(args) > 0:
-                    status = cursor.executemany(queryString, args)
-                    if status is None:
-                        status = True
-                else:
-                    status = cursor.executemany(queryString)
-                    if status is None:
-                        status = True
-            if op == CRUD.READ:
-                if not isMany:
-                    result = cursor.fetchone()
-                    status = True if status >= 0 else False
-                    
-                    response = DBResponse(status=status, row=result)
-                else:
-                    result = cursor.fetchall()
-                    status = True if status >= 0 else False
-                    response = DBResponse(status=status, rows=result)
+                status = cursor.execute(queryString)
+                #print(f"status is {status}")
+                status = True
+        else:
+            if args is not None and len(args) > 0:
+                args = [StatementCache.positional(a, keys) for a in args]
+                status = cursor.executemany(queryString, args)
+                if status is None:
+                    status = True
+            else:
+                status = cursor.executemany(queryString)
+                if status is None:
+                    status = True
+        if op == CRUD.READ:
+            # rows stay tuples here, __runQuery shapes them (RowFormat) after the result cache
+            columns = tuple(cursor.column_names)
+            if not isMany:
+                result = cursor.fetchone()
+                if result is not None:
+                    # read the rest of the result (a prepared cursor has read a row ahead), otherwise the
+                    # cached cursor and the pooled connection are handed back with it still pending
+                    cursor.fetchall()
+                status = True if status >= 0 else False
+                
+                response = DBResponse(status=status, row=result, columns=columns)
             else:
-                if op != CRUD.ALTER:
-                    if not db.autocommit:
-                        db.commit()
+                result = cursor.fetchall()
                 status = True if status >= 0 else False
-                insert_id = DB.db.fetch_eof_status()["insert_id"]
-                response = DBResponse(status=status, insert_id=insert_id)
-            if op != CRUD.READ:
-                # Get the number of rows affected
-                rows_affected = cursor.rowcount
-                print(f'db.py {op} {rows_affected} rows affected')
+                response = DBResponse(status=status, rows=result, columns=columns)
+        else:
+            # connections run in autocommit, DB.transaction() commits once at the end instead
+            status = True if status >= 0 else False
+            # from the cursor, only the C extension's connection has fetch_eof_status()
+            insert_id = cursor.lastrowid
+            response = DBResponse(status=status, insert_id=insert_id)
+        if op != CRUD.READ:
+            # Get the number of rows affected
+            rows_affected = cursor.rowcount
+            response.rows_affected = rows_affected
+            print(f'db.py {op} {rows_affected} rows affected')
+        if DB.debug:
+            print(f"Output: {response.__dict__}")
+        if not statements.owns(cursor):
+            # caching is disabled (DB_STATEMENT_CACHE_SIZE=0)
             try:
-                if DB.debug:
-                    print(f"Output: {response.__dict__}")
                 cursor.close()
             except Exception as ce:
                 print("cursor close error", ce)
-
-        except Error as e:
-            print(f"Error {e}")
-            if e.errno == 2006:  # MySQL server has gone away
-                DB.close()
-            raise Exception(e)
         return response
 
+    @staticmethod
+    def statementCache(db):
+        with DB._statements_lock:
+            statements = DB._statements.get(db)
+            if statements is None:
+                statements = StatementCache(db, size=DB.getConfig().statement_cache_size)
+                DB._statements[db] = statements
+        return statements
+
+    @staticmethod
+    def statementCacheStats():
+        return StatementCache.stats()
+
+    @staticmethod
+    def getStats():
+        if DB.stats is None:
+            with DB._pool_lock:
+                if DB.stats is None:
+                    from dotenv import load_dotenv
+                    load_dotenv()
+                    slow_ms = os.environ.get("DB_SLOW_QUERY_MS", 500)
+                    DB.stats = QueryStats(
+                        slow_ms=float(slow_ms) if slow_ms != "" else None,
+                        slow_log=os.environ.get("DB_SLOW_QUERY_LOG"))
+        return DB.stats
+
+    @staticmethod
+    def getResultCache():
+        if DB.results is None:
+            with DB._pool_lock:
+                if DB.results is None:
+                    from dotenv import load_dotenv
+                    load_dotenv()
+                    DB.results = ResultCache(
+                        size=int(os.environ.get("DB_RESULT_CACHE_SIZE", 256)),
+                        ttl=float(os.environ.get("DB_RESULT_CACHE_TTL", 60)))
+        return DB.results
+
+    @staticmethod
+    def getBudget():
+        if DB.budget is None:
+            with DB._pool_lock:
+                if DB.budget is None:
+                    from dotenv import load_dotenv
+                    load_dotenv()
+                    DB.budget = QueryBudget(
+                        quota=int(os.environ.get("DB_QUERY_QUOTA", 10000)),
+                        window=float(os.environ.get("DB_QUERY_QUOTA_WINDOW", 3600)),
+                        warn_at=float(os.environ.get("DB_QUERY_QUOTA_WARN", 0.8)),
+                        mode=os.environ.get("DB_QUERY_QUOTA_MODE", "warn"))
+        return DB.budget
+
+    @staticmethod
+    def chargeBudget():
+        # one query against the quota, labeled with DB.budgetLabel() or the request's endpoint
+        label = DB._budget_label.get()
+        request_count = None
+        request_g = DB._requestG()
+        if request_g is not None:
+            if label is None:
+                from flask import has_request_context, request
+                label = (request.endpoint or request.path) if has_request_context() else None
+            # this request's queries per label
+            counts = request_g.setdefault("_db_queries", {})
+            request_count = counts[label or "-"] = counts.get(label or "-", 0) + 1
+        DB.getBudget().charge(label or "-", request_count)
+
+    @staticmethod
+    @contextmanager
+    def budgetLabel(label):
+        # with DB.budgetLabel("load_user"): the queries in the block are reported under label
+        token = DB._budget_label.set(label)
+        try:
+            yield
+        finally:
+            DB._budget_label.reset(token)
+
+    @staticmethod
+    def getNPlusOne():
+        if DB.nplusone is None:
+            with DB._pool_lock:
+                if DB.nplusone is None:
+                    from dotenv import load_dotenv
+                    load_dotenv()
+                    allow = os.environ.get("DB_NPLUSONE_ALLOW", "")
+                    DB.nplusone = NPlusOneDetector(
+                        threshold=int(os.environ.get("DB_NPLUSONE_THRESHOLD", 0)),
+                        strict=os.environ.get("DB_NPLUSONE_STRICT", "").lower() in ("1", "true", "yes"),
+                        allow=[a.strip() for a in allow.split(";") if a.strip()])
+        return DB.nplusone
+
+    @staticmethod
+    def checkNPlusOne(fp):
+        # counts a statement (fingerprint) against the current request or DB.nPlusOneScope()
+        detector = DB.getNPlusOne()
+        scope = DB._nplusone_scope.get()
+        if scope is None and detector.threshold <= 0:
+            return
+        request_g = DB._requestG()
+        if scope is not None:
+            counts, threshold, strict = scope
+        elif request_g is not None:
+            counts = request_g.setdefault("_db_fingerprints", {})
+            threshold, strict = detector.threshold, detector.strict
+        else:
+            return
+        path = endpoint = None
+        if request_g is not None:
+            from flask import has_request_context, request
+            if has_request_context():
+                path, endpoint = request.path, request.endpoint
+        detector.check(fp, counts, threshold, strict, path, endpoint)
+
+    @staticmethod
+    @contextmanager
+    def nPlusOneScope(threshold=None, strict=None):
+        # with DB.nPlusOneScope(threshold=3, strict=True): statements in the block are counted
+        # together like one request's (scripts, tests), defaults to DB_NPLUSONE_THRESHOLD or 5
+        detector = DB.getNPlusOne()
+        if threshold is None:
+            threshold = detector.threshold or 5
+        token = DB._nplusone_scope.set(({}, threshold, detector.strict if strict is None else strict))
+        try:
+            yield
+        finally:
+            DB._nplusone_scope.reset(token)
+
+    @staticmethod
+    def nPlusOneReport():
+        return DB.getNPlusOne().report()
+
+    @staticmethod
+    def identityMapStats():
+        return IdentityMap.stats()
+
+    @staticmethod
+    def budgetReport(limit=None):
+        return DB.getBudget().report(limit)
+
+    @staticmethod
+    def resultCacheStats():
+        return DB.getResultCache().stats()
+
+    @staticmethod
+    def queryStats(limit=None):
+        return DB.getStats().snapshot(limit)
+
     @staticmethod
     def delete(queryString, *args):
         return DB.__runQuery(CRUD.DELETE, False, queryString, args)
@@ -122,65 +1445,898 @@ class DB:
     def insertOne(queryString, *args):
         return DB.__runQuery(CRUD.CREATE, False, queryString, args)
 
+    # cache=True (or a TTL in seconds) serves repeat calls from the result cache until the TTL
+    # runs out or this process writes to one of the tables the query reads
+    # row_format picks the shape of row/rows (see RowFormat), dicts by default
+    # timeout (seconds) stops the select server side (MAX_EXECUTION_TIME) and raises DBTimeoutError,
+    # it's capped by an enclosing DB.deadline() / DB.requestDeadline()
     @staticmethod
-    def selectAll(queryString, *args):
-        return DB.__runQuery(CRUD.READ, True, queryString, args)
+    def selectAll(queryString, *args, cache=False, row_format=RowFormat.DICT, timeout=None):
+        return DB.__runQuery(CRUD.READ, True, queryString, args, cache=cache, row_format=row_format,
+                             timeout=timeout)
 
     @staticmethod
-    def selectOne(queryString, *args):
-        return DB.__runQuery(CRUD.READ, False, queryString, args)
-    
+    def selectOne(queryString, *args, cache=False, row_format=RowFormat.DICT, timeout=None):
+        # reads by primary key go through the request's identity map (see IdentityMap)
+        identity = IdentityMap.current() if len(args) == 1 else None
+        parsed = IdentityMap.parse(queryString) if identity is not None else None
+        if parsed is not None:
+            response = IdentityMap.load(identity, parsed, args[0], lambda sql: DB.__runQuery(
+                CRUD.READ, False, sql, args, cache=cache, row_format=RowFormat.TUPLE, timeout=timeout))
+            if response is not None:
+                return RowFormat.apply(response, False, row_format)
+        return DB.__runQuery(CRUD.READ, False, queryString, args, cache=cache, row_format=row_format,
+                             timeout=timeout)
+
     @staticmethod
-    def close():
+    def registerMapper(cls, factory=None):
+        # lets cls be used as a row_format, by default rows are passed positionally to cls(...)
+        # matching columns to constructor parameters by name
+        # factory(columns) can instead return a custom row tuple -> object function
+        RowFormat.register(cls, factory)
+
+    # placeholders per statement (MySQL prepared statements allow 65535, SQLite 32766)
+    MAX_PARAMS = 32766
+    IDENTIFIER = re.compile(r"^\w+$")
+
+    @staticmethod
+    def bulkUpsert(table, columns, rows, update_columns=None, chunk_size=None):
+        # multi-row INSERT ... ON DUPLICATE KEY UPDATE sent in as few statements as fit in max_allowed_packet
+        # rows: tuples/lists in the order of columns, or dicts keyed by column
+        # update_columns: columns to overwrite with the new value on a duplicate key, or a dict of
+        #   column -> sql expression (e.g., {"is_active": "!is_active"}), nothing is updated when empty
+        # chunk_size: max rows per statement, by default chunks are sized from max_allowed_packet
+        # the response carries rows_affected and chunks (rows and ms per statement)
+        for name in [table, *columns, *(update_columns or [])]:
+            if not DB.IDENTIFIER.match(name):
+                raise Exception(f"Invalid identifier {name}")
+        if not rows:
+            response = DBResponse(status=True, rows_affected=0)
+            response.chunks = []
+            return response
+        if isinstance(update_columns, dict):
+            updates = [f"`{c}` = {expr}" for c, expr in update_columns.items()]
+        else:
+            updates = [f"`{c}` = VALUES(`{c}`)" for c in (update_columns or [])]
+        if not updates:
+            # keep the existing row as-is
+            updates = [f"`{columns[0]}` = `{columns[0]}`"]
+        prefix = f"INSERT INTO `{table}` ({', '.join(f'`{c}`' for c in columns)}) VALUES "
+        suffix = f" ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+        row_sql = "(" + ", ".join(["%s"] * len(columns)) + ")"
+
+        max_rows = DB.MAX_PARAMS // len(columns)
+        if chunk_size:
+            max_rows = min(max_rows, chunk_size)
+        # leave headroom under the packet limit for protocol overhead
+        max_bytes = DB.maxPacket() * 0.9 - len(prefix) - len(suffix)
+        chunks = []
+        chunk, chunk_bytes = [], 0
+        for row in rows:
+            values = tuple(row[c] for c in columns) if isinstance(row, dict) else tuple(row)
+            row_bytes = len(row_sql) + 2 + sum(len(str(v)) + 2 for v in values)
+            if chunk and (len(chunk) >= max_rows or chunk_bytes + row_bytes > max_bytes):
+                chunks.append(chunk)
+                chunk, chunk_bytes = [], 0
+            chunk.append(values)
+            chunk_bytes += row_bytes
+        chunks.append(chunk)
+
+        timings = []
+        rows_affected = 0
+        status = True
+        for chunk in chunks:
+            # full chunks share the same sql text so they reuse the cached prepared statement
+            queryString = prefix + ",".join([row_sql] * len(chunk)) + suffix
+            start = time.perf_counter()
+            result = DB.__runQuery(CRUD.CREATE, False, queryString, [v for values in chunk for v in values])
+            timings.append({"rows": len(chunk), "ms": round((time.perf_counter() - start) * 1000, 3)})
+            status = status and result.status
+            rows_affected += max(result.rows_affected or 0, 0)
+        if DB.debug:
+            print(f"db.py bulkUpsert {table} chunks {timings}")
+        response = DBResponse(status=status, rows_affected=rows_affected)
+        response.chunks = timings
+        return response
+
+    @staticmethod
+    def maxPacket():
+        # the server's max_allowed_packet, looked up once
+        if DB.max_packet is None:
+            max_packet = 4 * 1024 * 1024
+            try:
+                with DB.connection() as db:
+                    if not isinstance(db, SQLiteConnection):
+                        cursor = db.cursor()
+                        cursor.execute("SELECT @@max_allowed_packet")
+                        max_packet = int(cursor.fetchone()[0])
+                        cursor.close()
+            except Exception as e:
+                print("Unable to read max_allowed_packet, using 4MB", e)
+            DB.max_packet = max_packet
+        return DB.max_packet
+
+    # longest list inClause() pads into placeholders, longer ones are sent as a single JSON array
+    IN_LIST_MAX = 256
+    COLUMN = re.compile(r"^\w+(\.\w+)?$")
+
+    @staticmethod
+    def inClause(column, values, negate=False):
+        # (sql, params) for "column [NOT] IN (values)" that keeps the statement text stable:
+        # short lists are padded (repeating the last value) to the next power of two placeholders so
+        # there's a handful of statements to prepare/cache instead of one per list length, longer
+        # lists become a single JSON parameter joined through JSON_TABLE (json_each on SQLite)
+        # e.g. clause, params = DB.inClause("symbol", symbols)
+        #      DB.selectAll(f"SELECT id FROM IS601_Stocks WHERE {clause}", *params)
+        if not DB.COLUMN.match(column):
+            raise Exception(f"Invalid column name {column}")
+        values = list(dict.fromkeys(values))
+        if not values:
+            # x IN () isn't valid sql, nothing matches (or everything does for NOT IN)
+            return ("1 = 1" if negate else "1 = 0"), []
+        op = "NOT IN" if negate else "IN"
+        if len(values) <= DB.IN_LIST_MAX:
+            size = 1 << (len(values) - 1).bit_length()
+            values += [values[-1]] * (size - len(values))
+            return f"{column} {op} ({','.join(['%s'] * size)})", values
+        config = DB.getConfig()
+        if config.sqlite:
+            return f"{column} {op} (SELECT value FROM json_each(%s))", [json.dumps(values, default=str)]
+        # JSON_TABLE's columns get the connection's collation otherwise, "Illegal mix of collations"
+        # when that isn't the table's
+        sql_type = "BIGINT" if all(type(v) is int for v in values) else \
+            f"VARCHAR(255) CHARACTER SET {config.collation.split('_')[0]} COLLATE {config.collation}"
+        return (f"{column} {op} (SELECT v FROM JSON_TABLE(%s, '$[*]' COLUMNS (v {sql_type} PATH '$')) AS in_list)",
+                [json.dumps(values, default=str)])
+
+    # async versions of the above, each call runs on its own pooled connection so independent
+    # queries awaited together (asyncio.gather or DB.gather) overlap instead of running back to back
+    @staticmethod
+    async def adelete(queryString, *args):
+        return await DB._runAsync(DB.delete, queryString, *args)
+
+    @staticmethod
+    async def aupdate(queryString, *args):
+        return await DB._runAsync(DB.update, queryString, *args)
+
+    @staticmethod
+    async def ainsertMany(queryString, data):
+        return await DB._runAsync(DB.insertMany, queryString, data)
+
+    @staticmethod
+    async def ainsertOne(queryString, *args):
+        return await DB._runAsync(DB.insertOne, queryString, *args)
+
+    @staticmethod
+    async def aselectAll(queryString, *args, cache=False, row_format=RowFormat.DICT, timeout=None):
+        return await DB._runAsync(DB.selectAll, queryString, *args, cache=cache, row_format=row_format,
+                                  timeout=timeout)
+
+    @staticmethod
+    def selectAllShards(queryString, *args, key=None, reverse=False, limit=None, row_format=RowFormat.DICT,
+                        timeout=None):
+        # scatter-gather for cross-shard reads like the brokers list: the select runs on every shard
+        # at once and the rows are merged, sorted by key (like sorted()) and cut to limit when given
+        # (a LIMIT in the sql applies per shard), the same as DB.selectAll() without DB_SHARD_URLS
+        return DB.gather(DB.aselectAllShards(queryString, *args, key=key, reverse=reverse, limit=limit,
+                                             row_format=row_format, timeout=timeout))[0]
+
+    @staticmethod
+    async def aselectAllShards(queryString, *args, key=None, reverse=False, limit=None, row_format=RowFormat.DICT,
+                               timeout=None):
+        if row_format == RowFormat.COLUMNS:
+            raise Exception("selectAllShards() merges rows, use another row_format")
+
+        async def select(index):
+            with DB.onShard(index):
+                return await DB.aselectAll(queryString, *args, row_format=row_format, timeout=timeout)
+        shards = DB.getShards()
+        if shards:
+            responses = await asyncio.gather(*[select(index) for index in range(len(shards))])
+        else:
+            responses = [await DB.aselectAll(queryString, *args, row_format=row_format, timeout=timeout)]
+        rows = [row for response in responses for row in response.rows or []]
+        if key is not None:
+            rows.sort(key=key, reverse=reverse)
+        return DBResponse(status=all(r.status for r in responses), rows=rows[:limit] if limit else rows,
+                          columns=responses[0].columns)
+
+    @staticmethod
+    async def aselectOne(queryString, *args, cache=False, row_format=RowFormat.DICT, timeout=None):
+        return await DB._runAsync(DB.selectOne, queryString, *args, cache=cache, row_format=row_format,
+                                  timeout=timeout)
+
+    @staticmethod
+    def gather(*coros):
+        # runs the given coroutines concurrently from regular (sync) code like a Flask view
+        # and returns their results in the same order
+        async def run_all():
+            return await asyncio.gather(*coros)
+        return asyncio.run(run_all())
+
+    @staticmethod
+    async def _runAsync(fn, *args, **kwargs):
+        if DB._transaction.get() is not None:
+            # a transaction has a single connection, so its queries can't overlap
+            return fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        # copy the caller's context so request-scoped state (flask.g etc.) is visible in the worker thread
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(DB.getExecutor(), functools.partial(ctx.run, fn, *args, **kwargs))
+
+    @staticmethod
+    def getExecutor():
+        if DB.executor is None:
+            # no point in more threads than connections they can check out
+            size = DB.getPool().size
+            with DB._pool_lock:
+                if DB.executor is None:
+                    DB.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db")
+        return DB.executor
+
+    @staticmethod
+    def batch():
+        # users, roles = DB.batch().selectAll(q1, a).selectOne(q2, b).run()
+        # for independent reads on the same page: MySQL gets them as one multi-statement query
+        # (one round trip instead of one per select), SQLite runs them back to back
+        return Batch()
+
+    @staticmethod
+    def _runBatch(statements, timeout=None):
+        responses = [None] * len(statements)
+        results = DB.getResultCache()
+        transaction = DB._transaction.get()
+        pending = []  # (index, key, tables, generation)
+        for i, (isMany, queryString, args, cache, row_format) in enumerate(statements):
+            if cache and transaction is None:
+                key = ResultCache.key(isMany, queryString, args)
+                cached = results.get(key)
+                if cached is not None:
+                    responses[i] = RowFormat.apply(cached, isMany, row_format)
+                    continue
+                tables = ResultCache.tables(queryString)
+                pending.append((i, key, tables, results.generation(tables)))
+            else:
+                pending.append((i, None, None, None))
+        if not pending:
+            return responses
+        for _, queryString, _, _, _ in statements:
+            DB._checkShard(queryString)
+        DB.chargeBudget()
+        sqls = []
+        params = []
+        for i, _, _, _ in pending:
+            _, queryString, args, _, _ = statements[i]
+            if len(args) > 0 and type(args[0]) is dict:
+                args = {k: v for d in args for k, v in d.items()}
+            keys = StatementCache.NAMED_PARAM.findall(queryString)
+            sqls.append(StatementCache.NAMED_PARAM.sub("%s", queryString).strip().rstrip(";"))
+            params.append(StatementCache.positional(args, keys) if args else ())
+        queryString = ";\n".join(sqls)
+        if DB.debug:
+            print(f"db.py batch {queryString}")
+            print(f"db.py args {params}")
+        stats = DB.getStats()
+        attempt = 0
+        while True:
+            remaining = DB._timeout(timeout)
+            start = time.perf_counter()
+            try:
+                with DB.connection(read=True) as db:
+                    with DB._statementTimeout(db, remaining):
+                        fetched = DB._fetchBatch(db, [DB._timeoutHint(db, sql, remaining) for sql in sqls], params)
+                break
+            except Error as e:
+                stats.record(queryString, time.perf_counter() - start, error=True, args=params)
+                if DB._timedOut(e, start, remaining):
+                    print(f"Batch timed out after {remaining:.2f}s: {e}")
+                    raise DBTimeoutError(f"Batch timed out after {remaining:.2f}s") from e
+                if transaction is None and DB._retryRead(e, attempt):
+                    attempt += 1
+                    continue
+                print(f"Error {e}")
+                raise Exception(e)
+        fp = stats.record(queryString, time.perf_counter() - start,
+                          rows_returned=sum(len(rows) for _, rows in fetched), args=params)
+        DB.checkNPlusOne(fp)
+        for (i, key, tables, generation), (columns, rows) in zip(pending, fetched):
+            isMany, _, _, cache, row_format = statements[i]
+            if isMany:
+                response = DBResponse(status=True, rows=rows, columns=columns)
+            else:
+                response = DBResponse(status=True, row=rows[0] if rows else None, columns=columns)
+            if key is not None:
+                results.put(key, tables, generation, response, ttl=None if cache is True else cache)
+            responses[i] = RowFormat.apply(response, isMany, row_format)
+        return responses
+
+    @staticmethod
+    def _fetchBatch(db, sqls, params):
+        # [(columns, rows)] per statement
+        if isinstance(db, SQLiteConnection):
+            fetched = []
+            cursor = db.cursor()
+            try:
+                for sql, args in zip(sqls, params):
+                    cursor.execute(sql, args)
+                    fetched.append((cursor.column_names, cursor.fetchall()))
+            finally:
+                cursor.close()
+            return fetched
+        # multi-statement queries can't be prepared so the values are escaped client side by the driver
+        fetched = []
+        cursor = db.cursor()
         try:
-            DB.db.close()
-        except:
-            pass
-        DB.db = None
+            for result in cursor.execute(";\n".join(sqls), tuple(p for args in params for p in args), multi=True):
+                if result.with_rows:
+                    fetched.append((tuple(result.column_names), result.fetchall()))
+        finally:
+            cursor.close()
+        if len(fetched) != len(sqls):
+            raise Exception(f"Batch expected {len(sqls)} results, got {len(fetched)} (only selects can be batched)")
+        return fetched
 
     @staticmethod
-    def getDB():
-        if DB.db is None or not DB.db.is_connected():
-            import os
-            import re
-            from dotenv import load_dotenv
-            load_dotenv()
-            db_url = os.environ.get("DB_URL")
-            from urllib.parse import urlparse
-            url = urlparse(db_url)
-            if url:
-                user = url.username
-                password = url.password
-                host = url.hostname
-                port = url.port
-                database = url.path.strip("/")
-                try:
-                    DB.db = mysql.connector.connect(
-                        host=host, user=user, password=password, database=database, port=int(port))
-                except Error as e:
-                    print("Error while connecting to MySQL", e)
-                    raise e
-            else:  # old logic as fallback
-                data = re.findall(
-                    "mysql://(\w+):(\w+)@([\w\.]+):([\d]+)/([\w]+)", db_url)
-                if len(data) > 0:
-                    data = data[0]
-                    if len(data) >= 5:
-                        try:
-                            user, password, host, port, database = data
-                            DB.db = mysql.connector.connect(
-                                host=host, user=user, password=password, database=database, port=int(port))
-                        except Error as e:
-                            print("Error while connecting to MySQL", e)
-                            raise e
-                    else:
-                        raise Exception("Missing connection details")
+    def selectIter(queryString, *args, batch_size=500, row_format=RowFormat.DICT):
+        # generator version of selectAll for large reads: rows are streamed from the server with an
+        # unbuffered cursor and fetched batch_size at a time so memory stays flat regardless of row count
+        # note: the connection stays checked out until the generator is exhausted or closed
+        # with row_format="columns" each batch is yielded as one column -> list dict
+        if len(args) > 0 and type(args[0]) is dict:
+            args = {k: v for d in args for k, v in d.items()}
+        if DB.debug:
+            print(f"db.py query {queryString}")
+            print(f"db.py args {args}")
+        DB._checkShard(queryString)
+        DB.chargeBudget()
+        transaction = DB._transaction.get()
+        if transaction is not None:
+            db = transaction.db
+        else:
+            pool, db = DB._acquire(DB.readPool())
+        cursor = None
+        finished = False
+        error = None
+        # time spent in the caller's loop isn't the database's so only the fetches are timed
+        elapsed = 0.0
+        count = 0
+        try:
+            start = time.perf_counter()
+            cursor = db.cursor(buffered=False)
+            if args:
+                cursor.execute(queryString, args)
+            else:
+                cursor.execute(queryString)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+                if not rows:
+                    break
+                count += len(rows)
+                if row_format == RowFormat.COLUMNS:
+                    yield RowFormat.rows(rows, cursor.column_names, row_format)
                 else:
-                    raise Exception("Invalid connection string")
-        # enable autocommit (quick fix for common issues)
-        if DB.db:
-            DB.db.autocommit = True
-        return DB.db
+                    yield from RowFormat.rows(rows, cursor.column_names, row_format)
+                start = time.perf_counter()
+            finished = True
+        except Error as e:
+            error = e
+            DB.getStats().record(queryString, elapsed, rows_returned=count, error=True, args=args)
+            print(f"Error {e}")
+            raise Exception(e)
+        finally:
+            if finished:
+                DB.getStats().record(queryString, elapsed, rows_returned=count, args=args)
+            if cursor is not None and finished:
+                try:
+                    cursor.close()
+                except Exception as ce:
+                    print("cursor close error", ce)
+            if transaction is None:
+                # stopping early leaves the rest of the result on the wire, draining it could mean
+                # reading the whole table so the connection is dropped instead
+                DB._release(pool, db, error, discard=not finished)
+            elif not finished and cursor is not None:
+                # the transaction needs its connection back so the rest has to be read
+                try:
+                    cursor.fetchall()
+                    cursor.close()
+                except Exception as ce:
+                    print("cursor close error", ce)
+
+    @staticmethod
+    def close():
+        # closes the pooled connections and DB.getDB()'s (e.g., at the end of a script)
+        db, DB.db = DB.db, None
+        if db is not None:
+            try:
+                db.close()
+            except Exception as e:
+                print("close error", e)
+        if DB.pool is not None:
+            DB.pool.close()
+        for pool in DB.shards or []:
+            pool.close()
+
+    @staticmethod
+    def getPool():
+        if DB.pool is None:
+            with DB._pool_lock:
+                if DB.pool is None:
+                    config = DB.getConfig()
+                    DB.pool = ConnectionPool(
+                        DB._connect,
+                        size=config.pool_size,
+                        timeout=config.pool_timeout,
+                        idle_timeout=config.idle_timeout,
+                        ping_interval=config.ping_interval,
+                        breaker=config.breaker())
+        return DB.pool
+
+    @staticmethod
+    def getConfig():
+        # parsed on first use, DB.reset() drops it so the next query re-reads the environment
+        config = DB.config
+        if config is None:
+            config = DB.config = DBConfig.fromEnv()
+        return config
+
+    @staticmethod
+    def getDB():
+        # one connection shared by every caller (not safe across threads), kept for existing code,
+        # DB's own calls and new code check one out of the pool with DB.connection() instead
+        with DB._pool_lock:
+            if DB.db is None or not DB.db.is_connected():
+                DB.db = DB._connect()
+            return DB.db
+
+    @staticmethod
+    @contextmanager
+    def connection(read=False):
+        # read=True may be served by a replica (see DB.readPool())
+        transaction = DB._transaction.get()
+        if transaction is not None:
+            # statements inside DB.transaction() share its connection
+            yield transaction.db
+            return
+        pool, db = DB._acquire(DB.readPool() if read else DB.writePool())
+        error = None
+        try:
+            yield db
+        except Error as e:
+            error = e
+            raise
+        finally:
+            DB._release(pool, db, error)
+
+    @staticmethod
+    def _release(pool, db, error=None, discard=False):
+        # hands a checked out connection back and tells the pool's circuit breaker how it went, every
+        # checkout (DB.connection(), DB.transaction(), DB.selectIter(), DB._replicate()) ends here:
+        # a lost connection is a failure, otherwise the database answered (a half open probe closes it)
+        # error: what the statements failed with, the connection is checked before it's handed out again
+        lost = error is not None and DB._lostConnection(error)
+        pool.release(db, discard=discard or lost, suspect=error is not None)
+        if lost:
+            pool.failed()
+        else:
+            pool.ok()
+
+    @staticmethod
+    def _acquire(pool):
+        # (pool, connection), a replica that can't be reached falls back to the primary
+        try:
+            return pool, pool.acquire()
+        except (Error, DBUnavailableError) as e:
+            if not any(pool is replica for replica in DB.getReplicas()):
+                raise
+            print(f"Replica unavailable, reading from the primary: {e}")
+            primary = DB.getPool()
+            return primary, primary.acquire()
+
+    @staticmethod
+    def getReplicas():
+        if DB.replicas is None:
+            config = DB.getConfig()
+            with DB._pool_lock:
+                if DB.replicas is None:
+                    DB.replicas = [ConnectionPool(
+                        functools.partial(DB._connect, url, config.connectArgs(url)),
+                        size=config.pool_size,
+                        timeout=config.pool_timeout,
+                        idle_timeout=config.idle_timeout,
+                        ping_interval=config.ping_interval,
+                        breaker=config.breaker()) for url in config.replica_urls]
+        return DB.replicas
+
+    @staticmethod
+    def readPool():
+        # pool for a select outside of a transaction: a replica (DB_REPLICA_URLS) picked round robin or
+        # by fewest checked out connections (DB_REPLICA_STRATEGY=least_loaded), the primary when
+        # there are no replicas or this request/context already wrote (read-your-writes),
+        # the shard's own pool inside DB.shard()
+        if DB._shard.get() is not None:
+            return DB.writePool()
+        replicas = DB.getReplicas()
+        if not replicas or DB.wrote():
+            return DB.getPool()
+        if DB.getConfig().replica_strategy == "least_loaded":
+            return min(replicas, key=lambda pool: pool.load())
+        return replicas[next(DB._replica_turn) % len(replicas)]
+
+    @staticmethod
+    def writePool():
+        # the current DB.shard()'s pool, otherwise the primary
+        index = DB._shard.get()
+        return DB.getShards()[index] if index is not None else DB.getPool()
+
+    @staticmethod
+    def getShards():
+        # one pool per DB_SHARD_URLS entry, empty when broker data isn't sharded
+        if DB.shards is None:
+            config = DB.getConfig()
+            with DB._pool_lock:
+                if DB.shards is None:
+                    DB.shards = [ConnectionPool(
+                        functools.partial(DB._connectShard, index, url, config.connectArgs(url)),
+                        size=config.pool_size,
+                        timeout=config.pool_timeout,
+                        idle_timeout=config.idle_timeout,
+                        ping_interval=config.ping_interval,
+                        breaker=config.breaker()) for index, url in enumerate(config.shard_urls)]
+        return DB.shards
+
+    @staticmethod
+    def shardFor(key):
+        # shard holding a broker id: shard i hands out ids with auto_increment_offset = i + 1 and
+        # auto_increment_increment = the number of shards (see DB._connectShard()), so the id says where it lives
+        count = len(DB.getConfig().shard_urls)
+        return (int(key) - 1) % count if count else None
+
+    @staticmethod
+    @contextmanager
+    def shard(key=None):
+        # with DB.shard(broker_id): statements in the block go to the shard holding that broker,
+        # with DB.shard(): the shard the next new broker goes to (round robin)
+        # without DB_SHARD_URLS everything stays on DB_URL and this does nothing
+        count = len(DB.getConfig().shard_urls)
+        if not count:
+            yield None
+            return
+        index = DB.shardFor(key) if key is not None else next(DB._shard_turn) % count
+        with DB.onShard(index):
+            yield index
+
+    @staticmethod
+    @contextmanager
+    def onShard(index):
+        # with DB.onShard(i): statements in the block go to shard i (migrations, DB.selectAllShards())
+        transaction = DB._transaction.get()
+        if transaction is not None and DB._shard.get() != index:
+            # the transaction's connection is on another database
+            raise Exception("A DB.transaction() can't span shards, open it inside DB.shard()")
+        token = DB._shard.set(index)
+        try:
+            yield index
+        finally:
+            DB._shard.reset(token)
+
+    @staticmethod
+    def _checkShard(queryString):
+        # once broker data is spread over shards, reaching it outside of DB.shard() would read or
+        # write whatever is left on DB_URL
+        config = DB.getConfig()
+        if config.shard_urls and DB._shard.get() is None and DB.DML.match(queryString) \
+                and ResultCache.tables(queryString) & config.shard_tables:
+            raise Exception(f"{QueryStats.fingerprint(queryString)} needs DB.shard() (or DB.selectAllShards())")
+
+    @staticmethod
+    def _replicatedWrites(db, isMany, queryString, args):
+        # what DB._replicate() repeats for a write to a replicated table, as (isMany, queryString, args):
+        # ids differ between the databases (a shard hands out its own, see DB._connectShard()), so an
+        # UPDATE/DELETE is repeated on the natural key of the rows it's about to change on db,
+        # "WHERE id = 2" becomes "WHERE (symbol = %s AND latest_trading_day = %s) OR (...)"
+        match = DB.REPLICATED_WRITE.match(queryString)
+        table = match and (match.group(2) or match.group(3))
+        keys = DB.getConfig().replicated_keys.get(table.lower()) if table else None
+        if isMany or not keys:
+            return [(isMany, queryString, args)]
+        head, where = match.group(1), match.group(4)
+        named = bool(args) and type(args[0]) is dict
+        if named:
+            params = {k: v for d in args for k, v in d.items()}
+            where_args = (params,)
+        else:
+            split = head.count("%s")
+            where_args = tuple(args or ())[split:]
+        rows = DB.__execute(db, CRUD.READ, True, f"SELECT {', '.join(keys)} FROM {table} WHERE {where}",
+                            where_args).rows
+        if not rows:
+            return []
+        if named:
+            for i, row in enumerate(rows):
+                params.update((f"_row{i}_{key}", value) for key, value in zip(keys, row))
+            matches = [" AND ".join(f"{key} = %(_row{i}_{key})s" for key in keys) for i in range(len(rows))]
+            args = (params,)
+        else:
+            matches = [" AND ".join(f"{key} = %s" for key in keys)] * len(rows)
+            args = tuple(args or ())[:split] + tuple(value for row in rows for value in row)
+        return [(False, f"{head} WHERE ({') OR ('.join(matches)})", args)]
+
+    @staticmethod
+    def _replicate(op, isMany, queryString, args):
+        # repeats a write to a replicated table (DB_SHARD_REPLICATED, IS601_Stocks by default) on
+        # DB_URL and every shard other than the one it ran on, each commits on its own
+        config = DB.getConfig()
+        index = DB._shard.get()
+        done = {config.url if index is None else config.shard_urls[index]}
+        failed = []
+        for url, pool in [(config.url, DB.getPool()), *zip(config.shard_urls, DB.getShards())]:
+            if url in done:
+                continue
+            done.add(url)
+            DB.chargeBudget()
+            start = time.perf_counter()
+            error = None
+            try:
+                db = pool.acquire()
+            except (Error, DBUnavailableError) as e:
+                failed.append(f"{url.split('@')[-1]} ({e})")
+                continue
+            try:
+                response = DB.__execute(db, op, isMany, queryString, args)
+                DB.getStats().record(queryString, time.perf_counter() - start,
+                                     rows_affected=response.rows_affected, args=args)
+            except Error as e:
+                error = e
+                DB.getStats().record(queryString, time.perf_counter() - start, error=True, args=args)
+                failed.append(f"{url.split('@')[-1]} ({e})")
+            finally:
+                DB._release(pool, db, error)
+        if failed:
+            print(f"Error replicating {QueryStats.fingerprint(queryString)} to {', '.join(failed)}")
+            raise Exception(f"Write wasn't replicated to {', '.join(failed)}")
+
+    @staticmethod
+    def stickToPrimary():
+        # reads for the rest of the request (or context outside of one) go to the primary
+        request_g = DB._requestG()
+        if request_g is not None:
+            request_g._db_wrote = True
+        else:
+            DB._wrote.set(True)
+
+    @staticmethod
+    def wrote():
+        request_g = DB._requestG()
+        if request_g is not None:
+            return getattr(request_g, "_db_wrote", False)
+        return DB._wrote.get()
+
+    @staticmethod
+    def _requestG():
+        try:
+            from flask import g, has_app_context
+        except ImportError:
+            return None
+        return g if has_app_context() else None
+
+    @staticmethod
+    def _lostConnection(e):
+        # MySQL server has gone away / lost connection, don't hand this one out again
+        return DB._errno(e) in (2006, 2013, 2055)
+
+    @staticmethod
+    def _connectionFailure(e):
+        # lost connection or couldn't connect at all (can't connect / unknown host)
+        return DB._errno(e) in (2002, 2003, 2005, 2006, 2013, 2055)
+
+    @staticmethod
+    def _errno(e):
+        # (__runQuery re-raises driver errors wrapped in a plain Exception)
+        for err in (e, e.args[0] if e.args else None, e.__cause__, e.__context__):
+            if isinstance(err, Error) and getattr(err, "errno", None) is not None:
+                return err.errno
+        return None
+
+    @staticmethod
+    @contextmanager
+    def deadline(seconds):
+        # with DB.deadline(2): selects in the block share a 2 second budget, each one's timeout is
+        # what's left of it (nested blocks can only shorten it)
+        deadline = time.monotonic() + seconds
+        current = DB._deadline.get()
+        token = DB._deadline.set(deadline if current is None else min(current, deadline))
+        try:
+            yield
+        finally:
+            DB._deadline.reset(token)
+
+    @staticmethod
+    def requestDeadline(seconds):
+        # budget for the selects of the rest of the current flask request (set from before_request)
+        request_g = DB._requestG()
+        if request_g is None:
+            raise Exception("DB.requestDeadline() needs a request, use DB.deadline() instead")
+        request_g._db_deadline = time.monotonic() + seconds
+
+    @staticmethod
+    def _timeout(timeout):
+        # seconds a select may still run: its own timeout capped by the deadlines, None if unbounded
+        deadlines = [DB._deadline.get()]
+        request_g = DB._requestG()
+        if request_g is not None:
+            deadlines.append(getattr(request_g, "_db_deadline", None))
+        deadlines = [d for d in deadlines if d is not None]
+        if deadlines:
+            remaining = min(deadlines) - time.monotonic()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is not None and timeout <= 0:
+            raise DBTimeoutError("Query deadline passed before the query started")
+        return timeout
+
+    @staticmethod
+    def _timeoutHint(db, queryString, timeout):
+        # MySQL stops a select running past MAX_EXECUTION_TIME (ms), rounded down to one of
+        # TIMEOUT_BUCKETS so a shrinking deadline doesn't turn one query into many prepared statements
+        # (longer than the last bucket is left to the socket backstop)
+        if timeout is None or isinstance(db, SQLiteConnection) or timeout * 1000 > DB.TIMEOUT_BUCKETS[-1]:
+            return queryString
+        ms = DB.TIMEOUT_BUCKETS[max(bisect.bisect_right(DB.TIMEOUT_BUCKETS, timeout * 1000) - 1, 0)]
+        return DB.SELECT.sub(lambda m: f"{m.group(0)} /*+ MAX_EXECUTION_TIME({ms}) */", queryString, count=1)
+
+    @staticmethod
+    @contextmanager
+    def _statementTimeout(db, timeout):
+        if timeout is None:
+            yield
+            return
+        if isinstance(db, SQLiteConnection):
+            db.set_timeout(timeout)
+            try:
+                yield
+            finally:
+                db.set_timeout(None)
+            return
+        # backstop for the hint: a read timeout on the socket for a server that stops answering
+        # (pure python driver only, the socket is dropped with the connection when it fires)
+        sock = getattr(db, "_socket", None)
+        if sock is None or not hasattr(sock, "set_connection_timeout"):
+            yield
+            return
+        sock.set_connection_timeout(timeout + DB.TIMEOUT_GRACE)
+        try:
+            yield
+        finally:
+            sock.set_connection_timeout(None)
+
+    @staticmethod
+    def _timedOut(e, start, remaining):
+        # server side timeout, or the socket timeout firing (reported as a lost connection): a lost
+        # connection only counts once the time was actually up, a stale pooled connection dropping
+        # right away is retried like without a timeout
+        # start: time.perf_counter() when the statement was sent (None if it never was)
+        if remaining is None:
+            return False
+        if DB._errno(e) in DB.TIMEOUT_ERRNOS:
+            return True
+        return DB._lostConnection(e) and start is not None and time.perf_counter() - start >= remaining
+
+    @staticmethod
+    def _retryRead(e, attempt):
+        # sleeps and returns True when a read that failed this way should be tried again
+        config = DB.getConfig()
+        if attempt >= config.read_retries or not DB._connectionFailure(e):
+            return False
+        delay = config.backoff(attempt)
+        print(f"db.py retrying read in {delay:.3f}s after {e}")
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        # with DB.transaction(): pins one connection for every DB call inside the block and commits
+        # them together at the end (rolled back if the block raises), nested blocks join the outer one
+        transaction = DB._transaction.get()
+        if transaction is not None:
+            yield transaction.db
+            return
+        DB.stickToPrimary()
+        pool = DB.writePool()
+        db = pool.acquire()
+        transaction = Transaction(db)
+        token = DB._transaction.set(transaction)
+        error = None
+        discard = False
+        try:
+            db.start_transaction()
+            yield db
+            db.commit()
+        except BaseException as e:
+            error = e
+            # rows read inside the block may be ones that are being rolled back
+            IdentityMap.clear()
+            try:
+                db.rollback()
+            except Exception as rollback_error:
+                print("Rollback failed", rollback_error)
+                discard = True
+            raise
+        finally:
+            DB._transaction.reset(token)
+            DB._release(pool, db, error, discard=discard)
+            if transaction.tables:
+                DB.getResultCache().invalidate(frozenset(transaction.tables))
+        for op, isMany, queryString, args in transaction.replicate:
+            DB._replicate(op, isMany, queryString, args)
+
+    @staticmethod
+    def warmPool(count=None):
+        return DB.getPool().warm(count)
+
+    @staticmethod
+    def poolStats():
+        return DB.getPool().stats()
+
+    @staticmethod
+    def replicaStats():
+        return [dict(pool.stats(), url=url.split("@")[-1])
+                for url, pool in zip(DB.getConfig().replica_urls, DB.getReplicas())]
+
+    @staticmethod
+    def shardStats():
+        return [dict(pool.stats(), url=url.split("@")[-1])
+                for url, pool in zip(DB.getConfig().shard_urls, DB.getShards())]
+
+    @staticmethod
+    def reset():
+        # closes and forgets the pool, caches and stats so the next query re-reads the environment
+        # (used by tests/benchmarks switching DB_URL)
+        with DB._pool_lock:
+            db, pool, replicas, shards, executor = DB.db, DB.pool, DB.replicas, DB.shards, DB.executor
+            DB.config = DB.db = DB.pool = DB.replicas = DB.stats = DB.results = DB.executor = DB.max_packet = None
+            DB.shards = DB.budget = DB.nplusone = None
+        for p in [pool, *(replicas or []), *(shards or [])]:
+            if p is not None:
+                p.close()
+        if db is not None:
+            try:
+                db.close()
+            except Exception:
+                pass
+        if executor is not None:
+            executor.shutdown(wait=True)
+        SQLiteConnection.drop_memory()
+        DB._wrote.set(False)
+
+    @staticmethod
+    def _connectShard(index, url, connect_args):
+        db = DB._connect(url, connect_args)
+        cursor = db.cursor()
+        try:
+            cursor.execute(f"SET SESSION auto_increment_increment = {len(DB.getConfig().shard_urls)}, "
+                           f"auto_increment_offset = {index + 1}")
+        finally:
+            cursor.close()
+        return db
+
+    @staticmethod
+    def _connect(url=None, connect_args=None):
+        # the primary by default, replicas pass their own url/connect_args
+        config = DB.getConfig()
+        if url is None:
+            url, connect_args = config.url, config.connect_args
+        if url and url.startswith("sqlite:"):
+            # in-process SQLite for tests/benchmarks, see sql/sqlite_db.py
+            return SQLiteConnection.connect(url)
+        if connect_args is None:
+            raise Exception("Invalid connection string")
+        try:
+            return drivers.connect(config.driver, connect_args, compress=config.compress, buffered=config.buffered)
+        except Error as e:
+            print("Error while connecting to MySQL", e)
+            raise e
 
 if __name__ == "__main__":
     # verifies connection works
@@ -0,0 +1,196 @@
+# MySQL driver backends for DB, picked with DB_DRIVER:
+#   connector       mysql-connector-python using its C extension when it's installed (default)
+#   connector-pure  mysql-connector-python's pure python implementation
+#   pymysql         PyMySQL
+#   mysqlclient     mysqlclient (MySQLdb)
+# DB_COMPRESS=1 turns on protocol compression (helps large results over slow links, costs CPU)
+# DB_BUFFERED=1 makes mysql.connector's plain (non-prepared) cursors read whole results up front,
+#   PyMySQL/mysqlclient cursors always do (DB.selectIter() still streams with all of them)
+# PyMySQL/mysqlclient connections are wrapped in the parts of mysql.connector's interface that
+# sql/db.py uses, like sqlite_db.py does for SQLite
+import importlib
+import weakref
+
+try:
+    from sql.sqlite_db import SQLiteError
+except ImportError:  # scripts run from inside sql/ (e.g., init_db.py)
+    from sqlite_db import SQLiteError
+try:
+    import mysql.connector
+    from mysql.connector import Error
+except ImportError:
+    mysql = None
+    Error = SQLiteError
+
+DRIVERS = ["connector", "connector-pure", "pymysql", "mysqlclient"]
+
+
+def connect(driver, connect_args, compress=False, buffered=False):
+    # connect_args: DBConfig.connectArgs() (mysql.connector's keyword arguments)
+    if driver in ("connector", "connector-pure"):
+        if mysql is None:
+            raise Exception("mysql-connector-python is required for DB_DRIVER=" + driver)
+        return mysql.connector.connect(**connect_args, use_pure=driver == "connector-pure",
+                                       compress=compress, buffered=buffered)
+    if driver == "pymysql":
+        pymysql = _module("pymysql", "PyMySQL")
+        from pymysql.constants import CLIENT
+        if compress:
+            print("PyMySQL doesn't support compression, DB_COMPRESS is ignored")
+        conn = pymysql.connect(
+            host=connect_args["host"], user=connect_args["user"], password=connect_args["password"],
+            database=connect_args["database"], port=connect_args["port"],
+            autocommit=connect_args.get("autocommit", True),
+            connect_timeout=connect_args.get("connection_timeout", 10),
+            client_flag=CLIENT.MULTI_STATEMENTS)
+        return DBAPIConnection(conn, pymysql, pymysql.cursors.SSCursor, lambda: conn.ping(reconnect=False))
+    if driver == "mysqlclient":
+        MySQLdb = _module("MySQLdb", "mysqlclient")
+        from MySQLdb.constants import CLIENT
+        import MySQLdb.cursors
+        conn = MySQLdb.connect(
+            host=connect_args["host"], user=connect_args["user"], password=connect_args["password"],
+            database=connect_args["database"], port=connect_args["port"],
+            autocommit=connect_args.get("autocommit", True),
+            connect_timeout=connect_args.get("connection_timeout", 10),
+            compress=compress, client_flag=CLIENT.MULTI_STATEMENTS)
+        return DBAPIConnection(conn, MySQLdb, MySQLdb.cursors.SSCursor, conn.ping)
+    raise Exception(f"Unknown DB_DRIVER {driver}, expected one of {', '.join(DRIVERS)}")
+
+
+def _module(name, package):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise Exception(f"{package} is required for DB_DRIVER={name.lower()}")
+
+
+def _error(e):
+    # driver errors are raised as mysql.connector errors so DB's error handling works the same
+    errno = e.args[0] if e.args and isinstance(e.args[0], int) else None
+    msg = e.args[1] if len(e.args) > 1 else str(e)
+    return Error(msg=msg, errno=errno)
+
+
+class DBAPICursor:
+    def __init__(self, connection, cursor, module):
+        # weak like mysql.connector's cursors, otherwise cached cursors keep their connection alive
+        self._connection = weakref.proxy(connection)
+        self._cursor = cursor
+        self._module = module
+        self.column_names = ()
+        self.rowcount = -1
+        self.lastrowid = None
+        self.with_rows = False
+
+    def execute(self, operation, params=None, multi=False):
+        try:
+            if params:
+                self._cursor.execute(operation, params)
+            else:
+                # without params nothing is interpolated so a literal % stays as is
+                self._cursor.execute(operation)
+        except self._module.Error as e:
+            raise _error(e) from e
+        self._after_execute()
+        if multi:
+            return self._results()
+
+    def _results(self):
+        # one item per statement like mysql.connector's execute(multi=True)
+        while True:
+            yield self
+            try:
+                if not self._cursor.nextset():
+                    return
+            except self._module.Error as e:
+                raise _error(e) from e
+            self._after_execute()
+
+    def executemany(self, operation, seq_params=()):
+        try:
+            self._cursor.executemany(operation, seq_params)
+        except self._module.Error as e:
+            raise _error(e) from e
+        self._after_execute()
+
+    def _after_execute(self):
+        description = self._cursor.description
+        self.column_names = tuple(d[0] for d in description) if description else ()
+        self.with_rows = description is not None
+        self.rowcount = self._cursor.rowcount
+        self.lastrowid = self._cursor.lastrowid
+        self._connection._last_insert_id = self.lastrowid or 0
+
+    def _fetch(self, fetch, *args):
+        try:
+            return fetch(*args)
+        except self._module.Error as e:
+            raise _error(e) from e
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=1):
+        return list(self._fetch(self._cursor.fetchmany, size))
+
+    def fetchall(self):
+        return list(self._fetch(self._cursor.fetchall))
+
+    def close(self):
+        self._cursor.close()
+
+
+class DBAPIConnection:
+    def __init__(self, conn, module, unbuffered_cursor, ping):
+        self._conn = conn
+        self._module = module
+        self._unbuffered_cursor = unbuffered_cursor
+        self._ping = ping
+        self._last_insert_id = 0
+
+    def cursor(self, prepared=False, dictionary=False, buffered=None, **kwargs):
+        # no server side prepared statements here, the driver escapes the values into the sql
+        if buffered is False:
+            return DBAPICursor(self, self._conn.cursor(self._unbuffered_cursor), self._module)
+        return DBAPICursor(self, self._conn.cursor(), self._module)
+
+    @property
+    def autocommit(self):
+        return self._conn.get_autocommit()
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._conn.autocommit(value)
+
+    def start_transaction(self):
+        self._conn.begin()
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def is_connected(self):
+        try:
+            self._ping()
+            return True
+        except Exception:
+            return False
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        try:
+            self._ping()
+        except self._module.Error as e:
+            raise _error(e) from e
+
+    def fetch_eof_status(self):
+        return {"insert_id": self._last_insert_id}
+
+    def handle_unread_result(self, prepared=False):
+        # buffered cursors have already read the whole result
+        pass
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,388 @@
+# In-process SQLite stand-in for MySQL so tests and benchmarks can run without a server
+# DB_URL examples:
+#   sqlite://                  shared in-memory database (lives as long as the process)
+#   sqlite://shard1            another shared in-memory database, by name (e.g., for DB_SHARD_URLS)
+#   sqlite:///is601.db         file relative to the working directory
+#   sqlite:////tmp/is601.db    absolute path
+# The connection/cursor classes mimic the parts of mysql.connector that sql/db.py uses and
+# translate the MySQL flavored SQL the app writes (%s placeholders, ON DUPLICATE KEY UPDATE, etc.)
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+
+try:
+    from mysql.connector import Error
+except ImportError:
+    Error = None
+
+SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SQLiteError(Exception):
+    # mirrors mysql.connector.Error's msg/errno so DB's error handling works the same
+    def __init__(self, msg=None, errno=None):
+        super().__init__(msg)
+        self.msg = msg
+        self.errno = errno
+
+
+# MySQL's ER_QUERY_TIMEOUT, statements stopped by SQLiteConnection.set_timeout() report it too
+QUERY_TIMEOUT = 3024
+
+
+def _error(e):
+    errno = QUERY_TIMEOUT if isinstance(e, sqlite3.OperationalError) and str(e) == "interrupted" else None
+    if Error is not None:
+        return Error(msg=str(e), errno=errno)
+    return SQLiteError(msg=str(e), errno=errno)
+
+
+# -- type conversion (MySQL hands back Decimal/date/datetime so SQLite should too) --
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(" ", "seconds"))
+sqlite3.register_converter("DECIMAL", lambda b: Decimal(b.decode()))
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode()[:10]))
+sqlite3.register_converter("TIMESTAMP", lambda b: datetime.fromisoformat(b.decode()))
+sqlite3.register_converter("DATETIME", lambda b: datetime.fromisoformat(b.decode()))
+
+
+class _GroupConcat:
+    # MySQL's GROUP_CONCAT(a, b, ...) concatenates its args per row and joins rows with ","
+    # (SQLite's built-in treats a second arg as the separator)
+    def __init__(self):
+        self.values = []
+
+    def step(self, *args):
+        if any(a is None for a in args):
+            return
+        self.values.append("".join(str(a) for a in args))
+
+    def finalize(self):
+        return ",".join(self.values) if self.values else None
+
+
+def _substring_index(value, delim, count):
+    if value is None:
+        return None
+    parts = str(value).split(delim)
+    return delim.join(parts[:count]) if count >= 0 else delim.join(parts[count:])
+
+
+def _register_functions(conn):
+    conn.create_function("CONCAT", -1, lambda *args: None if any(a is None for a in args) else "".join(str(a) for a in args))
+    conn.create_function("NOW", 0, lambda: datetime.now().isoformat(" ", "seconds"))
+    conn.create_function("SUBSTRING_INDEX", 3, _substring_index)
+    conn.create_aggregate("GROUP_CONCAT", -1, _GroupConcat)
+    conn.create_aggregate("GROUP_CONCAT", 2, _GroupConcat)
+
+
+# -- SQL translation --
+STRING = r"'(?:[^'\\]|\\.)*'"
+PLACEHOLDER = re.compile(STRING + r"|%\((\w+)\)s|%s|%%")
+ON_DUPLICATE = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I)
+VALUES_FN = re.compile(r"\bVALUES\s*\(\s*`?(\w+)`?\s*\)", re.I)
+NOT_OP = re.compile(r"!(?!=)\s*")
+IF_FN = re.compile(r"\bIF\s*\(", re.I)
+FROM_DUAL = re.compile(r"\bFROM\s+dual\b", re.I)
+INSERT_IGNORE = re.compile(r"^\s*INSERT\s+IGNORE\b", re.I)
+INSERT = re.compile(r"^\s*(?:INSERT|REPLACE)\b", re.I)
+SHOW_TABLES = re.compile(r"^\s*SHOW\s+TABLES\s*;?\s*$", re.I)
+INSERT_INTO = re.compile(r"^\s*(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO\s+`?(\w+)`?", re.I)
+SET_AUTO_INCREMENT = re.compile(r"^\s*SET\s+(?:SESSION\s+)?auto_increment_increment\s*=\s*(\d+)\s*,"
+                                r"\s*auto_increment_offset\s*=\s*(\d+)\s*;?\s*$", re.I)
+
+
+@lru_cache(maxsize=512)
+def translate(queryString):
+    if SHOW_TABLES.match(queryString):
+        return "SELECT name AS Tables FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+
+    def placeholder(m):
+        token = m.group(0)
+        if token.startswith("'"):
+            return token
+        if token == "%%":
+            return "%"
+        return f":{m.group(1)}" if m.group(1) else "?"
+    sql = PLACEHOLDER.sub(placeholder, queryString)
+    dup = ON_DUPLICATE.search(sql)
+    if dup:
+        update = VALUES_FN.sub(r"excluded.\1", sql[dup.end():])
+        sql = sql[:dup.start()] + "ON CONFLICT DO UPDATE SET" + update
+    sql = INSERT_IGNORE.sub("INSERT OR IGNORE", sql)
+    sql = NOT_OP.sub("NOT ", sql)
+    sql = IF_FN.sub("IIF(", sql)
+    sql = FROM_DUAL.sub("", sql)
+    return sql
+
+
+AUTO_PK = re.compile(r"\bint\s+auto_increment\s+PRIMARY\s+KEY\b", re.I)
+ON_UPDATE_TS = re.compile(r"\s+ON\s+UPDATE\s+CURRENT_TIMESTAMP\b", re.I)
+UNIQUE_KEY = re.compile(r"\bUNIQUE\s+KEY\s+(?:`?\w+`?\s*)?\(", re.I)
+COMMENT = re.compile(r"\s+COMMENT\s+'(?:[^'\\]|\\.)*'", re.I)
+LINE_COMMENT = re.compile(r"--[^\n]*")
+TABLE_CONSTRAINT = re.compile(r"^(?:FOREIGN\s+KEY|UNIQUE|CHECK|PRIMARY\s+KEY|CONSTRAINT)\b", re.I)
+INDEX_DEF = re.compile(r"^(?:KEY|INDEX)\b", re.I)
+CREATE_TABLE = re.compile(r"CREATE\s+TABLE\s+`?(\w+)`?", re.I)
+ADD_COLUMN = re.compile(
+    r"^\s*ALTER\s+TABLE\s+`?(\w+)`?\s+ADD\s+COLUMN\s+`?(\w+)`?\s+(\w+(?:\([^)]*\))?)(.*?);?\s*$", re.I | re.S)
+DEFAULT_EXPR = re.compile(r"\bdefault\s+(\((?:[^()]|\([^()]*\))*\))", re.I)
+
+
+def translate_ddl(sql):
+    # turns the MySQL migrations in sql/*.sql into SQLite statements
+    add = ADD_COLUMN.match(COMMENT.sub("", sql))
+    if add:
+        # SQLite can't add a column that is unique or has an expression default, so emulate both
+        table, column, col_type, rest = add.groups()
+        statements = [f"ALTER TABLE {table} ADD COLUMN {column} {col_type}"]
+        default = DEFAULT_EXPR.search(rest)
+        if default:
+            expr = translate(default.group(1))
+            statements.append(f"UPDATE {table} SET {column} = {expr} WHERE {column} IS NULL")
+            statements.append(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{column}_default AFTER INSERT ON {table} "
+                f"WHEN NEW.{column} IS NULL BEGIN UPDATE {table} SET {column} = {expr} WHERE id = NEW.id; END")
+        if re.search(r"\bunique\b", rest, re.I):
+            statements.append(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{column}_unique ON {table} ({column})")
+        return ";\n".join(statements) + ";"
+    ddl = AUTO_PK.sub("INTEGER PRIMARY KEY AUTOINCREMENT", LINE_COMMENT.sub("", sql))
+    ddl = UNIQUE_KEY.sub("UNIQUE (", ddl)
+    ddl = COMMENT.sub("", ddl)
+    create = CREATE_TABLE.search(ddl)
+    if create:
+        ddl = _constraints_last(ddl)
+    if create and ON_UPDATE_TS.search(ddl):
+        # ON UPDATE CURRENT_TIMESTAMP becomes a trigger (recursive triggers are off so it won't loop)
+        table = create.group(1)
+        ddl = ON_UPDATE_TS.sub("", ddl).rstrip().rstrip(";") + ";\n" + \
+            f"CREATE TRIGGER IF NOT EXISTS {table}_modified AFTER UPDATE ON {table} " \
+            f"BEGIN UPDATE {table} SET modified = CURRENT_TIMESTAMP WHERE id = NEW.id; END;"
+    return translate(ddl)
+
+
+def _split_top_level(body):
+    parts, depth, current = [], 0, ""
+    for ch in body:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += ch
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def _constraints_last(ddl):
+    # MySQL lets table constraints sit between columns, SQLite wants them after the last column
+    start = ddl.index("(")
+    end = ddl.rindex(")")
+    columns, constraints = [], []
+    for part in _split_top_level(ddl[start + 1:end]):
+        if TABLE_CONSTRAINT.match(part):
+            constraints.append(part)
+        elif not INDEX_DEF.match(part):  # plain KEY/INDEX definitions are dropped
+            columns.append(part)
+    return ddl[:start + 1] + "\n        " + ",\n        ".join(columns + constraints) + "\n    " + ddl[end:]
+
+
+def load_schema(conn, sql_dir=SQL_DIR):
+    # runs the migrations in prefix order, same as init_db.py
+    for f in sorted(glob.glob(glob.escape(sql_dir) + "/*.sql"), key=lambda x: x.lower()):
+        with open(f, "r") as file:
+            conn.executescript(translate_ddl(file.read()))
+
+
+class SQLiteCursor:
+    def __init__(self, connection, dictionary=False):
+        # weak like mysql.connector's cursors, otherwise cached cursors keep their connection alive
+        self._connection = weakref.proxy(connection)
+        self._cursor = connection._conn.cursor()
+        self._dictionary = dictionary
+        self.column_names = ()
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, operation, params=None, multi=False):
+        self._operation = operation
+        auto_increment = SET_AUTO_INCREMENT.match(operation)
+        if auto_increment:
+            # MySQL's per session id spacing (used by DB's shards), applied to inserts in _after_execute()
+            self._connection._auto_increment = tuple(int(v) for v in auto_increment.groups())
+            self.column_names, self.rowcount, self.lastrowid, self.with_rows = (), 0, 0, False
+            return
+        sql = translate(operation)
+        try:
+            if params is None or len(params) == 0:
+                try:
+                    self._cursor.execute(sql)
+                except (sqlite3.ProgrammingError, sqlite3.Warning) as e:
+                    if "one statement" not in str(e):
+                        raise
+                    # files like the migrations can hold more than one statement
+                    self._cursor.executescript(sql)
+            else:
+                self._cursor.execute(sql, params)
+        except sqlite3.Error as e:
+            raise _error(e) from e
+        self._after_execute()
+
+    def executemany(self, operation, seq_params=()):
+        self._operation = operation
+        try:
+            self._cursor.executemany(translate(operation), seq_params)
+        except sqlite3.Error as e:
+            raise _error(e) from e
+        self._after_execute()
+
+    def _after_execute(self):
+        description = self._cursor.description
+        self.column_names = tuple(d[0] for d in description) if description else ()
+        self.rowcount = self._cursor.rowcount
+        # like MySQL's insert_id, only inserts report a generated id
+        self.lastrowid = self._cursor.lastrowid if INSERT.match(self._operation) else 0
+        if self.lastrowid and self._connection._auto_increment and self.rowcount == 1 \
+                and not ON_DUPLICATE.search(self._operation):
+            self.lastrowid = self._space_id(self.lastrowid)
+        self._connection._last_insert_id = self.lastrowid or 0
+        self.with_rows = description is not None
+
+    def _space_id(self, rowid):
+        # moves the new row to the next id matching auto_increment_increment/offset, later
+        # inserts continue after it like they do in MySQL
+        increment, offset = self._connection._auto_increment
+        if increment <= 1 or (rowid - offset) % increment == 0:
+            return rowid
+        new_id = rowid + (offset - rowid) % increment
+        table = INSERT_INTO.match(self._operation).group(1)
+        self._cursor.execute(f"UPDATE {table} SET id = ? WHERE rowid = ?", (new_id, rowid))
+        return new_id
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip(self.column_names, row))
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        rows = self._cursor.fetchmany(size)
+        return [self._row(r) for r in rows] if self._dictionary else rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        return [self._row(r) for r in rows] if self._dictionary else rows
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    # shared in-memory databases disappear with their last connection, one extra is kept open per url
+    _anchors = {}
+    _schema_lock = threading.Lock()
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._closed = False
+        self._autocommit = True
+        self._last_insert_id = 0
+        self._auto_increment = None  # (increment, offset) after SET auto_increment_increment = ...
+
+    @staticmethod
+    def connect(db_url):
+        path = db_url[len("sqlite:"):].lstrip("/") if db_url.startswith("sqlite:///") else ""
+        if db_url.startswith("sqlite:////"):
+            path = "/" + path
+        if path in ("", ":memory:"):
+            name = db_url[len("sqlite://"):] if db_url.startswith("sqlite://") and path == "" else ""
+            target, uri = f"file:{name or 'is601'}?mode=memory&cache=shared", True
+        else:
+            target, uri = path, False
+        conn = sqlite3.connect(target, uri=uri, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        _register_functions(conn)
+        with SQLiteConnection._schema_lock:
+            if uri and target not in SQLiteConnection._anchors:
+                SQLiteConnection._anchors[target] = conn
+                conn = sqlite3.connect(target, uri=uri, isolation_level=None, check_same_thread=False,
+                                       detect_types=sqlite3.PARSE_DECLTYPES)
+                _register_functions(conn)
+            tables = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+            if tables == 0:
+                load_schema(conn)
+        return SQLiteConnection(conn)
+
+    @staticmethod
+    def drop_memory():
+        # forgets the shared in-memory databases (used between tests)
+        with SQLiteConnection._schema_lock:
+            anchors = list(SQLiteConnection._anchors.values())
+            SQLiteConnection._anchors = {}
+        for conn in anchors:
+            conn.close()
+
+    def cursor(self, prepared=False, dictionary=False, buffered=None, **kwargs):
+        return SQLiteCursor(self, dictionary=dictionary)
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._autocommit = bool(value)
+        # sqlite3 opens a transaction before the next write when isolation_level isn't None
+        self._conn.isolation_level = None if value else "DEFERRED"
+
+    def start_transaction(self):
+        self._conn.execute("BEGIN")
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def is_connected(self):
+        return not self._closed
+
+    def set_timeout(self, seconds):
+        # stand-in for MAX_EXECUTION_TIME: statements are interrupted once seconds have passed (None to clear)
+        if seconds is None:
+            self._conn.set_progress_handler(None, 0)
+            return
+        deadline = time.monotonic() + seconds
+        self._conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if self._closed:
+            raise _error("SQLite connection is closed")
+
+    def fetch_eof_status(self):
+        return {"insert_id": self._last_insert_id}
+
+    def handle_unread_result(self, prepared=False):
+        pass
+
+    def close(self):
+        self._closed = True
+        self._conn.close()
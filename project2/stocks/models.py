@@ -17,7 +17,7 @@ class Stock(JsonSerializable):
         self.latest_trading_day = latest_trading_day
         self.previous_close = previous_close
         self.change = change
-        self.change_percent = Decimal(change_percent)
+        self.change_percent = change_percent if isinstance(change_percent, Decimal) else Decimal(change_percent)
         self.created = created
         self.modified = modified
         self.shares = shares if shares is not None else 1
@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+# make the project modules importable when running pytest from any folder
+CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, ".."))
+
+
+@pytest.fixture()
+def sqlite_db(monkeypatch):
+    # fresh in-memory SQLite database with the sql/*.sql schema loaded, no MySQL needed
+    # set TEST_DB_URL to run against a real database instead
+    from sql.db import DB
+    monkeypatch.setenv("DB_URL", os.environ.get("TEST_DB_URL", "sqlite://"))
+    DB.reset()
+    yield DB
+    DB.reset()
+
+
+@pytest.fixture()
+def nplusone(sqlite_db):
+    # fails the test with NPlusOneError when a statement shape runs more than
+    # DB_NPLUSONE_THRESHOLD (default 5) times, known shapes can be listed in DB_NPLUSONE_ALLOW
+    with sqlite_db.nPlusOneScope(strict=True):
+        yield sqlite_db
+
+
+@pytest.fixture()
+def sharded_db(monkeypatch):
+    # broker data over two shards next to the primary, in-memory SQLite by default, set TEST_DB_URL
+    # and TEST_DB_SHARD_URLS (comma separated mysql:// urls of local databases set up by sql/init_db.py)
+    # to use MySQL
+    from sql.db import DB
+    monkeypatch.setenv("DB_URL", os.environ.get("TEST_DB_URL", "sqlite://"))
+    monkeypatch.setenv("DB_SHARD_URLS", os.environ.get("TEST_DB_SHARD_URLS", "sqlite://shard0,sqlite://shard1"))
+    DB.reset()
+    yield DB
+    DB.reset()
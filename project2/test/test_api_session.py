@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from sql.db import DB
+from utils.api import API, RateLimitExceeded
+
+
+class QuoteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    statuses = []  # statuses to answer with before a 200
+    headers = {}
+    connections = set()
+    requests = 0
+
+    def do_GET(self):
+        QuoteHandler.requests += 1
+        QuoteHandler.connections.add(self.client_address)
+        status = QuoteHandler.statuses.pop(0) if QuoteHandler.statuses else 200
+        body = json.dumps({"symbol": "MSFT"} if status == 200 else {"error": status}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in QuoteHandler.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def api(monkeypatch, sqlite_db, tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QuoteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    QuoteHandler.statuses, QuoteHandler.headers, QuoteHandler.connections, QuoteHandler.requests = [], {}, set(), 0
+    monkeypatch.setenv("TEST_API_BASE_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setenv("TEST_API_RETRY_BACKOFF", "0")
+    monkeypatch.setenv("TEST_API_RATE_FILE", str(tmp_path / "ratelimit"))
+    API.reset()
+    yield API
+    API.reset()
+    server.shutdown()
+    server.server_close()
+
+
+def test_calls_reuse_one_connection(api):
+    for _ in range(3):
+        assert API.get("/query", {}, API_REF="TEST_API") == {"symbol": "MSFT"}
+    assert QuoteHandler.requests == 3
+    assert len(QuoteHandler.connections) == 1
+
+
+def test_5xx_is_retried(api):
+    QuoteHandler.statuses = [500, 503]
+    assert API.get("/query", {}, API_REF="TEST_API") == {"symbol": "MSFT"}
+    assert QuoteHandler.requests == 3
+
+
+def test_429_blocks_the_bucket_instead_of_retrying(api):
+    QuoteHandler.statuses = [429]
+    QuoteHandler.headers = {"Retry-After": "3600"}
+    assert API.get("/query", {}, API_REF="TEST_API") == {"error": 429}
+    assert QuoteHandler.requests == 1
+    with pytest.raises(RateLimitExceeded) as e:
+        API.get("/query", {}, API_REF="TEST_API")
+    assert 3590 <= e.value.retry_after <= 3600
+    assert QuoteHandler.requests == 1
+
+
+def test_last_error_response_is_returned_after_the_retries(api, monkeypatch):
+    monkeypatch.setenv("TEST_API_RETRIES", "1")
+    QuoteHandler.statuses = [500, 502]
+    assert API.get("/query", {}, API_REF="TEST_API") == {"error": 502}
+    assert QuoteHandler.requests == 2
+
+
+def test_rate_limit_is_checked_without_the_database(api, monkeypatch):
+    monkeypatch.setenv("TEST_API_RATE_CAPACITY", "2")
+    DB.getStats().reset()
+    API.get("/query", {}, API_REF="TEST_API")
+    API.get("/query", {}, API_REF="TEST_API")
+    with pytest.raises(RateLimitExceeded):
+        API.get("/query", {}, API_REF="TEST_API")
+    assert QuoteHandler.requests == 2
+    # only the state restore when the bucket was created
+    assert sum(q["count"] for q in DB.queryStats()) == 1
+
+
+def test_headers_sync_the_bucket_and_are_saved_at_intervals(api, monkeypatch):
+    monkeypatch.setenv("TEST_API_RATE_PERSIST_INTERVAL", "0")
+    QuoteHandler.headers = {"x-ratelimit-requests-limit": "100", "x-ratelimit-requests-remaining": "0",
+                            "x-ratelimit-requests-reset": "30"}
+    API.get("/query", {}, API_REF="TEST_API")
+    with pytest.raises(RateLimitExceeded) as e:
+        API.get("/query", {}, API_REF="TEST_API")
+    assert 29 <= e.value.retry_after <= 30
+    saved = DB.selectOne("SELECT value FROM IS601_System_Properties WHERE name = %s", "TEST_API_RATE_REMAINING")
+    assert saved.row["value"] == "0"
+    # a restarted server (new bucket file) is still blocked until the saved reset time
+    monkeypatch.setenv("TEST_API_RATE_FILE", os.environ["TEST_API_RATE_FILE"] + "2")
+    API.reset()
+    assert not API._is_eligible_to_fetch("TEST_API")
+
+
+def test_saved_rate_limit_is_restored_outside_the_lock(api, monkeypatch):
+    locked = []
+    monkeypatch.setattr(API, "_restore_rate_limit", lambda API_REF, limiter: locked.append(API._session_lock.locked()))
+    API.getLimiter("TEST_API")
+    API.getLimiter("TEST_API")
+    assert locked == [False]
@@ -0,0 +1,22 @@
+import time
+from sql.db import DB, DBResponse
+
+
+def test_gather_runs_independent_queries_concurrently(monkeypatch):
+    def slow_select(queryString, *args, cache=False, row_format="dict", timeout=None):
+        time.sleep(0.2)
+        return DBResponse(status=True, row={"query": queryString, "args": args})
+    monkeypatch.setattr(DB, "selectOne", staticmethod(slow_select))
+    monkeypatch.setattr(DB, "selectAll", staticmethod(slow_select))
+    start = time.perf_counter()
+    one, two, three = DB.gather(
+        DB.aselectOne("SELECT 1"),
+        DB.aselectAll("SELECT 2", 5),
+        DB.aselectOne("SELECT 3"),
+    )
+    elapsed = time.perf_counter() - start
+    # results keep the order they were passed in
+    assert [one.row["query"], two.row["query"], three.row["query"]] == ["SELECT 1", "SELECT 2", "SELECT 3"]
+    assert two.row["args"] == (5,)
+    # closer to the slowest query than the sum of all three
+    assert elapsed < 0.5
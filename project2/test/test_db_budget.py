@@ -0,0 +1,43 @@
+from sql.db import DB, DBBudgetExceededError, QueryBudget
+
+
+def test_report_ranks_endpoints_by_quota_used():
+    budget = QueryBudget(quota=100)
+    for request in range(2):
+        for n in range(1, 4):
+            budget.charge("brokers.view", n)
+        budget.charge("load_user", 1)
+    budget.charge("-")
+    report = budget.report()
+    assert report["used"] == 9 and report["remaining"] == 91
+    top = report["endpoints"][0]
+    assert top["endpoint"] == "brokers.view"
+    assert (top["queries"], top["requests"], top["per_request_avg"], top["per_request_max"]) == (6, 2, 3.0, 3)
+    assert [e["endpoint"] for e in report["endpoints"]] == ["brokers.view", "load_user", "-"]
+
+
+def test_shed_mode_refuses_queries_until_the_window_slides(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("sql.db.time.time", lambda: now[0])
+    budget = QueryBudget(quota=2, window=120, mode="shed")
+    budget.charge("a")
+    budget.charge("a")
+    try:
+        budget.charge("a")
+        assert False, "expected the quota to be used up"
+    except DBBudgetExceededError:
+        pass
+    assert budget.report()["shed"] == 1
+    now[0] += 180
+    budget.charge("a")
+    assert budget.report()["used"] == 1
+
+
+def test_queries_are_charged_to_the_budget_label(sqlite_db):
+    with DB.budgetLabel("load_user"):
+        DB.selectOne("SELECT 1 as one")
+        DB.selectOne("SELECT 1 as one", cache=True)
+        # served from the result cache, nothing is sent
+        DB.selectOne("SELECT 1 as one", cache=True)
+    endpoints = {e["endpoint"]: e["queries"] for e in DB.budgetReport()["endpoints"]}
+    assert endpoints == {"load_user": 2}
@@ -0,0 +1,73 @@
+import sqlite3
+from sql import drivers
+from sql.db import DBConfig, Error
+
+
+def test_unknown_driver_is_rejected():
+    try:
+        drivers.connect("odbc", DBConfig.parseUrl("mysql://u:p@localhost:3306/db"))
+        assert False, "expected an error"
+    except Exception as e:
+        assert "Unknown DB_DRIVER odbc" in str(e)
+
+
+def test_dbapi_connections_look_like_mysql_connector():
+    # sqlite3 is a DB-API 2 module like PyMySQL/MySQLdb so it can stand in for them here
+    raw = sqlite3.connect(":memory:", isolation_level=None)
+    conn = drivers.DBAPIConnection(raw, sqlite3, sqlite3.Cursor, lambda: raw.execute("SELECT 1"))
+    cursor = conn.cursor(prepared=True)
+    cursor.execute("CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)")
+    cursor.execute("INSERT INTO t (name) VALUES (?)", ("a",))
+    assert conn.fetch_eof_status()["insert_id"] == 1
+    cursor.execute("SELECT id, name FROM t")
+    assert cursor.column_names == ("id", "name")
+    assert cursor.fetchall() == [(1, "a")]
+    assert conn.is_connected()
+    try:
+        cursor.execute("SELECT nope FROM t")
+        assert False, "expected an error"
+    except Error as e:
+        assert "nope" in str(e)
+    conn.close()
+    assert not conn.is_connected()
+
+
+def test_connector_pure_runs_queries(monkeypatch):
+    # mysql.connector's pure python connection class (its handle_unread_result() etc.) with the
+    # statements themselves run on SQLite since there's no MySQL server here
+    from mysql.connector.connection import MySQLConnection
+    from sql.db import DB
+    from sql.sqlite_db import SQLiteConnection
+
+    class PureConnection(MySQLConnection):
+        def __init__(self):
+            super().__init__()
+            self._sqlite = SQLiteConnection.connect("sqlite://pure")
+
+        def cursor(self, *args, **kwargs):
+            return self._sqlite.cursor(**kwargs)
+
+        def is_connected(self):
+            return True
+
+        def ping(self, *args, **kwargs):
+            pass
+
+        def close(self):
+            self._sqlite.close()
+    connects = []
+    monkeypatch.setattr("mysql.connector.connect", lambda **kwargs: connects.append(kwargs) or PureConnection())
+    monkeypatch.setenv("DB_URL", "mysql://u:p@localhost:3306/db")
+    monkeypatch.setenv("DB_DRIVER", "connector-pure")
+    DB.reset()
+    try:
+        assert DB.selectOne("SELECT 1 as one").row == {"one": 1}
+        assert DB.selectAll("SELECT 1 as one", timeout=5).rows == [{"one": 1}]
+        assert connects[0]["use_pure"] is True
+        assert DB.insertOne("INSERT INTO IS601_Sample (name, val) VALUES (%s, 'v')", "a").insert_id == 1
+        assert DB.insertOne("INSERT INTO IS601_Sample (name, val) VALUES (%s, 'v')", "b").insert_id == 2
+        assert DB.update("UPDATE IS601_Sample SET name = %s WHERE id = %s", "c", 2).rows_affected == 1
+        assert DB.delete("DELETE FROM IS601_Sample WHERE id = %s", 1).rows_affected == 1
+        assert DB.selectAll("SELECT name FROM IS601_Sample").rows == [{"name": "c"}]
+    finally:
+        DB.reset()
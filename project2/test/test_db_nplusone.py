@@ -0,0 +1,55 @@
+import pytest
+from flask import Flask
+from sql.db import DB, NPlusOneError
+
+
+def load_each(ids):
+    return [DB.selectOne("SELECT * FROM IS601_Stocks WHERE id = %s", i) for i in ids]
+
+
+def test_a_query_in_a_loop_fails_the_test(nplusone):
+    with pytest.raises(NPlusOneError) as e:
+        load_each(range(1, 10))
+    assert "SELECT * FROM IS601_Stocks WHERE id = ?" in str(e.value)
+    # the stack points at the loop, not at db.py
+    assert "load_each" in str(e.value) and "db.py" not in str(e.value)
+
+
+def test_one_query_for_the_list_passes(nplusone):
+    clause, params = DB.inClause("id", range(1, 10))
+    for _ in range(3):
+        DB.selectAll(f"SELECT * FROM IS601_Stocks WHERE {clause}", *params)
+
+
+def test_known_shapes_are_reported_but_allowed(nplusone):
+    DB.getNPlusOne().allow.add("SELECT * FROM IS601_Stocks WHERE id = ?")
+    load_each(range(1, 10))
+    incident = DB.nPlusOneReport()["incidents"][0]
+    assert incident["statement"] == "SELECT * FROM IS601_Stocks WHERE id = ?"
+    assert incident["max_count"] == 9 and incident["requests"] == 1
+
+
+def test_requests_are_reported_with_their_path(sqlite_db, monkeypatch):
+    monkeypatch.setenv("DB_NPLUSONE_THRESHOLD", "3")
+    DB.reset()
+    app = Flask(__name__)
+
+    @app.route("/stocks")
+    def stocks():
+        # different stocks each request so the identity map doesn't hide the loop
+        load_each(range(1, 5))
+        return "ok"
+
+    with app.test_client() as client:
+        client.get("/stocks")
+        client.get("/stocks")
+    incident = DB.nPlusOneReport()["incidents"][0]
+    assert (incident["path"], incident["endpoint"], incident["requests"]) == ("/stocks", "stocks", 2)
+    assert "load_each" in incident["stack"]
+
+
+def test_off_by_default(sqlite_db):
+    app = Flask(__name__)
+    with app.test_request_context("/stocks"):
+        load_each(range(1, 10))
+    assert DB.nPlusOneReport()["incidents"] == []
@@ -0,0 +1,59 @@
+import time
+from sql.db import DBResponse, ResultCache
+
+ROLES = "SELECT id, name FROM IS601_Roles WHERE is_active = 1"
+
+
+def cache_roles(cache, ttl=None):
+    key = ResultCache.key(True, ROLES, ())
+    tables = ResultCache.tables(ROLES)
+    cache.put(key, tables, cache.generation(tables), DBResponse(status=True, rows=[{"id": -1, "name": "Admin"}]), ttl=ttl)
+    return key
+
+
+def test_tables_are_found_in_reads_and_writes():
+    assert ResultCache.tables(ROLES) == {"is601_roles"}
+    assert ResultCache.tables("""SELECT name FROM IS601_Roles r JOIN IS601_UserRoles ur on r.id = ur.role_id""") \
+        == {"is601_roles", "is601_userroles"}
+    assert ResultCache.tables("INSERT INTO IS601_UserRoles (user_id, role_id) VALUES (%s, %s)") == {"is601_userroles"}
+    assert ResultCache.tables("UPDATE `IS601_Roles` set name = %s") == {"is601_roles"}
+
+
+def test_hits_are_copies():
+    cache = ResultCache()
+    key = cache_roles(cache)
+    hit = cache.get(key)
+    hit.rows[0]["name"] = "changed"
+    assert cache.get(key).rows[0]["name"] == "Admin"
+    assert cache.stats()["hits"] == 2
+
+
+def test_writes_invalidate_matching_tables():
+    cache = ResultCache()
+    key = cache_roles(cache)
+    cache.invalidate(ResultCache.tables("INSERT INTO IS601_Users (email) VALUES (%s)"))
+    assert cache.get(key) is not None
+    cache.invalidate(ResultCache.tables("UPDATE IS601_Roles set is_active = 0 WHERE id = %s"))
+    assert cache.get(key) is None
+
+
+def test_result_read_before_a_write_is_not_cached():
+    cache = ResultCache()
+    key = ResultCache.key(True, ROLES, ())
+    tables = ResultCache.tables(ROLES)
+    generation = cache.generation(tables)
+    cache.invalidate(tables)
+    cache.put(key, tables, generation, DBResponse(status=True, rows=[]))
+    assert cache.get(key) is None
+
+
+def test_ttl_and_lru_eviction():
+    cache = ResultCache(size=1)
+    key = cache_roles(cache, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get(key) is None
+    key = cache_roles(cache)
+    other = ResultCache.key(False, ROLES, (1,))
+    cache.put(other, ResultCache.tables(ROLES), cache.generation(ResultCache.tables(ROLES)), DBResponse(status=True, row={"id": 1}))
+    assert cache.get(key) is None
+    assert cache.get(other).row == {"id": 1}
@@ -0,0 +1,92 @@
+import pytest
+from sql.db import DB
+
+INSERT_BROKER = "INSERT INTO IS601_Brokers (name, rarity, life, power, defense, stonks) VALUES (%s, 1, 1, 1, 1, 1)"
+INSERT_STOCK = """INSERT INTO IS601_Stocks (symbol, open, high, low, price, volume, latest_trading_day,
+    previous_close, `change`, change_percent) VALUES (%s, 1, 1, 1, 1, 1, '2024-01-02', 1, 0, 0)"""
+
+
+def create_broker(name):
+    with DB.shard() as index:
+        return index, DB.insertOne(INSERT_BROKER, name).insert_id
+
+
+def test_new_brokers_are_spread_over_the_shards_and_found_by_id(sharded_db):
+    created = [create_broker(f"broker {n}") for n in range(4)]
+    assert sorted(index for index, _ in created) == [0, 0, 1, 1]
+    for index, broker_id in created:
+        assert DB.shardFor(broker_id) == index
+        with DB.shard(broker_id):
+            assert DB.selectOne("SELECT name FROM IS601_Brokers WHERE id = %s", broker_id).row is not None
+    # ids don't collide across shards
+    assert len({broker_id for _, broker_id in created}) == 4
+
+
+def test_broker_tables_need_a_shard(sharded_db):
+    with pytest.raises(Exception, match="needs DB.shard"):
+        DB.selectAll("SELECT * FROM IS601_Brokers")
+    # other tables stay on DB_URL
+    assert DB.selectAll("SELECT * FROM IS601_Users").status
+
+
+def test_list_is_gathered_from_every_shard(sharded_db):
+    ids = [create_broker(f"broker {n}")[1] for n in range(5)]
+    result = DB.selectAllShards("SELECT id, name FROM IS601_Brokers", key=lambda row: row["id"], reverse=True)
+    assert [row["id"] for row in result.rows] == sorted(ids, reverse=True)
+    limited = DB.selectAllShards("SELECT id FROM IS601_Brokers", key=lambda row: row["id"], limit=2)
+    assert [row["id"] for row in limited.rows] == sorted(ids)[:2]
+
+
+def test_stocks_are_replicated_to_every_shard(sharded_db):
+    DB.insertOne(INSERT_STOCK, "AAA")
+    with DB.transaction():
+        DB.insertOne(INSERT_STOCK, "BBB")
+    with pytest.raises(ZeroDivisionError):
+        with DB.transaction():
+            DB.insertOne(INSERT_STOCK, "CCC")
+            1 / 0
+    assert DB.selectAll("SELECT symbol FROM IS601_Stocks", row_format="columns").rows["symbol"] == ["AAA", "BBB"]
+    for index in range(2):
+        with DB.onShard(index):
+            symbols = DB.selectAll("SELECT symbol FROM IS601_Stocks", row_format="columns").rows["symbol"]
+        assert symbols == ["AAA", "BBB"]
+
+
+def test_transactions_stay_on_their_shard(sharded_db):
+    with DB.shard() as index, DB.transaction():
+        broker_id = DB.insertOne(INSERT_BROKER, "new").insert_id
+        # the new broker's id routes back to the shard it's being created on
+        with DB.shard(broker_id):
+            DB.insertOne("INSERT INTO IS601_BrokerStocks (broker_id, symbol, shares) VALUES (%s, 'AAA', 1)",
+                         broker_id)
+        with pytest.raises(Exception, match="can't span shards"):
+            with DB.onShard(1 - index):
+                pass
+    with DB.shard(broker_id):
+        assert DB.selectAll("SELECT * FROM IS601_BrokerStocks WHERE broker_id = %s", broker_id).rows
+
+
+def test_unsharded_is_unchanged(sqlite_db):
+    with DB.shard(7) as index:
+        assert index is None
+        broker_id = DB.insertOne(INSERT_BROKER, "one").insert_id
+    assert [row["id"] for row in DB.selectAllShards("SELECT id FROM IS601_Brokers").rows] == [broker_id]
+
+
+def test_stock_edits_and_deletes_reach_every_shard(sharded_db):
+    # every database numbers the stocks on its own (the shards stride their ids), the same id is
+    # a different stock elsewhere (AAA is id 2 on shard 1, BBB 3 on shard 0)
+    for symbol in ["AAA", "BBB", "CCC"]:
+        DB.insertOne(INSERT_STOCK, symbol)
+    DB.update("UPDATE IS601_Stocks SET price = %s WHERE id = %s", 5, 2)
+    with DB.onShard(1):
+        DB.update("UPDATE IS601_Stocks SET price = %(price)s WHERE id = %(id)s", {"price": 7, "id": 2})
+    with DB.shard() as index, DB.transaction():
+        DB.delete("DELETE FROM IS601_Stocks WHERE id = %s", 3 if index == 0 else 4)
+    DB.delete("DELETE FROM IS601_Stocks WHERE id = %s", 99)
+    query = "SELECT symbol, price FROM IS601_Stocks ORDER BY symbol"
+    expected = [(row["symbol"], float(row["price"])) for row in DB.selectAll(query).rows]
+    assert expected == [("AAA", 7), ("CCC", 1)]
+    for index in range(2):
+        with DB.onShard(index):
+            assert [(row["symbol"], float(row["price"])) for row in DB.selectAll(query).rows] == expected
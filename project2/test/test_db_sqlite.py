@@ -0,0 +1,293 @@
+from datetime import date
+from decimal import Decimal
+
+from sql.sqlite_db import translate
+
+STOCK_UPSERT = """INSERT INTO IS601_Stocks (symbol, open, high, low, price, volume, latest_trading_day, previous_close, `change`, change_percent)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE price = VALUES(price), `change` = VALUES(`change`)"""
+
+
+def test_translate_placeholders_and_upserts():
+    assert translate("SELECT * FROM t WHERE a = %s AND b = %(name)s AND c LIKE '%%x%'") == \
+        "SELECT * FROM t WHERE a = ? AND b = :name AND c LIKE '%%x%'"
+    assert translate("INSERT INTO t (a) VALUES (%s) ON DUPLICATE KEY UPDATE a = VALUES(a), b = !b") == \
+        "INSERT INTO t (a) VALUES (?) ON CONFLICT DO UPDATE SET a = excluded.a, b = NOT b"
+
+
+def test_schema_is_loaded(sqlite_db):
+    tables = [list(r.values())[0] for r in sqlite_db.selectAll("SHOW TABLES").rows]
+    assert "IS601_BrokerStocks" in tables
+    # seeded by 004_insert_admin_role.sql
+    assert sqlite_db.selectOne("SELECT name FROM IS601_Roles WHERE id = %s", -1).row["name"] == "Admin"
+
+
+def test_crud_round_trip(sqlite_db):
+    result = sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "tc", "tcval")
+    assert result.status and result.insert_id
+    result = sqlite_db.selectOne("SELECT name, val FROM IS601_Sample WHERE id = %s", result.insert_id)
+    assert result.row == {"name": "tc", "val": "tcval"}
+    assert sqlite_db.update("UPDATE IS601_Sample SET val = %s WHERE name = %s", "new", "tc").rows_affected == 1
+    assert sqlite_db.delete("DELETE FROM IS601_Sample WHERE name = %s", "tc").rows_affected == 1
+    assert sqlite_db.selectAll("SELECT * FROM IS601_Sample").rows == []
+
+
+def test_named_params_and_username_default(sqlite_db):
+    sqlite_db.insertOne("INSERT INTO IS601_Users (email, password) VALUES (%s, %s)", "tc@example.com", "hash")
+    result = sqlite_db.selectOne("SELECT id, email, username FROM IS601_Users where email= %(email)s or username=%(email)s",
+                                 {"email": "tc"})
+    assert result.row["email"] == "tc@example.com"
+    assert result.row["username"] == "tc"
+
+
+def test_upsert_and_types(sqlite_db):
+    values = ["MSFT", "370.1", "371", "369", "370.5", 1000, "2023-11-01", "369.9", "0.6", "0.16"]
+    sqlite_db.insertOne(STOCK_UPSERT, *values)
+    values[4] = "380.25"
+    sqlite_db.insertOne(STOCK_UPSERT, *values)
+    rows = sqlite_db.selectAll("SELECT symbol, price, latest_trading_day FROM IS601_Stocks").rows
+    assert rows == [{"symbol": "MSFT", "price": Decimal("380.25"), "latest_trading_day": date(2023, 11, 1)}]
+
+
+def test_insert_many_and_select_iter(sqlite_db):
+    sqlite_db.insertMany(
+        "INSERT INTO IS601_System_Properties (`name`, `value`) VALUES (%(key)s, %(value)s) ON DUPLICATE KEY UPDATE `value` = VALUES(value)",
+        [{"key": f"k{i}", "value": i} for i in range(25)])
+    names = [r["name"] for r in sqlite_db.selectIter("SELECT name FROM IS601_System_Properties ORDER BY id", batch_size=4)]
+    assert names == [f"k{i}" for i in range(25)]
+
+
+def test_bulk_upsert_chunks_and_updates(sqlite_db):
+    sqlite_db.insertOne("INSERT INTO IS601_Brokers (name, rarity, life, power, defense, stonks) VALUES (%s, 1, 0, 0, 0, 0)", "tc")
+    rows = [(1, f"S{i}", 1) for i in range(10)]
+    result = sqlite_db.bulkUpsert("IS601_BrokerStocks", ["broker_id", "symbol", "shares"], rows, ["shares"], chunk_size=4)
+    assert result.status
+    assert [c["rows"] for c in result.chunks] == [4, 4, 2]
+    result = sqlite_db.bulkUpsert("IS601_BrokerStocks", ["broker_id", "symbol", "shares"],
+                                  [{"broker_id": 1, "symbol": "S0", "shares": 5}], ["shares"])
+    assert len(result.chunks) == 1
+    rows = sqlite_db.selectAll("SELECT symbol, shares FROM IS601_BrokerStocks WHERE broker_id = %s ORDER BY id", 1).rows
+    assert len(rows) == 10
+    assert rows[0] == {"symbol": "S0", "shares": 5}
+
+
+def test_bulk_upsert_expression_updates(sqlite_db):
+    mappings = [(1, -1, 1)]
+    sqlite_db.bulkUpsert("IS601_UserRoles", ["user_id", "role_id", "is_active"], mappings, {"is_active": "!is_active"})
+    sqlite_db.bulkUpsert("IS601_UserRoles", ["user_id", "role_id", "is_active"], mappings, {"is_active": "!is_active"})
+    assert sqlite_db.selectOne("SELECT is_active FROM IS601_UserRoles WHERE user_id = %s", 1).row["is_active"] == 0
+
+
+def test_transaction_commits_once(sqlite_db):
+    with sqlite_db.transaction() as db:
+        sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "a", "1")
+        sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "b", "2")
+        assert db.in_transaction
+        # reads inside the block see the uncommitted rows
+        assert len(sqlite_db.selectAll("SELECT * FROM IS601_Sample").rows) == 2
+    assert len(sqlite_db.selectAll("SELECT * FROM IS601_Sample").rows) == 2
+    assert sqlite_db.poolStats()["in_use"] == 0
+
+
+def test_transaction_rolls_back_on_error(sqlite_db):
+    try:
+        with sqlite_db.transaction():
+            sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "a", "1")
+            # name is unique
+            sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "a", "2")
+        assert False, "expected a duplicate error"
+    except Exception as e:
+        assert "UNIQUE" in str(e)
+    assert sqlite_db.selectAll("SELECT * FROM IS601_Sample").rows == []
+    assert sqlite_db.poolStats()["in_use"] == 0
+
+
+def test_row_formats(sqlite_db):
+    sqlite_db.insertMany("INSERT INTO IS601_System_Properties (`name`, `value`) VALUES (%s, %s)",
+                         [("a", "1"), ("b", "2")])
+    query = "SELECT name, value FROM IS601_System_Properties ORDER BY name"
+    assert sqlite_db.selectAll(query).rows == [{"name": "a", "value": "1"}, {"name": "b", "value": "2"}]
+    assert sqlite_db.selectAll(query, row_format="tuple").rows == [("a", "1"), ("b", "2")]
+    assert sqlite_db.selectAll(query, row_format="namedtuple").rows[1].value == "2"
+    assert sqlite_db.selectAll(query, row_format="columns").rows == {"name": ["a", "b"], "value": ["1", "2"]}
+    assert sqlite_db.selectOne(query, row_format="tuple").row == ("a", "1")
+    # cached hits are shaped per call
+    assert sqlite_db.selectAll(query, cache=True, row_format="tuple").rows == [("a", "1"), ("b", "2")]
+    assert sqlite_db.selectAll(query, cache=True).rows[0] == {"name": "a", "value": "1"}
+    batches = list(sqlite_db.selectIter(query, batch_size=1, row_format="columns"))
+    assert batches == [{"name": ["a"], "value": ["1"]}, {"name": ["b"], "value": ["2"]}]
+
+
+def test_registered_mapper(sqlite_db):
+    from stocks.models import Stock
+    sqlite_db.registerMapper(Stock)
+    sqlite_db.insertOne(
+        "INSERT INTO IS601_Stocks (symbol, open, high, low, price, volume, latest_trading_day, previous_close, `change`, change_percent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        "ABC", Decimal("1.5"), Decimal("2"), Decimal("1"), Decimal("1.75"), 100, date(2024, 1, 2),
+        Decimal("1.25"), Decimal("0.5"), Decimal("40"))
+    stock = sqlite_db.selectOne("SELECT * FROM IS601_Stocks WHERE symbol = %s", "ABC", row_format=Stock).row
+    assert isinstance(stock, Stock)
+    assert stock.symbol == "ABC" and stock.price == Decimal("1.75") and stock.shares == 1
+    stocks = sqlite_db.selectAll("SELECT *, 3 as shares FROM IS601_Stocks", row_format=Stock).rows
+    assert [s.shares for s in stocks] == [3]
+
+
+def test_batch_returns_one_response_per_select(sqlite_db):
+    sqlite_db.insertOne("INSERT INTO IS601_Users (email, password) VALUES (%s, %s)", "tc@example.com", "hash")
+    roles = "SELECT id, name FROM IS601_Roles WHERE is_active = 1"
+    user, missing, found = sqlite_db.batch() \
+        .selectOne("SELECT id, email FROM IS601_Users where email= %(email)s or username=%(email)s", {"email": "tc"}) \
+        .selectOne("SELECT id FROM IS601_Users WHERE email = %s", "nobody") \
+        .selectAll(roles, cache=True, row_format="tuple").run()
+    assert user.row["email"] == "tc@example.com"
+    assert missing.status and missing.row is None
+    assert found.rows == sqlite_db.selectAll(roles, row_format="tuple").rows
+    hits = sqlite_db.resultCacheStats()["hits"]
+    (again,) = sqlite_db.batch().selectAll(roles, cache=True, row_format="tuple").run()
+    assert again.rows == found.rows
+    assert sqlite_db.resultCacheStats()["hits"] == hits + 1
+
+
+def test_reads_go_to_replicas_until_the_context_writes(sqlite_db, monkeypatch, tmp_path):
+    import contextvars
+    monkeypatch.setenv("DB_REPLICA_URLS", f"sqlite:///{tmp_path}/replica.db")
+    query = "SELECT name FROM IS601_Sample WHERE name = %s"
+
+    def request():
+        # the replica doesn't get the primary's writes here, so where the read went is visible
+        before = sqlite_db.selectOne(query, "tc").row
+        sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "tc", "tcval")
+        after = sqlite_db.selectOne(query, "tc").row
+        return before, after
+
+    assert contextvars.Context().run(request) == (None, {"name": "tc"})
+    # a new request without writes reads from the replica again
+    assert contextvars.Context().run(lambda: sqlite_db.selectOne(query, "tc").row) is None
+    assert sqlite_db.replicaStats()[0]["total_connects"] == 1
+
+
+def test_reads_are_retried_after_connection_failures(sqlite_db, monkeypatch):
+    from sql.db import Error
+    monkeypatch.setenv("DB_RETRY_BACKOFF", "0.001")
+    connect = sqlite_db._connect
+    failures = []
+
+    def flaky(*args):
+        if len(failures) < 2:
+            failures.append(1)
+            raise Error("Can't connect to MySQL server", errno=2003)
+        return connect(*args)
+    monkeypatch.setattr(sqlite_db, "_connect", staticmethod(flaky))
+    assert sqlite_db.selectOne("SELECT 1 as one").row == {"one": 1}
+    assert len(failures) == 2
+    failures.clear()
+    # writes aren't retried
+    try:
+        sqlite_db.reset()
+        sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "tc", "tcval")
+        assert False, "expected the connect error"
+    except Exception as e:
+        assert "Can't connect" in str(e)
+    assert len(failures) == 1
+
+
+def test_lost_connections_are_retried_within_a_timeout(sqlite_db, monkeypatch):
+    from sql.db import Error, SQLiteConnection
+    monkeypatch.setenv("DB_RETRY_BACKOFF", "0.001")
+    failures = []
+    set_timeout = SQLiteConnection.set_timeout
+
+    def stale(self, seconds):
+        # the first statement finds the pooled connection gone (MySQL server has gone away)
+        if seconds is not None and not failures:
+            failures.append(1)
+            raise Error("MySQL server has gone away", errno=2006)
+        return set_timeout(self, seconds)
+    monkeypatch.setattr(SQLiteConnection, "set_timeout", stale)
+    assert sqlite_db.selectOne("SELECT 1 as one", timeout=5).row == {"one": 1}
+    assert failures == [1]
+
+
+def test_select_timeouts_and_deadlines(sqlite_db):
+    import time
+    from sql.db import DBTimeoutError
+    endless = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+    start = time.monotonic()
+    try:
+        sqlite_db.selectOne(endless, timeout=0.1)
+        assert False, "expected a timeout"
+    except DBTimeoutError:
+        pass
+    assert time.monotonic() - start < 1
+    # the connection is still usable afterwards
+    assert sqlite_db.selectOne("SELECT 1 as one", timeout=1).row == {"one": 1}
+    with sqlite_db.deadline(0.05):
+        assert sqlite_db.selectOne("SELECT 1 as one").row == {"one": 1}
+        time.sleep(0.06)
+        try:
+            sqlite_db.selectOne("SELECT 1 as one")
+            assert False, "expected the deadline to have passed"
+        except DBTimeoutError:
+            pass
+    assert sqlite_db._timeoutHint(object(), "  select id FROM IS601_Users", 0.25) \
+        == "  select /*+ MAX_EXECUTION_TIME(244) */ id FROM IS601_Users"
+    # the remaining time of a deadline only produces a handful of distinct statements
+    hints = {sqlite_db._timeoutHint(object(), "SELECT 1", ms / 1000) for ms in range(100, 5000)}
+    assert len(hints) == 18
+
+
+def test_in_clause_pads_small_lists_and_uses_json_for_large_ones(sqlite_db, monkeypatch):
+    clause, params = sqlite_db.inClause("symbol", ["A", "B", "C"])
+    assert clause == "symbol IN (%s,%s,%s,%s)" and params == ["A", "B", "C", "C"]
+    assert sqlite_db.inClause("symbol", [], negate=True) == ("1 = 1", [])
+    values = [(f"S{i}", f"{i}") for i in range(10)]
+    sqlite_db.insertMany("INSERT INTO IS601_System_Properties (`name`, `value`) VALUES (%s, %s)", values)
+    monkeypatch.setattr(sqlite_db, "IN_LIST_MAX", 4)
+    clause, params = sqlite_db.inClause("name", [f"S{i}" for i in range(6)] + ["missing"])
+    assert "json_each" in clause and len(params) == 1
+    rows = sqlite_db.selectAll(f"SELECT name FROM IS601_System_Properties WHERE {clause} ORDER BY id", *params).rows
+    assert [r["name"] for r in rows] == [f"S{i}" for i in range(6)]
+    clause, params = sqlite_db.inClause("name", [f"S{i}" for i in range(6)], negate=True)
+    assert sqlite_db.selectAll(f"SELECT count(*) as c FROM IS601_System_Properties WHERE {clause}", *params).rows[0]["c"] == 4
+
+
+def test_in_clause_json_table_uses_the_tables_collation(monkeypatch):
+    from sql.db import DB
+    monkeypatch.setenv("DB_URL", "mysql://u:p@localhost:3306/db")
+    monkeypatch.setenv("DB_COLLATION", "utf8mb4_unicode_ci")
+    monkeypatch.setattr(DB, "IN_LIST_MAX", 2)
+    DB.reset()
+    try:
+        clause, params = DB.inClause("symbol", ["A", "B", "C"])
+        assert "COLUMNS (v VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci PATH '$')" in clause
+        assert params == ['["A", "B", "C"]']
+        assert "COLUMNS (v BIGINT PATH '$')" in DB.inClause("id", [1, 2, 3])[0]
+    finally:
+        DB.reset()
+
+
+def test_identity_map_dedupes_primary_key_reads_in_a_request(sqlite_db):
+    from flask import Flask, g
+    sample_id = sqlite_db.insertOne("INSERT INTO IS601_Sample (name, val) VALUES(%s, %s)", "tc", "tcval").insert_id
+    with Flask(__name__).test_request_context("/"):
+        before = sqlite_db.identityMapStats()
+        assert sqlite_db.selectOne("SELECT name FROM IS601_Sample WHERE id = %s", sample_id).row == {"name": "tc"}
+        assert sqlite_db.selectOne("SELECT name FROM IS601_Sample WHERE id = %s", sample_id).row == {"name": "tc"}
+        # only the columns read so far are kept, val is read (and added) when it's asked for
+        assert g._db_identity[("is601_sample", str(sample_id))].result()[0] == ("name",)
+        assert sqlite_db.selectOne("SELECT val, name FROM IS601_Sample WHERE id = %s", sample_id,
+                                   row_format="tuple").row == ("tcval", "tc")
+        assert sqlite_db.selectOne("SELECT name, val FROM IS601_Sample WHERE id = %s", sample_id,
+                                   row_format="tuple").row == ("tc", "tcval")
+        assert sqlite_db.selectOne("SELECT * FROM IS601_Sample WHERE id = %s", sample_id).row["val"] == "tcval"
+        assert sqlite_db.selectOne("SELECT val FROM IS601_Sample WHERE id = %s", sample_id).row == {"val": "tcval"}
+        assert sqlite_db.selectOne("SELECT name FROM IS601_Sample WHERE id = %s", -1).row is None
+        stats = sqlite_db.identityMapStats()
+        assert (stats["hits"] - before["hits"], stats["misses"] - before["misses"]) == (3, 4)
+        sqlite_db.update("UPDATE IS601_Sample SET val = %s WHERE id = %s", "new", sample_id)
+        assert sqlite_db.selectOne("SELECT val FROM IS601_Sample WHERE id = %s", sample_id).row == {"val": "new"}
+        # users (password hashes) aren't kept in the request
+        sqlite_db.selectOne("SELECT id, email FROM IS601_Users WHERE id = %s", 1)
+        assert not any(table == "is601_users" for table, _ in g._db_identity)
+    # outside of a request every read goes to the database
+    assert sqlite_db.selectOne("SELECT val FROM IS601_Sample WHERE id = %s", sample_id).row == {"val": "new"}
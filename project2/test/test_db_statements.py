@@ -0,0 +1,58 @@
+from sql.db import StatementCache
+
+
+class FakeCursor:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def cursor(self, **kwargs):
+        return FakeCursor()
+
+
+def test_statement_cache_reuses_cursor_and_statement():
+    conn = FakeConnection()
+    cache = StatementCache(conn, size=2)
+    cursor, sql, _ = cache.get("SELECT * FROM IS601_Brokers WHERE id = %s")
+    again, sql_again, _ = cache.get("SELECT * FROM IS601_Brokers WHERE id = %s")
+    assert again is cursor
+    # the driver only skips the re-prepare when it sees the same statement object
+    assert sql_again is sql
+
+
+def test_statement_cache_converts_named_params():
+    conn = FakeConnection()
+    cache = StatementCache(conn)
+    _, sql, keys = cache.get("SELECT id FROM IS601_Users where email= %(email)s or username=%(email)s")
+    assert sql == "SELECT id FROM IS601_Users where email= %s or username=%s"
+    assert StatementCache.positional({"email": "a@b.c"}, keys) == ("a@b.c", "a@b.c")
+
+
+def test_statement_cache_evicts_least_recently_used():
+    before = StatementCache.stats()["evictions"]
+    conn = FakeConnection()
+    cache = StatementCache(conn, size=2)
+    first, _, _ = cache.get("SELECT 1")
+    second, _, _ = cache.get("SELECT 2")
+    cache.get("SELECT 1")
+    cache.get("SELECT 3")
+    assert cache.owns(first)
+    assert not cache.owns(second)
+    assert second.closed
+    assert StatementCache.stats()["evictions"] == before + 1
+
+
+def test_select_one_reads_the_whole_result(sqlite_db, monkeypatch):
+    # with TEST_DB_URL set this runs on mysql.connector, which fails the next statement on the
+    # connection (or the cached cursor) while a result is still unread
+    monkeypatch.setenv("DB_POOL_SIZE", "1")
+    sqlite_db.reset()
+    sqlite_db.insertMany("INSERT INTO IS601_Sample (name, val) VALUES (%s, %s)", [("a", "1"), ("b", "2"), ("c", "3")])
+    query = "SELECT name FROM IS601_Sample WHERE name IN ('a', 'b', 'c') ORDER BY name"
+    for _ in range(2):
+        assert sqlite_db.selectOne(query).row == {"name": "a"}
+    assert [row["name"] for row in sqlite_db.selectAll(query).rows] == ["a", "b", "c"]
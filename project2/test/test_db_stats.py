@@ -0,0 +1,31 @@
+from sql.db import QueryStats
+
+
+def test_fingerprint_groups_in_lists_and_literals():
+    a = QueryStats.fingerprint("SELECT id FROM IS601_Stocks WHERE symbol IN (%s,%s) LIMIT 100")
+    b = QueryStats.fingerprint("SELECT id FROM IS601_Stocks\n  WHERE symbol IN (%s) LIMIT 10")
+    assert a == b == "SELECT id FROM IS601_Stocks WHERE symbol IN (...) LIMIT ?"
+
+
+def test_stats_percentiles_and_totals():
+    stats = QueryStats(slow_ms=None)
+    for ms in range(1, 101):
+        stats.record("SELECT * FROM IS601_Brokers WHERE id = %s", ms / 1000, rows_returned=1)
+    stats.record("UPDATE IS601_Brokers SET name = %s WHERE id = %s", 0.001, rows_affected=1)
+    report = stats.snapshot()
+    hottest = report[0]
+    assert hottest["statement"] == "SELECT * FROM IS601_Brokers WHERE id = ?"
+    assert hottest["count"] == 100
+    assert hottest["rows_returned"] == 100
+    assert (hottest["p50"], hottest["p95"], hottest["p99"]) == (50.0, 95.0, 99.0)
+    assert report[1]["rows_affected"] == 1
+
+
+def test_slow_queries_are_logged(tmp_path):
+    log = tmp_path / "slow.log"
+    stats = QueryStats(slow_ms=10, slow_log=str(log))
+    stats.record("SELECT 1", 0.001)
+    stats.record("SELECT SLEEP(1)", 1.0)
+    lines = log.read_text().splitlines()
+    assert len(lines) == 1
+    assert "1000.0ms SELECT SLEEP" in lines[0]
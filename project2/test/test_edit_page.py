@@ -3,9 +3,10 @@ import pytest
 
 
 @pytest.fixture()
-def app():
-    from ..main import create_app
-    from ..sql.db import DB
+def app(sqlite_db):
+    # sqlite_db (see conftest.py) points DB at an in-memory SQLite copy of the schema
+    from main import create_app
+    DB = sqlite_db
     app = create_app()
     """app.config.update({
         "TESTING": True,
@@ -0,0 +1,21 @@
+import pytest
+from flask import Flask
+from views.metrics import metrics
+
+
+@pytest.fixture()
+def client(sqlite_db):
+    app = Flask(__name__)
+    app.register_blueprint(metrics)
+    return app.test_client()
+
+
+def test_metrics_need_the_token(client, monkeypatch):
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setenv("METRICS_TOKEN", "secret")
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200 and "queries" in response.get_json()
+    assert client.post("/metrics/reset").status_code == 403
+    assert client.post("/metrics/reset", headers={"Authorization": "Bearer secret"}).get_json() == {"status": True}
@@ -0,0 +1,157 @@
+import threading
+import pytest
+from utils.AlphaVantage import AlphaVantage, QuoteCache
+from utils.ratelimit import RateLimitExceeded
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.AlphaVantage.time.monotonic", lambda: now[0])
+    return now
+
+
+class Provider:
+    def __init__(self):
+        self.calls = 0
+        self.limited = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def fetch(self):
+        self.release.wait(5)
+        if self.limited:
+            raise RateLimitExceeded("Rate limit reached", 10)
+        self.calls += 1
+        return {"symbol": "MSFT", "price": str(self.calls)}
+
+
+def test_fresh_quotes_are_served_from_the_cache(clock):
+    cache, provider = QuoteCache(ttl=60), Provider()
+    assert cache.get(("GLOBAL_QUOTE", "MSFT"), provider.fetch)["price"] == "1"
+    clock[0] += 59
+    assert cache.get(("GLOBAL_QUOTE", "MSFT"), provider.fetch)["price"] == "1"
+    assert provider.calls == 1
+
+
+def test_stale_quotes_are_served_while_one_refresh_runs(clock):
+    cache, provider = QuoteCache(ttl=60, max_stale=600), Provider()
+    cache.get("MSFT", provider.fetch)
+    clock[0] += 120
+    provider.release.clear()
+    # both served the old quote straight away, only one refresh is started
+    assert cache.get("MSFT", provider.fetch)["price"] == "1"
+    assert cache.get("MSFT", provider.fetch)["price"] == "1"
+    provider.release.set()
+    cache._executor.shutdown(wait=True)
+    assert provider.calls == 2
+    assert cache.get("MSFT", provider.fetch)["price"] == "2"
+    assert cache.stats() == {"size": 1, "hits": 1, "stale_hits": 2, "misses": 1}
+
+
+def test_too_old_quotes_are_served_when_the_refresh_fails(clock):
+    cache, provider = QuoteCache(ttl=60, max_stale=600), Provider()
+    cache.get("MSFT", provider.fetch)
+    clock[0] += 1000
+    provider.limited = True
+    assert cache.get("MSFT", provider.fetch)["price"] == "1"
+    with pytest.raises(RateLimitExceeded):
+        cache.get("AAPL", provider.fetch)
+
+
+def test_too_old_quotes_are_served_when_the_response_has_no_quote(clock):
+    # AlphaVantage's soft limit is a 200 with a "Note" instead of the quote, fetch() returns None
+    cache, provider = QuoteCache(ttl=60, max_stale=600), Provider()
+    cache.get("MSFT", provider.fetch)
+    clock[0] += 1000
+    assert cache.get("MSFT", lambda: None)["price"] == "1"
+    assert cache.get("AAPL", lambda: None) is None
+    clock[0] += 1
+    assert cache.get("MSFT", provider.fetch)["price"] == "2"
+
+
+def test_least_recently_used_quotes_are_dropped(clock):
+    cache, provider = QuoteCache(size=2), Provider()
+    for symbol in ["A", "B", "A", "C"]:
+        cache.get(symbol, provider.fetch)
+    assert provider.calls == 3
+    assert list(cache._entries) == ["A", "C"]
+
+
+def test_quote_is_cached_per_symbol(monkeypatch):
+    calls = []
+    monkeypatch.setattr(AlphaVantage, "quote_cache", QuoteCache())
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", lambda symbol: calls.append(symbol) or {"symbol": symbol})
+    assert AlphaVantage.quote("msft ") == {"symbol": "MSFT"}
+    assert AlphaVantage.quote("MSFT") == {"symbol": "MSFT"}
+    assert calls == ["MSFT"]
+
+
+def quote_for(symbol):
+    return {"symbol": symbol, "open": "1", "high": "1", "low": "1", "price": "1", "volume": "1",
+            "latest_trading_day": "2024-01-02", "previous_close": "1", "change": "0", "change_percent": "0"}
+
+
+def test_quotes_are_looked_up_in_parallel_with_per_symbol_errors(monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+
+    def fetch(symbol):
+        barrier.wait()  # only passes when the three lookups run at the same time
+        if symbol == "BAD":
+            raise RateLimitExceeded("Rate limit reached", 10)
+        return quote_for(symbol) if symbol != "NONE" else None
+    monkeypatch.setattr(AlphaVantage, "quote_cache", QuoteCache())
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", fetch)
+    results = AlphaVantage.quotes(["msft", "BAD", "NONE", "MSFT"])
+    assert list(results) == ["MSFT", "BAD", "NONE"]
+    assert results["MSFT"]["symbol"] == "MSFT" and results["NONE"] is None
+    assert isinstance(results["BAD"], RateLimitExceeded)
+
+
+def test_quotes_use_the_bulk_function_when_configured(monkeypatch):
+    calls = []
+
+    def get(url, params):
+        calls.append(params)
+        return {"data": [{"symbol": "MSFT", "open": "1", "close": "2", "timestamp": "2024-01-02 16:00:00",
+                          "change_percent": "0.5%"}]}
+    monkeypatch.setattr(AlphaVantage, "quote_cache", QuoteCache())
+    monkeypatch.setattr(AlphaVantage, "BULK_FUNCTION", "REALTIME_BULK_QUOTES")
+    monkeypatch.setattr("utils.AlphaVantage.API.get", get)
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", lambda symbol: calls.append(symbol) or quote_for(symbol))
+    results = AlphaVantage.quotes(["MSFT", "AAPL"])
+    assert calls[0]["symbol"] == "MSFT,AAPL"
+    # AAPL wasn't in the bulk response so it's looked up on its own
+    assert calls[1:] == ["AAPL"]
+    assert (results["MSFT"]["price"], results["MSFT"]["latest_trading_day"]) == ("2", "2024-01-02")
+    assert results["MSFT"]["change_percent"] == "0.5"
+    # and cached like quote()'s
+    assert AlphaVantage.quote("MSFT")["price"] == "2"
+
+
+def test_fetch_stocks_inserts_the_missing_symbols_at_once(sqlite_db, monkeypatch):
+    from brokerstock_utils.utils import fetch_stocks
+    monkeypatch.setattr(AlphaVantage, "quote_cache", QuoteCache())
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", quote_for)
+    stocks = fetch_stocks(["msft", "aapl", "goog"])
+    assert sorted(s["symbol"] for s in stocks) == ["AAPL", "GOOG", "MSFT"]
+    inserts = [q for q in sqlite_db.queryStats() if q["statement"].startswith("INSERT INTO `IS601_Stocks`")]
+    assert [q["count"] for q in inserts] == [1]
+    # already stored, nothing is fetched
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", None)
+    assert {s["id"] for s in fetch_stocks(["MSFT", "AAPL", "GOOG"])} == {s["id"] for s in stocks}
+
+
+def test_quotes_wait_for_the_rate_limit_within_a_limit(monkeypatch):
+    monkeypatch.setattr(AlphaVantage, "quote_cache", QuoteCache())
+    refusals = {"MSFT": [0.01, 0.01], "AAPL": [0.01], "GOOG": [3600]}
+
+    def fetch(symbol):
+        if refusals[symbol]:
+            raise RateLimitExceeded("Rate limit reached", refusals[symbol].pop(0))
+        return quote_for(symbol)
+    monkeypatch.setattr(AlphaVantage, "_fetch_quote", fetch)
+    results = AlphaVantage.quotes(["MSFT", "AAPL", "GOOG"])
+    assert (results["MSFT"]["symbol"], results["AAPL"]["symbol"]) == ("MSFT", "AAPL")
+    # the next call is further away than QUOTE_RATE_WAIT
+    assert isinstance(results["GOOG"], RateLimitExceeded)
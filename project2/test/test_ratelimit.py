@@ -0,0 +1,63 @@
+import pytest
+from utils.ratelimit import RateLimitExceeded, TokenBucket
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.ratelimit.time.time", lambda: now[0])
+    return now
+
+
+def test_workers_share_one_bucket(tmp_path, clock):
+    # two instances on the same file stand in for two gunicorn workers
+    path = str(tmp_path / "bucket")
+    first, second = TokenBucket(path, capacity=3), TokenBucket(path, capacity=3)
+    assert first.created and not second.created
+    first.acquire()
+    second.acquire()
+    first.acquire()
+    with pytest.raises(RateLimitExceeded) as e:
+        second.acquire()
+    # 3 per 60s refills a token every 20s
+    assert e.value.retry_after == pytest.approx(20)
+    clock[0] += 20
+    second.acquire()
+
+
+def test_sync_blocks_until_the_provider_resets(clock):
+    bucket = TokenBucket(capacity=5, persist_interval=60)
+    assert bucket.sync(limit=10, remaining=0, reset_seconds=30) is False
+    with pytest.raises(RateLimitExceeded):
+        bucket.acquire()
+    clock[0] += 30
+    assert bucket.available() == 10
+    # one caller per interval is told to persist
+    clock[0] += 30
+    assert bucket.sync(remaining=7) is True
+    assert bucket.sync(remaining=7) is False
+    assert bucket.available() == 7
+
+
+def test_no_local_limit_until_the_provider_reports_one(clock):
+    bucket = TokenBucket(window=86400)
+    for _ in range(100):
+        bucket.acquire()
+    assert bucket.stats() == {"tokens": None, "capacity": None, "resets_in": 0.0}
+    # a daily limit: what's left lasts until the provider's reset, it doesn't refill per minute
+    bucket.sync(limit=25, remaining=1, reset_seconds=3600)
+    bucket.acquire()
+    clock[0] += 600
+    with pytest.raises(RateLimitExceeded) as e:
+        bucket.acquire()
+    assert e.value.retry_after == pytest.approx(3000)
+    clock[0] += 3000
+    assert bucket.available() == 25
+
+
+def test_remaining_without_a_reset_lasts_the_configured_window(clock):
+    bucket = TokenBucket(window=86400)
+    bucket.sync(remaining=0)
+    with pytest.raises(RateLimitExceeded) as e:
+        bucket.acquire()
+    assert e.value.retry_after == pytest.approx(86400)
@@ -9,10 +9,219 @@ if __name__ == "__main__":
     # Add the parent directory to the Python path
     PARENT_DIR = os.path.join(CURR_DIR, "..")  # Go up one level from utils to project folder
     sys.path.append(PARENT_DIR)
-from utils.api import API
+from utils.api import API, RateLimitExceeded
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class QuoteCache:
+    """Recent API responses by (function, symbol), least recently used dropped past size
+
+    Younger than ttl seconds an entry is served as is. Up to max_stale seconds past that it's
+    still served right away while one background refresh replaces it, older ones are fetched
+    again (or served anyway when that fails or returns nothing, e.g. AlphaVantage's rate limit Note).
+    """
+
+    def __init__(self, size=512, ttl=60, max_stale=3600):
+        self.size = size
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (fetched at, value)
+        self._refreshing = set()
+        self._executor = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key, fetch):
+        # fetch() -> value to cache, or None when the response shouldn't be (e.g., an error note)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                age = now - entry[0]
+                if age < self.ttl:
+                    self.hits += 1
+                    return dict(entry[1])
+                if age < self.ttl + self.max_stale:
+                    self.stale_hits += 1
+                    refresh = key not in self._refreshing
+                    if refresh:
+                        self._refreshing.add(key)
+                        if self._executor is None:
+                            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="quotes")
+                        self._executor.submit(self._refresh, key, fetch)
+                    return dict(entry[1])
+            self.misses += 1
+        try:
+            value = fetch()
+        except Exception as e:
+            if entry is None:
+                raise
+            print(f"Refresh failed ({e}), serving the {now - entry[0]:.0f}s old quote for {key}")
+            return dict(entry[1])
+        if value is None and entry is not None:
+            print(f"No quote in the response, serving the {now - entry[0]:.0f}s old quote for {key}")
+            return dict(entry[1])
+        self.put(key, value)
+        return value
+
+    def fresh(self, key):
+        # the cached value if it's younger than ttl, otherwise None (nothing is fetched)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def _refresh(self, key, fetch):
+        try:
+            self.put(key, fetch())
+        except Exception as e:
+            print(f"Background refresh of {key} failed, still serving the stale quote", e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def put(self, key, value):
+        if value is None:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), dict(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "stale_hits": self.stale_hits,
+                    "misses": self.misses}
+
+
 class AlphaVantage(API):
+    # GLOBAL_QUOTE only changes once per trading interval, see QuoteCache
+    quote_cache = QuoteCache(
+        size=int(os.environ.get("QUOTE_CACHE_SIZE", 512)),
+        ttl=float(os.environ.get("QUOTE_CACHE_TTL", 60)),
+        max_stale=float(os.environ.get("QUOTE_CACHE_MAX_STALE", 3600)))
+    # premium plans have a bulk quote function (REALTIME_BULK_QUOTES, up to 100 symbols a call),
+    # without one quotes() looks symbols up in parallel on QUOTE_WORKERS threads
+    BULK_FUNCTION = os.environ.get("QUOTE_BULK_FUNCTION", "")
+    BULK_SIZE = 100
+    # seconds quotes() waits for the rate limiter to free up calls before giving up on a symbol
+    RATE_WAIT = float(os.environ.get("QUOTE_RATE_WAIT", 10))
+    _executor = None
+    _executor_lock = threading.Lock()
+
     @staticmethod
     def quote(symbol):
+        symbol = f"{symbol}".upper().strip()
+        return AlphaVantage.quote_cache.get(("GLOBAL_QUOTE", symbol), lambda: AlphaVantage._fetch_quote(symbol))
+
+    @staticmethod
+    def quotes(symbols):
+        # symbol -> its quote like quote() returns (None when there isn't one), or the exception
+        # looking it up raised (e.g., RateLimitExceeded) so one bad symbol doesn't fail the rest
+        # symbols past the rate limit's budget wait for it (up to RATE_WAIT seconds in all)
+        symbols = list(dict.fromkeys(f"{s}".upper().strip() for s in symbols))
+        results = {}
+        missing = []
+        for symbol in symbols:
+            cached = AlphaVantage.quote_cache.fresh(("GLOBAL_QUOTE", symbol))
+            if cached is not None:
+                results[symbol] = cached
+            else:
+                missing.append(symbol)
+        if AlphaVantage.BULK_FUNCTION and len(missing) > 1:
+            for i in range(0, len(missing), AlphaVantage.BULK_SIZE):
+                try:
+                    found = AlphaVantage._fetch_bulk(missing[i:i + AlphaVantage.BULK_SIZE])
+                except Exception as e:
+                    # looked up one by one below instead
+                    print(f"Bulk quote failed: {e}")
+                    continue
+                for symbol, quote in found.items():
+                    AlphaVantage.quote_cache.put(("GLOBAL_QUOTE", symbol), quote)
+                    results[symbol] = quote
+            missing = [s for s in missing if s not in results]
+        futures = {}
+        deadline = time.monotonic() + AlphaVantage.RATE_WAIT
+        if len(missing) == 1:
+            # not worth a thread
+            try:
+                results[missing[0]] = AlphaVantage._quote_waiting(missing[0], deadline)
+            except Exception as e:
+                results[missing[0]] = e
+        elif missing:
+            executor = AlphaVantage.getExecutor()
+            futures = {symbol: executor.submit(AlphaVantage._quote_waiting, symbol, deadline) for symbol in missing}
+        for symbol, future in futures.items():
+            try:
+                results[symbol] = future.result()
+            except Exception as e:
+                results[symbol] = e
+        return {symbol: results[symbol] for symbol in symbols}
+
+    @staticmethod
+    def _quote_waiting(symbol, deadline):
+        # quote(), the rate limiter refuses calls past the budget without sending them
+        # (RateLimitExceeded) so wait for its next call while that's before deadline
+        while True:
+            try:
+                return AlphaVantage.quote(symbol)
+            except RateLimitExceeded as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                time.sleep(e.retry_after)
+
+    @staticmethod
+    def getExecutor():
+        if AlphaVantage._executor is None:
+            with AlphaVantage._executor_lock:
+                if AlphaVantage._executor is None:
+                    AlphaVantage._executor = ThreadPoolExecutor(
+                        max_workers=int(os.environ.get("QUOTE_WORKERS", 4)), thread_name_prefix="quote")
+        return AlphaVantage._executor
+
+    @staticmethod
+    def _fetch_bulk(symbols):
+        # symbol -> quote in GLOBAL_QUOTE's shape, symbols the response leaves out aren't included
+        params = {"function": AlphaVantage.BULK_FUNCTION, "symbol": ",".join(symbols), "datatype": "json"}
+        resp = API.get("/query", params)
+        if not resp or not isinstance(resp.get("data"), list):
+            raise Exception(f"Unexpected bulk quote response: {resp}")
+        found = {}
+        for row in resp["data"]:
+            symbol = f"{row.get('symbol', '')}".upper()
+            if symbol not in symbols:
+                continue
+            found[symbol] = {
+                "symbol": symbol,
+                "open": row.get("open"),
+                "high": row.get("high"),
+                "low": row.get("low"),
+                "price": row.get("close"),
+                "volume": row.get("volume"),
+                "latest_trading_day": f"{row.get('timestamp', '')}"[:10],
+                "previous_close": row.get("previous_close"),
+                "change": row.get("change"),
+                "change_percent": f"{row.get('change_percent', '')}".replace("%", ""),
+            }
+        return found
+
+    @staticmethod
+    def _fetch_quote(symbol):
+        # the parsed quote, None when the API didn't return one
         params = {}
         params["function"] = "GLOBAL_QUOTE"
         params["symbol"] = f"{symbol}"
@@ -23,14 +232,16 @@ class AlphaVantage(API):
         # this API is "odd" and includes numbers as part of the keys like 01. 02. 03. etc and below removes that and returns just the named keys
         # below also converts the remaining spaces into _ to avoid space problems
         # I think the API is mostly targeted at the csv output option instead of the json option although it supports both
-        if resp and resp["Global Quote"]:
+        if resp and resp.get("Global Quote"):
             gq = resp["Global Quote"]
             for k,v in gq.items():
                 if "." in k:
                     k = k.split(".")[1].strip()
                     fixed[k.replace(" ", "_")] = v.replace("%","") if k == "change percent" else v
         else:
-            fixed = resp
+            # error notes (bad symbol, call frequency) aren't quotes, they're not cached either
+            print(f"No quote for {symbol}: {resp}")
+            return None
         return fixed
 
 if __name__ == "__main__":
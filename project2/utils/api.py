@@ -1,6 +1,10 @@
 from enum import Enum
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import tempfile
+import threading
 # fix for testing just this file
 if __name__ == "__main__":
     import sys
@@ -12,6 +16,7 @@ if __name__ == "__main__":
     sys.path.append(PARENT_DIR)
 from dotenv import load_dotenv
 from sql.db import DB  # Import the DB class from your db.py module
+from utils.ratelimit import RateLimitExceeded, TokenBucket
 from datetime import datetime, timedelta
 
 load_dotenv()
@@ -21,6 +26,12 @@ class HTTP(Enum):
     POST = 2
 
 class API:
+    # one keep-alive requests.Session per API_REF, shared by every thread (see API.getSession())
+    sessions = {}
+    # rate limit token bucket per API_REF shared by the worker processes (see API.getLimiter())
+    limiters = {}
+    _session_lock = threading.Lock()
+
     @staticmethod
     def _get_config(API_REF="API"):
         # Configuration keys and their meanings:
@@ -32,6 +43,18 @@ class API:
         # RATE_REMAINING_HEADER: The header field name for remaining rate limit.
         # RATE_RESET_HEADER: The header field name for rate limit reset time.
         # RATE_HAS_LIMIT: Flag to indicate whether rate limit checks should be performed.
+        # POOL_SIZE: Keep-alive connections kept open to the API (one per concurrent request).
+        # RETRIES: Retries after a connection error or a 5xx response (GETs only, with backoff), a 429 isn't
+        #   retried, it blocks the rate limit bucket until its Retry-After instead.
+        # RETRY_BACKOFF: Seconds before the first retry, doubled for each one after it.
+        # RETRY_BACKOFF_MAX: Most seconds to wait before a retry.
+        # CONNECT_TIMEOUT / READ_TIMEOUT: Seconds to wait to connect / for the response.
+        # RATE_CAPACITY: Calls allowed per RATE_WINDOW before the headers say otherwise, 0 (default) leaves the
+        #   limit to the provider: its rate limit headers and 429s.
+        # RATE_WINDOW: Seconds the provider's limit is for (e.g., 86400 for a daily one) when its headers
+        #   don't say when it resets.
+        # RATE_PERSIST_INTERVAL: Seconds between saves of the rate limit state to IS601_System_Properties.
+        # RATE_FILE: File the worker processes share the rate limit through, empty for per process.
         return {
             "BASE_URL": os.environ.get(f"{API_REF}_BASE_URL", ""),
             "HOST": os.environ.get(f"{API_REF}_HOST", ""),
@@ -40,9 +63,85 @@ class API:
             "RATE_LIMIT_HEADER": os.environ.get(f"{API_REF}_RATE_LIMIT_HEADER", "x-ratelimit-requests-limit"),
             "RATE_REMAINING_HEADER": os.environ.get(f"{API_REF}_RATE_REMAINING_HEADER", "x-ratelimit-requests-remaining"),
             "RATE_RESET_HEADER": os.environ.get(f"{API_REF}_RATE_RESET_HEADER", "x-ratelimit-requests-reset"),
-            "RATE_HAS_LIMIT": os.environ.get(f"{API_REF}_RATE_HAS_LIMIT", True)  # Default to True
+            "RATE_HAS_LIMIT": os.environ.get(f"{API_REF}_RATE_HAS_LIMIT", True),  # Default to True
+            "POOL_SIZE": int(os.environ.get(f"{API_REF}_POOL_SIZE", 10)),
+            "RETRIES": int(os.environ.get(f"{API_REF}_RETRIES", 3)),
+            "RETRY_BACKOFF": float(os.environ.get(f"{API_REF}_RETRY_BACKOFF", 0.5)),
+            "RETRY_BACKOFF_MAX": float(os.environ.get(f"{API_REF}_RETRY_BACKOFF_MAX", 5)),
+            "CONNECT_TIMEOUT": float(os.environ.get(f"{API_REF}_CONNECT_TIMEOUT", 3.05)),
+            "READ_TIMEOUT": float(os.environ.get(f"{API_REF}_READ_TIMEOUT", 10)),
+            "RATE_CAPACITY": float(os.environ.get(f"{API_REF}_RATE_CAPACITY", 0)),
+            "RATE_WINDOW": float(os.environ.get(f"{API_REF}_RATE_WINDOW", 60)),
+            "RATE_PERSIST_INTERVAL": float(os.environ.get(f"{API_REF}_RATE_PERSIST_INTERVAL", 60)),
+            "RATE_FILE": os.environ.get(f"{API_REF}_RATE_FILE",
+                                        os.path.join(tempfile.gettempdir(), f"is601_{API_REF.lower()}_ratelimit")),
         }
 
+    @staticmethod
+    def getSession(API_REF="API"):
+        # reusing the session's pooled connections skips the TCP+TLS handshake on every call
+        session = API.sessions.get(API_REF)
+        if session is None:
+            with API._session_lock:
+                session = API.sessions.get(API_REF)
+                if session is None:
+                    config = API._get_config(API_REF)
+                    retry = Retry(
+                        total=config["RETRIES"],
+                        backoff_factor=config["RETRY_BACKOFF"],
+                        backoff_max=config["RETRY_BACKOFF_MAX"],
+                        # a retried 429 would spend calls the rate limit bucket doesn't count and hide the
+                        # 429 from it (API._update_rate_limit()), and sleep for whatever Retry-After says
+                        status_forcelist=(500, 502, 503, 504),
+                        respect_retry_after_header=False,
+                        # the last 5xx response is returned as is instead of raising
+                        raise_on_status=False)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config["POOL_SIZE"], max_retries=retry)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    API.sessions[API_REF] = session
+        return session
+
+    @staticmethod
+    def getLimiter(API_REF="API"):
+        limiter = API.limiters.get(API_REF)
+        if limiter is None:
+            created = False
+            with API._session_lock:
+                limiter = API.limiters.get(API_REF)
+                if limiter is None:
+                    config = API._get_config(API_REF)
+                    limiter = TokenBucket(config["RATE_FILE"] or None, capacity=config["RATE_CAPACITY"] or None,
+                                          window=config["RATE_WINDOW"],
+                                          persist_interval=config["RATE_PERSIST_INTERVAL"])
+                    created = limiter.created
+                    API.limiters[API_REF] = limiter
+            if created:
+                # first process since the machine started (or the file was removed), the DB is
+                # read outside the lock so a slow one doesn't hold up every other API call
+                API._restore_rate_limit(API_REF, limiter)
+        return limiter
+
+    @staticmethod
+    def reset():
+        # forgets the sessions and rate limiters so the next call re-reads the config (used by tests)
+        API.closeSessions()
+        with API._session_lock:
+            limiters = list(API.limiters.values())
+            API.limiters = {}
+        for limiter in limiters:
+            limiter.close()
+
+    @staticmethod
+    def closeSessions():
+        # closes the pooled connections (e.g., at the end of a script or after changing the config)
+        with API._session_lock:
+            sessions = list(API.sessions.values())
+            API.sessions = {}
+        for session in sessions:
+            session.close()
+
     @staticmethod
     def get(url, params=None, API_REF="API"):
         return API._fetch(url, params, API_REF, HTTP.GET)
@@ -63,32 +162,43 @@ class API:
             params[config["PARAMS_KEY_NAME"]] = config["name"]
 
         url = config["BASE_URL"] + url
+        limiter = API.getLimiter(API_REF) if config["RATE_HAS_LIMIT"] else None
+        if limiter is not None:
+            # raises RateLimitExceeded without calling the API
+            limiter.acquire()
+        session = API.getSession(API_REF)
+        timeout = (config["CONNECT_TIMEOUT"], config["READ_TIMEOUT"])
 
         if verb == HTTP.GET:
-            response = requests.get(url, headers=headers, params=params)
+            response = session.get(url, headers=headers, params=params, timeout=timeout)
         elif verb == HTTP.POST:
-            response = requests.post(url, headers=headers, params=params)
+            response = session.post(url, headers=headers, params=params, timeout=timeout)
         else:
             raise ValueError(f"Invalid HTTP verb: {verb}")
 
         # Check if RATE_HAS_LIMIT is True before updating rate limit, remaining rate, and rate limit reset time
-        if config["RATE_HAS_LIMIT"]:
-            API._update_rate_limit(API_REF, response)
+        if limiter is not None:
+            API._update_rate_limit(API_REF, response, limiter)
 
         return response.json()
 
     @staticmethod
-    def _update_rate_limit(API_REF, response):
-        if not API._is_eligible_to_fetch(API_REF):
-            raise Exception("Rate limit reached or exceeded")
+    def _update_rate_limit(API_REF, response, limiter):
         config = API._get_config(API_REF)
-        rate_limit_header = config["RATE_LIMIT_HEADER"]
-        rate_remaining_header = config["RATE_REMAINING_HEADER"]
-        rate_limit_reset_header = config["RATE_RESET_HEADER"]
-
-        rate_limit = int(response.headers.get(rate_limit_header, 0))
-        rate_remaining = int(response.headers.get(rate_remaining_header, 0))
-        rate_limit_reset_time_seconds = int(response.headers.get(rate_limit_reset_header, 0))
+        headers = response.headers
+        if response.status_code == 429:
+            # out of calls whatever the headers say, wait for Retry-After (or the window) before the next
+            retry_after = headers.get("Retry-After")
+            limiter.sync(remaining=0, reset_seconds=int(retry_after) if retry_after and retry_after.isdigit()
+                         else config["RATE_WINDOW"])
+        if config["RATE_REMAINING_HEADER"] not in headers:
+            # the provider doesn't report its limits, the bucket's own count is all there is
+            return
+        rate_limit = int(headers.get(config["RATE_LIMIT_HEADER"], 0))
+        rate_remaining = int(headers.get(config["RATE_REMAINING_HEADER"], 0))
+        rate_limit_reset_time_seconds = int(headers.get(config["RATE_RESET_HEADER"], 0))
+        if not limiter.sync(rate_limit, rate_remaining, rate_limit_reset_time_seconds):
+            return
 
         # Calculate reset time based on current time and reset time in seconds
         current_time = datetime.utcnow()
@@ -102,60 +212,50 @@ class API:
         rate_remaining_key = f"{API_REF}_RATE_REMAINING"
         rate_limit_reset_key = f"{API_REF}_RATE_LIMIT_RESET_TIME"
 
-        # Create a list of dictionaries with named placeholders for the values
         rate_data = [
-            {"key": rate_limit_key, "value": rate_limit},
-            {"key": rate_remaining_key, "value": rate_remaining},
-            {"key": rate_limit_reset_key, "value": reset_time_str}
+            (rate_limit_key, rate_limit),
+            (rate_remaining_key, rate_remaining),
+            (rate_limit_reset_key, reset_time_str)
         ]
 
-        # Create the insert or update query for the rate limit, remaining rate, and rate limit reset time
-        insert_query = "INSERT INTO IS601_System_Properties (`name`, `value`) VALUES (%(key)s, %(value)s) ON DUPLICATE KEY UPDATE `value` = VALUES(value)"
-
-        # Execute the query with the list of data
-        DB.insertMany(insert_query, rate_data)
+        # saved every RATE_PERSIST_INTERVAL seconds (by one of the workers) so a restart picks up
+        # where the limit was, insert or update the three properties in one statement
+        try:
+            DB.bulkUpsert("IS601_System_Properties", ["name", "value"], rate_data, ["value"])
+        except Exception as e:
+            print(f"Unable to save the {API_REF} rate limit", e)
 
     @staticmethod
-    def _check_rate_limit(API_REF):
-        config = API._get_config(API_REF)
+    def _restore_rate_limit(API_REF, limiter):
+        # seeds a new bucket with the last saved state, e.g. still blocked until the reset time
         rate_remaining_key = f"{API_REF}_RATE_REMAINING"
         rate_limit_reset_key = f"{API_REF}_RATE_LIMIT_RESET_TIME"
 
         # Fetch remaining rate and rate limit reset time from System_Properties table
         query = "SELECT `value` FROM IS601_System_Properties WHERE `name` IN (%s, %s) ORDER BY name desc"
         params = [rate_remaining_key,rate_limit_reset_key]
+        try:
+            rows = DB.selectAll(query, *params).rows
+        except Exception as e:
+            print(f"Unable to load the {API_REF} rate limit", e)
+            return
+        if not rows or len(rows) != 2:
+            # no record yet, start with a full bucket
+            return
 
-        result = DB.selectAll(query, *params)
-        rows = result.rows
-        if not rows:
-            # no record yet, auto pass
-            return True
-        
-        if len(rows) != 2:
-            raise Exception("Incomplete rate limit data in System_Properties")
-        
         rate_remaining_value = int(rows[0]["value"])
         rate_limit_reset_time_str = rows[1]["value"]
 
         # Convert rate limit reset time from string to datetime
         rate_limit_reset_time = datetime.strptime(rate_limit_reset_time_str, "%Y-%m-%d %H:%M:%S")
-
-        # Check if rate limit has been exceeded
-        if rate_remaining_value <= 0:
-            # Rate limit exceeded
-            if datetime.utcnow() < rate_limit_reset_time:
-                # Rate limit reset time hasn't passed yet
-                return False
-            else:
-                # Rate limit reset time has passed, reset rate remaining to 0
-                return True
-
-        # Rate limit not exceeded
-        return True
+        seconds_left = (rate_limit_reset_time - datetime.utcnow()).total_seconds()
+        if seconds_left > 0:
+            # the saved window hasn't reset yet
+            limiter.sync(remaining=rate_remaining_value, reset_seconds=seconds_left)
 
     @staticmethod
     def _is_eligible_to_fetch(API_REF):
-        return API._check_rate_limit(API_REF)
+        return API.getLimiter(API_REF).available() >= 1
 
 
 if __name__ == "__main__":
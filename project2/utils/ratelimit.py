@@ -0,0 +1,134 @@
+# Token bucket shared by every process on the machine (e.g., gunicorn workers) through a small
+# mmap'd file, so checking the API's rate limit costs microseconds instead of database round trips
+# The file holds the bucket's state and is locked with flock while it's read/updated, without
+# fcntl (Windows) or with path=None the bucket is only shared by the threads of one process
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds until a token is available
+
+
+class TokenBucket:
+    FIELDS = ("tokens", "updated", "capacity", "rate", "resets_at", "persisted_at", "initialized")
+    LAYOUT = struct.Struct("<dddddd?")
+
+    def __init__(self, path=None, capacity=None, window=60, persist_interval=60):
+        # capacity tokens, refilled evenly over window seconds, capacity=None doesn't limit calls until
+        # the provider reports its limit (sync())
+        self.path = path
+        self.capacity = capacity
+        self.window = window
+        self.persist_interval = persist_interval  # see sync()
+        self.created = False  # True when this bucket set up the shared state (nothing to share yet)
+        self._lock = threading.Lock()  # flock doesn't keep this process' own threads apart
+        self._fd = None
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < TokenBucket.LAYOUT.size:
+                os.ftruncate(self._fd, TokenBucket.LAYOUT.size)
+            self._map = mmap.mmap(self._fd, TokenBucket.LAYOUT.size)
+        else:
+            self._map = bytearray(TokenBucket.LAYOUT.size)
+        with self._state():
+            pass
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            if self._fd is not None and fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = dict(zip(TokenBucket.FIELDS, TokenBucket.LAYOUT.unpack_from(self._map, 0)))
+                now = time.time()
+                if not state["initialized"]:
+                    capacity = float(self.capacity) if self.capacity else math.inf
+                    state.update(tokens=capacity, updated=now, capacity=capacity,
+                                 rate=self.capacity / self.window if self.capacity else 0.0, resets_at=0.0,
+                                 persisted_at=now, initialized=True)
+                    self.created = True
+                self._refill(state, now)
+                yield state
+                TokenBucket.LAYOUT.pack_into(self._map, 0, *(state[f] for f in TokenBucket.FIELDS))
+            finally:
+                if self._fd is not None and fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _refill(state, now):
+        if state["resets_at"]:
+            if now < state["resets_at"]:
+                # the provider gives calls back when its window resets, not gradually
+                state["updated"] = now
+                return
+            state["tokens"] = state["capacity"]
+            state["resets_at"] = 0.0
+        elapsed = max(now - state["updated"], 0.0)
+        state["tokens"] = min(state["capacity"], state["tokens"] + elapsed * state["rate"])
+        state["updated"] = now
+
+    def acquire(self):
+        # takes a token or raises RateLimitExceeded, the API isn't called in that case
+        with self._state() as state:
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return
+            if state["resets_at"]:
+                retry_after = state["resets_at"] - state["updated"]
+            else:
+                retry_after = (1 - state["tokens"]) / state["rate"] if state["rate"] else self.window
+        raise RateLimitExceeded(f"Rate limit reached, retry in {retry_after:.1f}s", retry_after)
+
+    def available(self):
+        with self._state() as state:
+            return state["tokens"]
+
+    def sync(self, limit=None, remaining=None, reset_seconds=None):
+        # corrects the bucket with what the provider reported (its rate limit headers), the provider
+        # knows about calls from other machines too: limit calls per window, remaining of them until
+        # its window resets in reset_seconds (window seconds from the first report when it doesn't say)
+        # returns True to the one caller per persist_interval that should save the state (to the DB)
+        with self._state() as state:
+            now = state["updated"]
+            if limit:
+                state["rate"] = limit / self.window
+                state["capacity"] = float(limit)
+                state["tokens"] = min(state["tokens"], state["capacity"])
+            if remaining is not None:
+                state["tokens"] = min(state["tokens"], float(max(remaining, 0)))
+            if reset_seconds:
+                state["resets_at"] = now + reset_seconds
+            elif remaining is not None and not state["rate"] and not state["resets_at"]:
+                # no local rate to refill with either
+                state["resets_at"] = now + self.window
+            persist = now - state["persisted_at"] >= self.persist_interval
+            if persist:
+                state["persisted_at"] = now
+        return persist
+
+    def stats(self):
+        with self._state() as state:
+            # None while there's no limit (yet)
+            return {
+                "tokens": round(state["tokens"], 3) if state["tokens"] != math.inf else None,
+                "capacity": state["capacity"] if state["capacity"] != math.inf else None,
+                "resets_in": round(max(state["resets_at"] - state["updated"], 0.0), 3),
+            }
+
+    def close(self):
+        if self._fd is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,42 @@
+import hmac
+import os
+
+from flask import Blueprint, abort, jsonify, request
+
+from sql.db import DB
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.before_request
+def check_token():
+    # served only with METRICS_TOKEN set, to requests carrying it ("Authorization: Bearer <token>"),
+    # the client's address says nothing behind a reverse proxy
+    token = os.environ.get("METRICS_TOKEN", "")
+    if not token:
+        abort(404)
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer ") or not hmac.compare_digest(auth[len("Bearer "):].encode(), token.encode()):
+        abort(403)
+
+
+@metrics.route('/metrics', methods=['GET'])
+def index():
+    limit = request.args.get("limit", type=int)
+    return jsonify({
+        "queries": DB.queryStats(limit),
+        "pool": DB.poolStats(),
+        "replicas": DB.replicaStats(),
+        "shards": DB.shardStats(),
+        "statements": DB.statementCacheStats(),
+        "results": DB.resultCacheStats(),
+        "identity_map": DB.identityMapStats(),
+        "budget": DB.budgetReport(limit),
+        "n_plus_one": DB.nPlusOneReport(),
+    })
+
+
+@metrics.route('/metrics/reset', methods=['POST'])
+def reset():
+    DB.getStats().reset()
+    DB.getNPlusOne().reset()
+    return jsonify({"status": True})